@@ -0,0 +1,94 @@
+"""
+    Runs start_crawling against the local stand-in of the riot api (see fake_riot_api.py)
+    and reports matches per minute, api calls per stored match, 429s and peak memory.
+    Uses mongomock unless --db-url is given; a real database should be a throwaway one,
+    since its ReDiTi collection is replaced with the ranks to crawl.
+
+    Usage: python -m benchmarks.crawl_throughput [--ranks 4] [--pages 2] [--latency 0.02] [--keys 1] [--concurrent] ...
+"""
+import argparse
+import json
+import resource
+import time
+from multiprocessing import Process
+from urllib.request import urlopen
+from mooncaker.external_tools import REGIONS, TIERS, DIVISIONS
+from mooncaker.external_tools.data_crawler import Crawler
+from benchmarks.fake_riot_api import FakeRiotApi
+
+
+def set_ranks(database, count):
+    """
+    Replaces the ranks to crawl with the first count ones, taken from every region in turn
+    """
+    ranks = [{'region': region, 'tier': tier, 'division': division, 'page': 1, 'crawled': False}
+             for tier in TIERS for division in DIVISIONS for region in REGIONS][:count]
+    database.db_rediti.delete_many({})
+    database.db_rediti.insert_many(ranks)
+
+
+def no_new_key():
+    raise RuntimeError("The stand-in api never asks for a new key")
+
+
+def run(api, ranks=4, db_url=None, keys=1, **crawler_args):
+    """
+    Args:
+        api (FakeRiotApi): the stand-in to crawl, served in its own process
+        ranks (int, optional): tiers and divisions to crawl. Defaults to 4.
+        db_url (str, optional): the Mongo DB to use. Defaults to None, a mock.
+        keys (int, optional): api keys given to the crawler, each with its own rate limits. Defaults to 1.
+        crawler_args: passed to the Crawler
+
+    Returns:
+        dict: the results of the benchmark
+    """
+    server = api.server()
+    port = server.server_address[1]
+    server_process = Process(target=server.serve_forever, daemon=True)
+    server_process.start()
+    try:
+        crawler = Crawler([f"RGAPI-benchmark-{number}" for number in range(keys)], no_new_key, db_url,
+                          api_url=f"http://127.0.0.1:{port}/{{platform}}", **crawler_args)
+        set_ranks(crawler.db, ranks)
+        start = time.time()
+        crawler.start_crawling()
+        elapsed = time.time() - start
+        with urlopen(f"http://127.0.0.1:{port}/stats") as response:
+            stats = json.load(response)
+    finally:
+        server_process.terminate()
+        server.server_close()
+    stored = crawler.db.count_matches()
+    calls = sum(stats["requests"].values())
+    return {"seconds": round(elapsed, 2),
+            "stored_matches": stored,
+            "matches_per_minute": round(stored / elapsed * 60, 1),
+            "calls_per_match": round(calls / max(stored, 1), 2),
+            "calls": stats["requests"],
+            "429s": stats["statuses"].get("429", 0),
+            "errors": sum(count for status, count in stats["statuses"].items() if status.startswith("5")),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the crawler against a stand-in of the riot api")
+    parser.add_argument("--ranks", type=int, default=4)
+    parser.add_argument("--pages", type=int, default=2)
+    parser.add_argument("--entries-per-page", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--app-limits", default="500:10,30000:600")
+    parser.add_argument("--method-limits", default="2000:10")
+    parser.add_argument("--db-url", default=None)
+    parser.add_argument("--keys", type=int, default=1)
+    parser.add_argument("--concurrent", action="store_true")
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--record", default=None, metavar="CASSETTE",
+                        help="record the traffic, to be replayed with benchmarks.replay_crawl")
+    args = parser.parse_args()
+    api = FakeRiotApi(pages=args.pages, entries_per_page=args.entries_per_page, latency=args.latency,
+                      error_rate=args.error_rate, app_limits=args.app_limits, method_limits=args.method_limits)
+    results = run(api, args.ranks, args.db_url, args.keys, concurrent=args.concurrent, max_in_flight=args.max_in_flight,
+                  record=args.record)
+    print(json.dumps(results, indent=4))
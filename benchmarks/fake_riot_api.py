@@ -0,0 +1,278 @@
+"""
+    A local stand-in for the riot api serving synthetic league-v4, summoner-v4 and match-v5 data,
+    with the rate limit headers and the 429s of the real one, some latency and some errors.
+    The crawler is pointed to it with Crawler(api_url="http://127.0.0.1:<port>/{platform}").
+
+    Usage: python -m benchmarks.fake_riot_api [--port 8080] [--latency 0.05] [--error-rate 0.01] ...
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from benchmarks.timeline_extraction import synthetic_timeline
+
+
+ROLE_POSITIONS = ["TOP", "JUNGLE", "MIDDLE", "BOTTOM", "UTILITY"]
+# where each participant stands at the second minute, so that the timeline gives the same roles
+TIMELINE_POSITIONS = {1: (2030, 12480), 2: (6215, 10700), 3: (7100, 7100), 4: (11500, 2000), 5: (11110, 1300),
+                      6: (2600, 12700), 7: (7300, 5100), 8: (7900, 7300), 9: (12600, 3000), 10: (11100, 2100)}
+ROUTES = [(re.compile(r"^/lol/league/v4/entries/[^/]+/(?P<tier>[^/]+)/(?P<division>[^/]+)$"), "league.entries"),
+          (re.compile(r"^/lol/summoner/v4/summoners/by-name/(?P<name>[^/]+)$"), "summoner.by_name"),
+          (re.compile(r"^/lol/summoner/v4/summoners/(?P<id>[^/]+)$"), "summoner.by_id"),
+          (re.compile(r"^/lol/match/v5/matches/by-puuid/(?P<puuid>[^/]+)/ids$"), "match.matchlist_by_puuid"),
+          (re.compile(r"^/lol/match/v5/matches/(?P<match_id>[^/]+)/timeline$"), "match.timeline_by_match"),
+          (re.compile(r"^/lol/match/v5/matches/(?P<match_id>[^/]+)$"), "match.by_id")]
+
+
+def parse_limits(header):
+    return [(int(requests), int(window)) for requests, window in
+            (limit.split(":") for limit in header.split(","))]
+
+
+class Limit():
+    """
+    Sliding windows of the requests made, as riot counts them
+    """
+
+    def __init__(self, header):
+        self.header = header
+        self.windows = [(requests, window, deque()) for requests, window in parse_limits(header)]
+
+    def retry_after(self, now):
+        """
+        Returns:
+            int: seconds to wait before the next request is allowed, 0 if it's allowed now
+        """
+        wait = 0
+        for requests, window, times in self.windows:
+            while times and times[0] <= now - window:
+                times.popleft()
+            if len(times) >= requests:
+                wait = max(wait, times[0] + window - now)
+        return int(wait) + 1 if wait else 0
+
+    def spend(self, now):
+        for _, _, times in self.windows:
+            times.append(now)
+
+    def counts(self):
+        return ",".join(f"{len(times)}:{window}" for _, window, times in self.windows)
+
+
+class FakeRiotApi():
+
+    def __init__(self, pages=2, entries_per_page=20, matches_per_player=20, match_pool=200,
+                 timeline_rate=0.1, events_per_frame=50, latency=0.0, error_rate=0.0,
+                 app_limits="500:10,30000:600", method_limits="2000:10", seed=0, revoked_keys=()):
+        """
+        Args:
+            pages (int, optional): pages of league entries for each tier and division. Defaults to 2.
+            entries_per_page (int, optional): league entries in each page. Defaults to 20.
+            matches_per_player (int, optional): clash matches in the history of each player. Defaults to 20.
+            match_pool (int, optional): distinct matches of each tier and division, the histories of its
+                                        players overlap when it's small. Defaults to 200.
+            timeline_rate (float, optional): fraction of matches without positions, so that the crawler needs
+                                             their timeline. Defaults to 0.1.
+            events_per_frame (int, optional): size of the timelines. Defaults to 50.
+            latency (float, optional): average seconds taken by each response. Defaults to 0.0.
+            error_rate (float, optional): fraction of responses that are a 500 or a 503. Defaults to 0.0.
+            app_limits (str, optional): application rate limits for each routing value, as in the headers.
+                                        Defaults to the ones of a production key.
+            method_limits (str, optional): rate limits of each method. Defaults to "2000:10".
+            seed (int, optional): seed of the synthetic data. Defaults to 0.
+            revoked_keys (iterable(str), optional): api keys answered with a 403. Defaults to none.
+        """
+        self.pages = pages
+        self.entries_per_page = entries_per_page
+        self.matches_per_player = matches_per_player
+        self.match_pool = match_pool
+        self.timeline_rate = timeline_rate
+        self.events_per_frame = events_per_frame
+        self.latency = latency
+        self.error_rate = error_rate
+        self.app_limits = app_limits
+        self.method_limits = method_limits
+        self.seed = seed
+        self.revoked_keys = set(revoked_keys)
+        self.limits = {}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.rng = random.Random(seed)
+
+    def rng_for(self, *values):
+        return random.Random("-".join(map(str, (self.seed,) + values)))
+
+    def rate_limit(self, platform, method, key=None):
+        """
+        Returns:
+            (int, dict): the status (200 or 429) and the rate limit headers, every key has its own limits
+        """
+        now = time.time()
+        with self.lock:
+            app = self.limits.setdefault((key, platform), Limit(self.app_limits))
+            method_limit = self.limits.setdefault((key, platform, method), Limit(self.method_limits))
+            app_wait, method_wait = app.retry_after(now), method_limit.retry_after(now)
+            if not app_wait and not method_wait:
+                app.spend(now)
+                method_limit.spend(now)
+            headers = {"X-App-Rate-Limit": app.header, "X-App-Rate-Limit-Count": app.counts(),
+                       "X-Method-Rate-Limit": method_limit.header,
+                       "X-Method-Rate-Limit-Count": method_limit.counts()}
+        if app_wait or method_wait:
+            headers["Retry-After"] = str(max(app_wait, method_wait))
+            headers["X-Rate-Limit-Type"] = "application" if app_wait >= method_wait else "method"
+            return 429, headers
+        return 200, headers
+
+    def entries(self, platform, tier, division, query):
+        page = int(query.get("page", ["1"])[0])
+        if page > self.pages:
+            return []
+        return [{"summonerId": f"{platform}.{tier}.{division}.{page}.{number}",
+                 "summonerName": f"{tier} {division} {page} {number}",
+                 "tier": tier, "rank": division, "leaguePoints": number}
+                for number in range(self.entries_per_page)]
+
+    def summoner(self, platform, summoner_id):
+        return {"id": summoner_id, "puuid": f"puuid.{summoner_id}", "name": summoner_id}
+
+    def matchlist(self, puuid, query):
+        # the players of a tier and division play among themselves
+        _, platform, tier, division, *_ = puuid.split(".")
+        pool_start = self.rng_for(tier, division).randrange(10 ** 9)
+        rng = self.rng_for(puuid)
+        history = sorted(rng.sample(range(self.match_pool), min(self.matches_per_player, self.match_pool)),
+                         reverse=True)
+        start = int(query.get("start", ["0"])[0])
+        count = int(query.get("count", ["20"])[0])
+        return [f"{platform.upper()}_{pool_start + number}" for number in history[start:start + count]]
+
+    def match(self, match_id):
+        rng = self.rng_for(match_id)
+        needs_timeline = rng.random() < self.timeline_rate
+        participants = []
+        for number in range(10):
+            position = ROLE_POSITIONS[number % 5]
+            participants.append({"participantId": number + 1, "puuid": f"puuid.{match_id}.{number}",
+                                 "teamId": 100 if number < 5 else 200,
+                                 "championId": rng.randint(1, 150),
+                                 "summoner1Id": 11 if position == "JUNGLE" else 4, "summoner2Id": 14,
+                                 "teamPosition": "" if needs_timeline else position,
+                                 "individualPosition": "Invalid",
+                                 "totalMinionsKilled": 20 if position == "UTILITY" else rng.randint(100, 250),
+                                 "gameEndedInEarlySurrender": False})
+        winner = rng.choice([100, 200])
+        return {"metadata": {"matchId": match_id, "participants": [p["puuid"] for p in participants]},
+                "info": {"gameDuration": rng.randint(1200, 2400), "gameEndTimestamp": 1,
+                         "gameVersion": "11.14.385.9967", "platformId": match_id.split("_")[0],
+                         "queueId": 700, "participants": participants,
+                         "teams": [{"teamId": team, "win": team == winner,
+                                    "bans": [{"championId": rng.randint(1, 150), "pickTurn": turn}
+                                             for turn in range(5)]}
+                                   for team in (100, 200)]}}
+
+    def timeline(self, match_id):
+        return synthetic_timeline(minutes=25, events_per_frame=self.events_per_frame,
+                                  seed=match_id, positions=TIMELINE_POSITIONS)
+
+    def respond(self, path, query, key=None):
+        """
+        Args:
+            path (str): the path requested, starting with the platform or routing value
+            query (dict): the query parameters, as parsed by parse_qs
+            key (str, optional): the api key sent with the request. Defaults to None.
+
+        Returns:
+            (int, dict, str): the status, the headers and the body of the response
+        """
+        platform, _, path = path.lstrip("/").partition("/")
+        path = "/" + path
+        for pattern, method in ROUTES:
+            found = pattern.match(path)
+            if found:
+                break
+        else:
+            return 404, {}, json.dumps({"status": {"message": "Not found", "status_code": 404}})
+        with self.lock:
+            self.requests[method] += 1
+        if key in self.revoked_keys:
+            return 403, {}, json.dumps({"status": {"message": "Forbidden", "status_code": 403}})
+        if self.latency:
+            time.sleep(self.rng.uniform(0.5, 1.5) * self.latency)
+        status, headers = self.rate_limit(platform, method, key)
+        if status == 429:
+            return status, headers, json.dumps({"status": {"message": "Rate limit exceeded", "status_code": 429}})
+        if self.rng.random() < self.error_rate:
+            status = self.rng.choice([500, 503])
+            return status, headers, json.dumps({"status": {"message": "Injected error", "status_code": status}})
+        params = found.groupdict()
+        if method == "league.entries":
+            body = self.entries(platform, params["tier"], params["division"], query)
+        elif method.startswith("summoner."):
+            body = self.summoner(platform, params.get("id") or params["name"])
+        elif method == "match.matchlist_by_puuid":
+            body = self.matchlist(params["puuid"], query)
+        elif method == "match.timeline_by_match":
+            return 200, headers, self.timeline(params["match_id"])
+        else:
+            body = self.match(params["match_id"])
+        return 200, headers, json.dumps(body)
+
+    def stats(self):
+        with self.lock:
+            return {"requests": dict(self.requests), "statuses": dict(self.statuses)}
+
+    def server(self, host="127.0.0.1", port=0):
+        """
+        Returns:
+            ThreadingHTTPServer: the server, bound but not yet serving (port 0 picks a free port)
+        """
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/stats":
+                    status, headers, body = 200, {}, json.dumps(api.stats())
+                else:
+                    status, headers, body = api.respond(url.path, parse_qs(url.query),
+                                                        self.headers.get("X-Riot-Token"))
+                    with api.lock:
+                        api.statuses[status] += 1
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json;charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *_):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves synthetic riot api data")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--pages", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--app-limits", default="500:10,30000:600")
+    parser.add_argument("--method-limits", default="2000:10")
+    args = parser.parse_args()
+    api = FakeRiotApi(pages=args.pages, latency=args.latency, error_rate=args.error_rate,
+                      app_limits=args.app_limits, method_limits=args.method_limits)
+    print(f"Serving on http://127.0.0.1:{args.port}/{{platform}}")
+    api.server(port=args.port).serve_forever()
@@ -0,0 +1,78 @@
+"""
+    Replays a recorded crawl (see the record option of the Crawler) against mongomock,
+    at full speed and without network, optionally under cProfile, to profile the parsing
+    and the database stages of the crawler in isolation.
+
+    Usage: python -m benchmarks.replay_crawl <cassette> [--profile N] [--concurrent]
+"""
+import argparse
+import cProfile
+import json
+import pstats
+import re
+import time
+from mooncaker.external_tools.data_crawler import Crawler
+from mooncaker.external_tools.cassette import CassettePlayer
+
+
+ENTRIES_PATH = re.compile(r"/lol/league/v4/entries/[^/]+/(?P<tier>[^/]+)/(?P<division>[^/]+)$")
+
+
+def recorded_ranks(player):
+    """
+    Returns:
+        list(dict): the ranks whose league entries were recorded, starting from their first recorded page
+    """
+    ranks = {}
+    for key in player.responses:
+        region, _, method_name, path, params = json.loads(key)
+        found = ENTRIES_PATH.search(path)
+        if method_name == "entries" and found:
+            rank = (region, found["tier"], found["division"])
+            ranks[rank] = min(ranks.get(rank, params.get("page", 1)), params.get("page", 1))
+    return [{'region': region, 'tier': tier, 'division': division, 'page': int(page), 'crawled': False}
+            for (region, tier, division), page in ranks.items()]
+
+
+def no_new_key():
+    raise RuntimeError("No key is needed when replaying")
+
+
+def replay(path, concurrent=False, profile=None):
+    """
+    Args:
+        path (str): the cassette
+        concurrent (bool, optional): replay with the concurrent crawler. Defaults to False.
+        profile (cProfile.Profile, optional): enabled around the crawling. Defaults to None.
+
+    Returns:
+        dict: the results of the replay
+    """
+    crawler = Crawler("RGAPI-replay", no_new_key, None, concurrent=concurrent, replay=path)
+    crawler.db.db_rediti.delete_many({})
+    crawler.db.db_rediti.insert_many(recorded_ranks(crawler.cassette))
+    start = time.time()
+    if profile is not None:
+        profile.enable()
+    crawler.start_crawling()
+    if profile is not None:
+        profile.disable()
+    elapsed = time.time() - start
+    stored = crawler.db.count_matches()
+    return {"seconds": round(elapsed, 2),
+            "stored_matches": stored,
+            "matches_per_minute": round(stored / elapsed * 60, 1),
+            "not_in_cassette": crawler.cassette.missing}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays a recorded crawl")
+    parser.add_argument("cassette")
+    parser.add_argument("--concurrent", action="store_true")
+    parser.add_argument("--profile", type=int, default=0, metavar="N",
+                        help="profile the replay and print the N most expensive functions")
+    args = parser.parse_args()
+    profile = cProfile.Profile() if args.profile else None
+    print(json.dumps(replay(args.cassette, args.concurrent, profile), indent=4))
+    if profile is not None:
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(args.profile)
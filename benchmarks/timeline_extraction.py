@@ -0,0 +1,108 @@
+"""
+    Compares the time and the peak memory needed to get the role frames out of a timeline
+    decoding the whole json (the old path) and with timeline_parser.role_frames.
+
+    Usage: python -m benchmarks.timeline_extraction [timeline.json | raw store directory ...] [--repeat N]
+    Without arguments a synthetic timeline shaped like the ones of riot (30 minutes) is used.
+"""
+import argparse
+import json
+import os
+import random
+import time
+import tracemalloc
+from mooncaker.external_tools.raw_store import DiskRawStore
+from mooncaker.external_tools.timeline_parser import role_frames
+
+
+def synthetic_timeline(minutes=30, events_per_frame=300, seed=0, positions=None):
+    """
+    Args:
+        positions (dict, optional): participant id -> (x, y) where the participant is in every frame.
+                                    Defaults to None, random positions.
+
+    Returns:
+        str: the text of a timeline with the same layout and a similar size of a real one
+    """
+    rng = random.Random(seed)
+
+    def position(number):
+        if positions is not None:
+            return {"x": positions[number][0], "y": positions[number][1]}
+        return {"x": rng.randint(0, 15000), "y": rng.randint(0, 15000)}
+
+    def participant_frame(number):
+        return {"championStats": {stat: rng.randint(0, 5000) for stat in
+                                  ("abilityHaste", "armor", "attackDamage", "attackSpeed", "health",
+                                   "healthMax", "magicResist", "movementSpeed", "power", "powerMax")},
+                "currentGold": rng.randint(0, 3000),
+                "damageStats": {stat: rng.randint(0, 50000) for stat in
+                                ("magicDamageDone", "magicDamageDoneToChampions", "physicalDamageDone",
+                                 "physicalDamageDoneToChampions", "totalDamageDone", "totalDamageTaken",
+                                 "trueDamageDone", "trueDamageTaken")},
+                "jungleMinionsKilled": rng.randint(0, 100), "level": rng.randint(1, 18),
+                "minionsKilled": rng.randint(0, 300), "participantId": number,
+                "position": position(number),
+                "totalGold": rng.randint(500, 15000), "xp": rng.randint(0, 20000)}
+
+    def event(timestamp):
+        return {"itemId": rng.randint(1000, 7000), "participantId": rng.randint(1, 10),
+                "timestamp": timestamp, "type": rng.choice(["ITEM_PURCHASED", "SKILL_LEVEL_UP", "WARD_PLACED"]),
+                "position": {"x": rng.randint(0, 15000), "y": rng.randint(0, 15000)}}
+
+    frames = [{"events": [event(minute * 60000 + i) for i in range(events_per_frame)],
+               "participantFrames": {str(number): participant_frame(number) for number in range(1, 11)},
+               "timestamp": minute * 60000}
+              for minute in range(minutes + 1)]
+    return json.dumps({"metadata": {"dataVersion": "2", "matchId": "EUW1_1",
+                                    "participants": [f"puuid{number}" for number in range(10)]},
+                       "info": {"frameInterval": 60000, "frames": frames, "gameId": 1}})
+
+
+def load_timelines(paths):
+    timelines = []
+    for path in paths:
+        if os.path.isdir(path):
+            store = DiskRawStore(path)
+            timelines += [json.dumps(store.get(match_id, "timeline")) for match_id in store.match_ids()
+                          if os.path.exists(store.path(match_id, "timeline"))]
+        else:
+            with open(path) as timeline_file:
+                timelines.append(timeline_file.read())
+    return timelines
+
+
+def decode_all(text):
+    return role_frames(json.loads(text))
+
+
+def extract(text):
+    return role_frames(text)
+
+
+def measure(func, timelines, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in timelines:
+            func(text)
+    elapsed = (time.perf_counter() - start) / (repeat * len(timelines))
+    tracemalloc.start()
+    for text in timelines:
+        func(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the extraction of the role frames from timelines")
+    parser.add_argument("paths", nargs="*", help="timeline json files or raw store directories")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    timelines = load_timelines(args.paths) or [synthetic_timeline()]
+    assert all(decode_all(text) == extract(text) for text in timelines)
+    size = sum(len(text) for text in timelines) / len(timelines)
+    print(f"{len(timelines)} timelines, {size / 2 ** 20:.2f} MB on average")
+    for name, func in (("json.loads", decode_all), ("role_frames", extract)):
+        elapsed, peak = measure(func, timelines, args.repeat)
+        print(f"{name:>12}: {elapsed * 1000:8.2f} ms per timeline, peak memory {peak / 2 ** 20:8.2f} MB")
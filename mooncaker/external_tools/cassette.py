@@ -0,0 +1,141 @@
+"""
+    Records the traffic between the crawler and riot in a cassette and replays it,
+    so that a crawl can be repeated without network, api key or rate limits
+"""
+import atexit
+import gzip
+import json
+from collections import deque
+from functools import partial
+from logging import WARNING
+from threading import Lock, local
+from urllib.parse import urlsplit
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from riotwatcher import RateLimiter
+from riotwatcher.Handlers import RequestHandler
+from .logger import log as log_raw
+
+
+log = partial(log_raw, "cassette")
+# the headers needed to replay a response, the others are dropped to keep the cassette small
+RECORDED_HEADERS = ["Content-Type", "Retry-After", "X-Rate-Limit-Type",
+                    "X-App-Rate-Limit", "X-App-Rate-Limit-Count",
+                    "X-Method-Rate-Limit", "X-Method-Rate-Limit-Count"]
+CASSETTE_FLUSH_EVERY = 100
+
+
+def request_key(region, endpoint_name, method_name, url, query_params):
+    """
+    Returns:
+        str: what identifies a request in a cassette, what comes before /lol/ is left out so that
+             a crawl recorded against riot can be replayed with a different api_url
+    """
+    path = urlsplit(url).path
+    path = path[path.find("/lol/"):] if "/lol/" in path else path
+    params = {key: value for key, value in query_params.items() if value is not None}
+    return json.dumps([region, endpoint_name, method_name, path, params],
+                      sort_keys=True, default=str)
+
+
+class CassetteRecorder(RequestHandler):
+    """
+    Appends every request and its response to a gzipped file of json lines.
+    Each session is a new gzip member, so a cassette can be recorded in several runs.
+    It goes at the end of the handler chain, where it sees the responses as they come from riot.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): the cassette file, created if missing
+        """
+        super().__init__()
+        self.path = path
+        self.file = gzip.open(path, "at", encoding="utf-8")
+        self.lock = Lock()
+        self.current = local()
+        self.recorded = 0
+        atexit.register(self.close)
+
+    def preview_request(self, region, endpoint_name, method_name, url, query_params):
+        # the response doesn't carry the query params, the key is kept until it arrives on the same thread
+        self.current.key = request_key(region, endpoint_name, method_name, url, query_params)
+
+    def after_request(self, region, endpoint_name, method_name, url, response):
+        record = {"key": self.current.key,
+                  "status": response.status_code,
+                  "headers": {name: response.headers[name] for name in RECORDED_HEADERS
+                              if name in response.headers},
+                  "body": response.text}
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.recorded += 1
+            if self.recorded % CASSETTE_FLUSH_EVERY == 0:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class CassettePlayer(RequestHandler):
+    """
+    Answers every request with the response recorded for it, without touching the network.
+    A request made several times gets its responses in the recorded order, the last one
+    being repeated; a request that was never recorded gets a 404.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): the cassette file
+        """
+        super().__init__()
+        self.responses = {}
+        self.lock = Lock()
+        self.missing = 0
+        with gzip.open(path, "rt", encoding="utf-8") as cassette:
+            try:
+                for line in cassette:
+                    record = json.loads(line)
+                    self.responses.setdefault(record["key"], deque()).append(record)
+            except (EOFError, ValueError):
+                # the recording crawler was killed halfway through a line or a gzip member
+                log(WARNING, "The cassette %s is truncated, replaying what was recorded before", path)
+
+    def preview_request(self, region, endpoint_name, method_name, url, query_params):
+        key = request_key(region, endpoint_name, method_name, url, query_params)
+        with self.lock:
+            records = self.responses.get(key)
+            if records is None:
+                self.missing += 1
+                record = None
+            else:
+                record = records.popleft() if len(records) > 1 else records[0]
+        if record is None:
+            log(WARNING, "%s %s %s is not in the cassette, answering 404", method_name, url, query_params)
+            record = {"status": 404, "headers": {}, "body": '{"status": {"status_code": 404}}'}
+        response = Response()
+        response.status_code = record["status"]
+        response.headers = CaseInsensitiveDict(record["headers"])
+        response._content = record["body"].encode()
+        response.encoding = "utf-8"
+        response.url = url
+        return response
+
+
+class NoRateLimiter(RateLimiter):
+    """
+    Never delays a call, used when replaying a cassette
+    """
+
+    def next_free(self, region, endpoint_name, method_name):
+        return 0.0
+
+    def wait_until(self, region, endpoint_name, method_name):
+        return None
+
+    def record_response(self, region, endpoint_name, method_name, status, headers):
+        pass
@@ -0,0 +1,154 @@
+"""
+    Runs the steps of the crawling as stages connected by bounded queues,
+    so that network calls, parsing and database writes overlap
+"""
+from concurrent.futures import Future
+from queue import Queue, Full, Empty
+from threading import Thread, Event
+
+
+class Marker():
+    """
+    An item that is passed untouched through every stage, in order with the other items.
+    Used to tell the last stage that everything coming from a page went through.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Failure():
+    """
+    Carries the exception raised by a stage down to the consumer of the pipeline
+    """
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Stage():
+
+    def __init__(self, name, func, pool=None):
+        """
+        Args:
+            name (str): the name of the stage, used for the threads and the queue depths
+            func (callable): called with each item, returns an iterable of items for the next stage
+            pool (Executor, optional): if given func runs on the pool and the stage only submits the
+                                       items, the next stage waits for the results in order. The number
+                                       of items in flight is then bounded by the size of the queues.
+                                       Defaults to None.
+        """
+        self.name = name
+        self.func = func
+        self.pool = pool
+
+
+END = object()
+
+
+def resolve(item):
+    """
+    Returns the items carried by an item of a queue, waiting for them if they come from a pool
+    """
+    if isinstance(item, Future):
+        try:
+            return item.result()
+        except Exception as err:
+            return [Failure(err)]
+    return [item]
+
+
+class Pipeline():
+    """
+    Iterating over a pipeline runs the source and every stage in its own thread and yields
+    the items coming out of the last stage. Each queue holds at most maxsize items, so a slow
+    stage makes the previous ones wait instead of piling up items in memory.
+    """
+
+    def __init__(self, source, stages, maxsize=100):
+        """
+        Args:
+            source (iterable): the items to feed to the first stage
+            stages (list(Stage)): the stages, in order
+            maxsize (int, optional): the size of the queues between the stages. Defaults to 100.
+        """
+        self.source = source
+        self.stages = stages
+        self.queues = [Queue(maxsize) for _ in range(len(stages) + 1)]
+        self.stopped = Event()
+
+    def depths(self):
+        """
+        Returns:
+            dict: name of the stage -> number of items waiting to be processed by it
+                  ('output' for the items produced by the last stage)
+        """
+        names = [stage.name for stage in self.stages] + ['output']
+        return {name: queue.qsize() for name, queue in zip(names, self.queues)}
+
+    def put(self, queue, item):
+        # the consumer might stop early, in that case nobody is going to empty the queue
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def get(self, queue):
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                pass
+        return END
+
+    def run_source(self, outbox):
+        try:
+            for item in self.source:
+                if not self.put(outbox, item):
+                    return
+        except Exception as err:
+            self.put(outbox, Failure(err))
+        self.put(outbox, END)
+
+    def run_stage(self, stage, inbox, outbox):
+        while True:
+            received = self.get(inbox)
+            if received is END:
+                break
+            for item in resolve(received):
+                if isinstance(item, (Marker, Failure)):
+                    self.put(outbox, item)
+                elif stage.pool is not None:
+                    self.put(outbox, stage.pool.submit(lambda item: list(stage.func(item)), item))
+                else:
+                    try:
+                        for result in stage.func(item):
+                            self.put(outbox, result)
+                    except Exception as err:
+                        self.put(outbox, Failure(err))
+        self.put(outbox, END)
+
+    def __iter__(self):
+        threads = [Thread(target=self.run_source, args=(self.queues[0],),
+                          name="pipeline-source", daemon=True)]
+        for stage, inbox, outbox in zip(self.stages, self.queues, self.queues[1:]):
+            threads.append(Thread(target=self.run_stage, args=(stage, inbox, outbox),
+                                  name=f"pipeline-{stage.name}", daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                received = self.get(self.queues[-1])
+                if received is END:
+                    break
+                for item in resolve(received):
+                    if isinstance(item, Failure):
+                        raise item.exception
+                    yield item
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
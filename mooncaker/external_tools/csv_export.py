@@ -0,0 +1,158 @@
+"""
+    Streams the matches collection as a gzip compressed csv, straight from a Mongo cursor,
+    so that memory and disk use don't depend on the size of the collection
+"""
+import csv
+import io
+import re
+import zlib
+from pymongo import ASCENDING
+
+
+# the roles of the match docs, as the crawler names them
+ROLES = ("TOP", "JUNGLE", "MID", "ADC", "SUPPORT")
+# the columns of the csv, dotted paths in the match docs as mongoexport names them
+CSV_FIELDS = ["_id", "region", "duration", "patch", "winner"] + [
+    field for team in ("team1", "team2") for field in
+    [f"{team}.teamId"] + [f"{team}.bans.{ban}" for ban in range(5)]
+    + [f"{team}.{role}.{attr}" for role in ROLES for attr in ("summonerId", "champion")]]
+# a projection like team1.bans.0 would look for a field named 0 in the bans, the whole list is fetched
+PROJECTION = {re.sub(r'[.]\d+$', '', field): 1 for field in CSV_FIELDS}
+PATCH = re.compile(r'^(\d+)[.](\d+)$')
+# docs fetched from Mongo per round trip
+EXPORT_BATCH_SIZE = 1000
+# the compressed rows are sent at least this often, so that the download starts at once and keeps going
+ROWS_PER_FLUSH = 1000
+# gzip header and trailer instead of the zlib ones
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def parse_patch(patch):
+    """
+    Returns:
+        tuple(int, int): the major and minor version of a patch like "11.20"
+
+    Raises:
+        ValueError: if the patch is not written as major.minor
+    """
+    match = PATCH.match(str(patch))
+    if match is None:
+        raise ValueError(f"{patch} is not a patch, like 11.20")
+    return int(match.group(1)), int(match.group(2))
+
+
+def export_query(patches, region=None, min_patch=None, max_patch=None, since=None):
+    """
+    Builds the filter of an export. Patches are strings, "11.9" comes after "11.10",
+    so the range is resolved against the patches actually stored.
+
+    Args:
+        patches (iterable(str)): the distinct patches of the matches collection
+        region (str, optional): only the matches of this region. Defaults to None.
+        min_patch (str, optional): only the matches of this patch or a later one. Defaults to None.
+        max_patch (str, optional): only the matches of this patch or an earlier one. Defaults to None.
+        since (str, optional): only the matches whose id comes after this one, the order of the export,
+                               to download just the rows following the last one received. Defaults to None.
+
+    Returns:
+        dict: the Mongo filter
+
+    Raises:
+        ValueError: if a patch bound is not a patch
+    """
+    query = {}
+    if region:
+        query['region'] = region.lower()
+    if min_patch or max_patch:
+        low = parse_patch(min_patch) if min_patch else (0, 0)
+        high = parse_patch(max_patch) if max_patch else (float('inf'), float('inf'))
+        query['patch'] = {'$in': sorted(patch for patch in patches
+                                        if PATCH.match(str(patch)) and low <= parse_patch(patch) <= high)}
+    if since:
+        query['_id'] = {'$gt': since}
+    return query
+
+
+def field_value(doc, path):
+    """
+    Returns:
+        the value at a dotted path of a doc, list indexes included, "" if it is missing like mongoexport does
+    """
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        elif isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return ""
+    return value
+
+
+def csv_chunks(docs, fields=CSV_FIELDS, rows_per_chunk=ROWS_PER_FLUSH, header=True):
+    """
+    Writes the docs as csv, a header first
+
+    Args:
+        docs (iterable(dict)): the docs, typically a cursor
+        fields (list(str), optional): the dotted paths of the columns. Defaults to CSV_FIELDS.
+        rows_per_chunk (int, optional): the rows of each chunk. Defaults to ROWS_PER_FLUSH.
+        header (bool, optional): whether to write the header, not when appending. Defaults to True.
+
+    Yields:
+        str: the header, then the rows in chunks of rows_per_chunk
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(fields)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    rows = 0
+    for doc in docs:
+        writer.writerow([field_value(doc, field) for field in fields])
+        rows += 1
+        if rows % rows_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_stream(chunks):
+    """
+    Compresses text chunks into a single gzip member, flushing after each one
+    so that every chunk can be decompressed as soon as it's received
+
+    Args:
+        chunks (iterable(str)): the text
+
+    Yields:
+        bytes: the compressed data
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def export_matches(collection, region=None, min_patch=None, max_patch=None, since=None):
+    """
+    Streams the matches matching the filters (see export_query) as a gzip compressed csv, ordered by id.
+    The filters are checked before anything is yielded.
+
+    Args:
+        collection (pymongo.collection.Collection): the matches
+
+    Returns:
+        generator(bytes): the compressed csv
+
+    Raises:
+        ValueError: if a patch bound is not a patch
+    """
+    patches = collection.distinct('patch') if min_patch or max_patch else []
+    query = export_query(patches, region, min_patch, max_patch, since)
+    cursor = collection.find(query, PROJECTION, sort=[('_id', ASCENDING)], batch_size=EXPORT_BATCH_SIZE)
+    return gzip_stream(csv_chunks(cursor))
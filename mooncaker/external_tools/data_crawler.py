@@ -2,18 +2,58 @@
     Crawls lol data with the APi and stores it in a database
 """
 
+import hashlib
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from functools import partial
-from logging import INFO, DEBUG, WARNING
+from logging import INFO, WARNING
+from threading import Event, Lock, Thread, local
 from riotwatcher import LolWatcher, ApiError
-from . import REGION2BIG_REGION
-from .db_interactor import Database
+from riotwatcher._apis import UrlConfig
+from pymongo.errors import PyMongoError
+from . import REGIONS, REGION2BIG_REGION
+from .crawl_pipeline import Pipeline, Stage, Marker
+from .db_interactor import Database, BulkWriter
+from .rate_limiter import HeaderRateLimiter
+from .raw_store import open_raw_store
+from .timeline_parser import TimelineDeserializer, role_frames
+from .cassette import CassetteRecorder, CassettePlayer, NoRateLimiter
+from .key_pool import KeyPool
+from .scheduler import RankTally
+from .metrics import metrics, METRICS_PUBLISH_EVERY
 from .logger import log as log_raw
 
 
 log = partial(log_raw, "datacrawler")
-# todo: add conccurent requests where possible to speed things up
+CLASH_QUEUE = 700
+MATCHLIST_PAGE_SIZE = 100  # the maximum allowed by riot
+# games end after they start, so the next matchlist starts this many seconds before the crawl
+WATERMARK_OVERLAP = 3 * 60 * 60
+ROLES = ["TOP", "JUNGLE", "MID", "ADC", "SUPPORT"]
+# match-v5 positions to our roles, the bot lane is split by farm afterwards
+POSITION2ROLE = {"TOP": "TOP", "JUNGLE": "JUNGLE", "MIDDLE": "MID", "BOTTOM": "BOT", "UTILITY": "BOT"}
+MIN_GAME_DURATION = 5 * 60  # shorter games are remakes
+ROLE_STATS_EVERY = 100
+CALL_LOG_EVERY = 100  # api calls logged, one in every
+PUUID_BATCH_SIZE = 10  # league entries resolved together
+PIPELINE_QUEUE_SIZE = 100
+QUEUE_DEPTH_SAMPLE_EVERY = 1  # seconds
+# returned by safe_api_call as result when riot answers with a 404
+NOT_FOUND = "NOT_FOUND"
+# returned by match_doc when the calls failed, unlike None for the invalid matches it's retried later
+FETCH_FAILED = "FETCH_FAILED"
+# how long a crawled rank waits before the daemon crawls it again
+REVISIT_EVERY = timedelta(days=1)
+# longest wait of the daemon between two passes, so that ranks released by other crawlers are picked up
+DAEMON_IDLE_POLL = 5 * 60
+# wait of the daemon after a failed pass, doubled after each failure in a row up to DAEMON_IDLE_POLL
+DAEMON_ERROR_BACKOFF = 10
+# attribute of the watcher -> name of the endpoint given to the rate limiter
+ENDPOINT_NAMES = {"league": "LeagueApiV4", "summoner": "SummonerApiV4", "match": "MatchApiV5"}
 
 
 class Crawler():
@@ -21,13 +61,177 @@ class Crawler():
     def __init__(self,
                  API_KEY,
                  get_key_blocking,
-                 db_url):
-
+                 db_url,
+                 concurrent=False,
+                 max_in_flight=4,
+                 reserved_budget=0.0,
+                 timeline_roles=False,
+                 raw_store=None,
+                 api_url=None,
+                 record=None,
+                 replay=None,
+                 poll_new_keys=None,
+                 revisit_every=REVISIT_EVERY):
+        """
+        Args:
+            API_KEY (str | list(str)): the riot api key(s) to start with
+            get_key_blocking (callable): called (and waited on) when every api key has been retired
+            db_url (str): the url of the Mongo DB, None to use a mock (testing only)
+            concurrent (bool, optional): if True every platform is crawled by its own worker and
+                                         the requests are spread over a pool of threads for each
+                                         platform (euw1, kr, ...) and routing value (europe, asia, ...).
+                                         Defaults to False.
+            max_in_flight (int, optional): how many requests can be in flight at the same time
+                                           towards a single platform or routing value when crawling
+                                           concurrently. Defaults to 4.
+            reserved_budget (float, optional): fraction of the rate limits of the key left to other
+                                               tools sharing it. Defaults to 0.0.
+            timeline_roles (bool, optional): if True the roles are always assigned from the timeline,
+                                             otherwise the timeline is requested only when the positions
+                                             in the match are missing or contradictory. Defaults to False.
+            raw_store (str, optional): where to keep the raw match and timeline payloads (a directory
+                                       or a mongodb:// url), so that the docs can be rebuilt offline.
+                                       Defaults to None, the payloads are not kept.
+            api_url (str, optional): the root of the api, with a {platform} placeholder, to crawl a stand-in
+                                     of riot (see benchmarks/fake_riot_api.py). Defaults to None, riot.
+            record (str, optional): a cassette file where every request and response is appended.
+                                    Defaults to None.
+            replay (str, optional): a cassette file whose responses are given back instead of calling
+                                    riot, without rate limits nor waits. Defaults to None.
+            poll_new_keys (callable, optional): returns the api keys added by the admins since the last call,
+                                                without waiting, to be added to the key pool. Defaults to None.
+            revisit_every (datetime.timedelta, optional): how long a crawled rank waits before run_daemon
+                                                          crawls it again. Defaults to a day.
+        """
         self.db = Database(db_url)
-        self.watcher = LolWatcher(API_KEY, default_match_v5=True)
-        self.get_new_key = get_key_blocking
+        self.writer = BulkWriter(self.db)
+        self.reserved_budget = reserved_budget
+        self.api_url = api_url
+        self.cassette = None
+        self.replaying = replay is not None
+        if self.replaying:
+            self.cassette = CassettePlayer(replay)
+        elif record is not None:
+            self.cassette = CassetteRecorder(record)
+        self.keys = KeyPool(self.make_watcher, get_key_blocking, poll_new_keys)
+        for api_key in ([API_KEY] if isinstance(API_KEY, str) else API_KEY):
+            self.keys.add(api_key)
+        self.concurrent = concurrent
+        self.max_in_flight = max_in_flight
+        self.pools = {}
+        self.pools_lock = Lock()
+        self.pool_thread = local()
+        self.rank_thread = local()  # the tally of the rank each thread is working on
+        self.timeline_roles = timeline_roles
+        self.role_sources = Counter()
+        self.role_sources_lock = Lock()
+        self.raw_store = open_raw_store(raw_store) if raw_store is not None else None
+        self.revisit_every = revisit_every
+        # waits after a 429, replaced to crawl without waiting
+        self.sleep = time.sleep
+        self.stopped = Event()
+
+    def make_watcher(self, api_key):
+        """
+        Creates the watcher for the given key, each key gets its own rate limiter
+        since riot counts the requests separately for each of them.
+        Timelines are returned undecoded, see timeline_parser.
+
+        Returns:
+            (LolWatcher, RateLimiter): the watcher and its rate limiter
+        """
+        rate_limiter = NoRateLimiter() if self.replaying else HeaderRateLimiter(self.reserved_budget)
+        watcher = LolWatcher(api_key,
+                             rate_limiter=rate_limiter,
+                             deserializer=TimelineDeserializer(),
+                             default_match_v5=True)
+        if self.api_url is not None:
+            # the watcher sets the root of the urls of every watcher, so it's replaced afterwards
+            UrlConfig.root_url = self.api_url
+        if self.cassette is not None:
+            # last in the chain, right before the network
+            watcher._base_api._request_handlers.append(self.cassette)
+        return watcher, rate_limiter
+
+    def pool(self, route):
+        """
+        Returns the thread pool that runs the requests directed to the given
+        platform or routing value, creating it on first use.
+        Riot enforces rate limits separately on each of them, so each gets its own workers.
+
+        Args:
+            route (str): a platform (euw1, kr, ...) or a routing value (europe, asia, ...)
+
+        Returns:
+            ThreadPoolExecutor: the pool for the route
+        """
+        with self.pools_lock:
+            if route not in self.pools:
+                self.pools[route] = ThreadPoolExecutor(max_workers=self.max_in_flight,
+                                                       thread_name_prefix=f"crawler-{route}",
+                                                       initializer=self.set_pool_route,
+                                                       initargs=(route,))
+            return self.pools[route]
+
+    def api_map(self, route, func, items):
+        """
+        Applies func to every item, running the calls on the pool of the route when crawling
+        concurrently and one after the other otherwise.
+
+        Args:
+            route (str): the platform or routing value the calls are directed to
+            func (callable): the function to apply, it should go through safe_api_call
+            items (iterable): the arguments to pass to func, one per call
+
+        Returns:
+            list: the results of func in the same order as items
+        """
+        # a worker of the pool waiting on the same pool could wait forever, so it makes the calls itself
+        if self.concurrent and getattr(self.pool_thread, 'route', None) != route:
+            return list(self.pool(route).map(self.with_tally(func), items))
+        return [func(item) for item in items]
+
+    def set_pool_route(self, route):
+        self.pool_thread.route = route
+
+    def with_tally(self, func):
+        """
+        Returns func made to count its calls in the tally of the rank the calling thread is working on,
+        from whichever thread it is run
+        """
+        tally = getattr(self.rank_thread, 'tally', None)
+
+        def counted(*args):
+            previous = getattr(self.rank_thread, 'tally', None)
+            self.rank_thread.tally = tally
+            try:
+                return func(*args)
+            finally:
+                self.rank_thread.tally = previous
+        return counted
+
+    def tally(self, name, amount=1):
+        tally = getattr(self.rank_thread, 'tally', None)
+        if tally is not None:
+            tally.add(name, amount)
 
-    def safe_api_call(self, attributes, args, retry_count=3):
+    def renew_key(self, stale_watcher):
+        """
+        Retires the key of the watcher that received a 403, the calls go on with the other keys
+        of the pool. Only when no key is left the crawl waits for a new one, and when several
+        workers find the pool empty at the same time only the first one asks for it.
+
+        Args:
+            stale_watcher (LolWatcher): the watcher that received the 403
+        """
+        if self.replaying:
+            # when replaying, the responses recorded after the new key come next anyway
+            return
+        self.keys.retire(stale_watcher)
+        if not len(self.keys):
+            self.keys.wait_for_key()
+
+    def safe_api_call(self, attributes, args, retry_count=3, kwargs=None):
         """calls the given command and checks for the successful outcome
         If the outcome is not successful, it intercepts the error and based on
         that will either retry (up to 3 times) or return unsuccessful status
@@ -38,46 +242,134 @@ class Crawler():
             redo_count (int, optional): used internally to count how many times
                                         the call has been retried.
                                         Defaults to 3.
+            kwargs (dict, optional): the keyword arguments to pass to the function. Defaults to None.
 
         Returns:
             (bool, Any | None): the outcome of the operation and the result, None if it was unsuccessful
+                                or NOT_FOUND if the resource does not exist (404 is not retried)
         """
-        log(INFO, f"Calling {attributes} with args: {args}")
+        log(INFO, "Calling %s with args: %s", attributes, args, every=CALL_LOG_EVERY)
         result = None
         call_is_successful = False
         if retry_count > 0:
             # redo call in case of errors up to x times
+            watcher = self.keys.watcher(args[0] if args else None,
+                                        ENDPOINT_NAMES.get(attributes[0], attributes[0]), attributes[-1])
+            labels = {'endpoint': ".".join(attributes), 'region': args[0] if args else ""}
+            self.tally('calls')
+            start = time.perf_counter()
             try:
-                command = getattr(self.watcher, attributes[0])
+                command = getattr(watcher, attributes[0])
                 for attribute in attributes[1:]:
                     command = getattr(command, attribute)
-                result = command(*args)
+                result = command(*args, **(kwargs or {}))
                 call_is_successful = True
+                self.count_api_call(labels, start, 200)
             except ApiError as err:
+                self.count_api_call(labels, start, err.response.status_code)
                 if err.response.status_code == 403:
                     log(WARNING, "Received a 403 status code, waiting new API")
-                    log(DEBUG, "Going to possibly hang while waiting new api key")
-                    new_key = self.get_new_key()
-                    self.watcher = LolWatcher(new_key, default_match_v5=True)
-                    log(DEBUG, f"Received new api key ending with {new_key[-5:]}")
+                    self.renew_key(watcher)
                 elif err.response.status_code == 404:
-                    log(WARNING, "Received a 404 status code with the following arguments: ")
-                    log(WARNING, f"{args}")
-                    log(WARNING, f"While calling {attributes}")
+                    log(WARNING, "Received a 404 status code with the arguments %s while calling %s", args, attributes)
+                    return False, NOT_FOUND
                 elif err.response.status_code == 429:
                     sleep_time = err.response.headers.get("Retry-After")
                     sleep_time = 60 * (4 - retry_count) if sleep_time is None else int(sleep_time)
-                    log(WARNING, f"Received a 429 status code, too many same type requests, sleeping for {sleep_time}")
-                    log(WARNING, f"The request was: {attributes}")
-                    time.sleep(sleep_time)
+                    log(WARNING, "Received a 429 status code calling %s, too many same type requests, sleeping for %s",
+                        attributes, sleep_time)
+                    if not self.replaying:
+                        self.sleep(sleep_time)
+                        metrics.inc("mooncaker_api_429_sleep_seconds_total", sleep_time, **labels)
                 else:
-                    log(WARNING, f"Received a {err.response.status_code} status code with the following arguments:")
-                    log(WARNING, f"{args}")
-                    log(WARNING, f"While calling {attributes}")
+                    log(WARNING, "Received a %d status code with the arguments %s while calling %s",
+                        err.response.status_code, args, attributes)
             if not call_is_successful:
-                return self.safe_api_call(attributes, args, retry_count - 1)
+                metrics.inc("mooncaker_api_retries_total", **labels)
+                return self.safe_api_call(attributes, args, retry_count - 1, kwargs)
         return call_is_successful, result
 
+    @staticmethod
+    def count_api_call(labels, start, status):
+        # the latency is taken before any 429 sleep, the rate limiter waits are part of it
+        metrics.observe("mooncaker_api_request_seconds", time.perf_counter() - start, **labels)
+        metrics.inc("mooncaker_api_requests_total", status=str(status), **labels)
+
+    @staticmethod
+    def page_fingerprint(entries):
+        """
+        Returns what identifies the state of a page of league entries: who is in it and how many
+        ranked games each one played. While it doesn't change nobody moved in or out of the page
+        and no ranked games were played by the page's players since the last pass. Wins and losses
+        don't count clash (queue 700) or other unranked games, so the clash games played meanwhile
+        are missed: such pages are skipped on purpose, since a page asks one match list per player.
+
+        Args:
+            entries (list(dict)): the league entries of the page
+
+        Returns:
+            str: the fingerprint of the page
+        """
+        players = sorted(f"{entry.get('summonerId', entry.get('puuid'))}:{entry.get('wins')}:{entry.get('losses')}"
+                         for entry in entries)
+        return hashlib.sha1("\n".join(players).encode()).hexdigest()
+
+    @staticmethod
+    def summoner_key(entry):
+        """
+        Returns the key under which a summoner is cached: its summoner id when known,
+        since it never changes, otherwise its name normalized as riot does
+
+        Args:
+            entry (dict): a league entry or any dict with either summonerId or summonerName
+        """
+        if entry.get('summonerId'):
+            return f"id:{entry['summonerId']}"
+        return "name:" + entry['summonerName'].replace(" ", "").lower()
+
+    def puuids_by_entries(self, region, entries):
+        """
+            Fetch PUUIDs for each league entry and returns them as a list.
+            The PUUID in the entry is used if present, otherwise it is looked up in the
+            cache of resolved summoners and only the unknown summoners are requested to riot,
+            by summoner id if available and by name otherwise.
+
+            Parameters:
+            region(String): the server region to which the accounts belong
+            entries(List[Dict]): league entries, with at least one of puuid, summonerId, summonerName
+
+            Returns:
+            List[String]: list of PUUIDs associated to the entries,
+                          containing None if no PUUID was found for the entry
+        """
+        keys = [None if entry.get('puuid') else Crawler.summoner_key(entry) for entry in entries]
+        known = self.db.cached_puuids(region, list(filter(None, keys)))
+        unknown = [entry for entry, key in zip(entries, keys) if key is not None and key not in known]
+
+        def resolve(entry):
+            if entry.get('summonerId'):
+                is_successful, user = self.safe_api_call(["summoner", "by_id"],
+                                                         (region, entry['summonerId']))
+            else:
+                is_successful, user = self.safe_api_call(["summoner", "by_name"],
+                                                         (region, entry['summonerName']))
+            if is_successful:
+                return user.get('puuid')
+            return NOT_FOUND if user == NOT_FOUND else None
+
+        resolved = {}
+        for entry, puuid in zip(unknown, self.api_map(region, resolve, unknown)):
+            key = Crawler.summoner_key(entry)
+            if puuid == NOT_FOUND:
+                # remember it so that it's not asked again
+                resolved[key] = None
+            elif puuid is not None:
+                resolved[key] = puuid
+        self.db.cache_puuids(region, resolved)
+        known.update(resolved)
+        return [entry['puuid'] if key is None else known.get(key)
+                for entry, key in zip(entries, keys)]
+
     def puuids_by_name(self, region, summoner_names):
         """
             Fetch PUUIDs for each summoner name and returns them as a list
@@ -90,16 +382,7 @@ class Crawler():
             List[String]: list of PUUIDs associated to input summoner names,
                           containing None if no PUUID was found for the summoner name
         """
-        ids = []
-        for name in summoner_names:
-            # todo: check when 404 maybe name has changed
-            is_successful, user = self.safe_api_call(["summoner", "by_name"],
-                                                     (region, name))
-            if is_successful:
-                ids.append(user.get('puuid'))
-            else:
-                ids.append(None)
-        return ids
+        return self.puuids_by_entries(region, [{'summonerName': name} for name in summoner_names])
 
     def clash_matches(self, region, names):
         """
@@ -115,27 +398,86 @@ class Crawler():
         """
         # retrieve accounts puuids
         puuids = self.puuids_by_name(region, names)
+        return self.clash_matches_by_puuid(region, puuids)
+
+    def clash_matches_by_puuid(self, region, puuids, journal=None):
+        """
+        Gets the match list of the given players and returns only their new clash matches.
+        For each player only the matches played since the last crawl (its watermark) are
+        requested, paging through the whole history the first time the player is crawled.
+
+        Args:
+            region (str): the server region to which the accounts belong (euw1, eune1, ...)
+            puuids (list(str)): list of PUUIDs to crawl, None values are skipped
+            journal (tuple, optional): the _id of the rank and the page being crawled, if given
+                                       the players and their new matches are written to the crawl
+                                       journal before moving the watermarks. Defaults to None.
+
+        Returns:
+            list(str): list of strings with the clash match ids as string
+        """
         puuids = list(filter(None, puuids))
         match_list = []
         big_region = REGION2BIG_REGION[region]
-        for puuid in puuids:
-            is_successful, matches = self.safe_api_call(['match', "matchlist_by_puuid"],
-                                                        (big_region,
-                                                         puuid,
-                                                         700,
-                                                         None,
-                                                         0,
-                                                         100))
-            if is_successful:
-                for match in matches:
-                    match_list.append(match)
+        watermarks = self.db.get_watermarks(puuids)
+        new_watermarks = {}
+
+        for puuid, (matches, watermark) in zip(puuids,
+                                               self.api_map(big_region,
+                                                            partial(self.matchlist, big_region, watermarks=watermarks),
+                                                            puuids)):
+            match_list.extend(matches)
+            if watermark is not None:
+                new_watermarks[puuid] = watermark
 
         match_list = list(filter(None, match_list))  # todo: might not be needed anymore
-        return self.db.filter_match_duplicates(match_list)
+        self.tally('listed', len(match_list))
+        match_list = self.db.filter_match_duplicates(match_list)
+        self.tally('new', len(match_list))
+        if journal is not None:
+            self.db.journal_listed(*journal, list(new_watermarks), match_list)
+        self.db.set_watermarks(new_watermarks)
+        return match_list
 
-    def summoner_names(self, region, tier, division, page, mode='RANKED_SOLO_5x5'):
+    def matchlist(self, big_region, puuid, watermarks):
         """
-            Fetch all the summoner names in a tier and division
+        Pages through the clash match list of a player, stopping at its watermark
+
+        Args:
+            big_region (str): the routing value of the player (europe, asia, ...)
+            puuid (str): the PUUID of the player
+            watermarks (dict): puuid -> watermark as returned by Database.get_watermarks
+
+        Returns:
+            (list(str), dict | None): the new match ids, newest first, and the watermark to store
+                                      for the player, None if the match list could not be completed
+        """
+        watermark = watermarks.get(puuid, {})
+        crawl_time = int(time.time())
+        matches = []
+        start = 0
+        while True:
+            is_successful, page = self.safe_api_call(['match', 'matchlist_by_puuid'],
+                                                     (big_region, puuid),
+                                                     kwargs={'queue': CLASH_QUEUE,
+                                                             'start': start,
+                                                             'count': MATCHLIST_PAGE_SIZE,
+                                                             'start_time': watermark.get('time')})
+            if not is_successful:
+                return matches, None
+            if watermark.get('match') in page:
+                matches.extend(page[:page.index(watermark['match'])])
+                break
+            matches.extend(page)
+            if len(page) < MATCHLIST_PAGE_SIZE:
+                break
+            start += MATCHLIST_PAGE_SIZE
+        return matches, {'time': crawl_time - WATERMARK_OVERLAP,
+                         'match': matches[0] if matches else watermark.get('match')}
+
+    def summoner_entries(self, region, tier, division, page, mode='RANKED_SOLO_5x5'):
+        """
+            Fetch all the league entries of a page of a tier and division
 
             Parameters:
             region(String): a server region
@@ -144,7 +486,8 @@ class Crawler():
             division(String): division of the queue
 
             Returns:
-                List(str): list of players' summoner name or None if call is unsuccessful
+                List(dict): list of players' league entries which can be resolved to a PUUID,
+                            None if call is unsuccessful
         """
         is_successful, players_list = self.safe_api_call(['league', 'entries'],
                                                          (region,
@@ -153,7 +496,28 @@ class Crawler():
                                                           division,
                                                           page))
         if is_successful:
-            names = [summoner.get('summonerName') for summoner in players_list]
+            return [summoner for summoner in players_list
+                    if summoner.get('puuid')
+                    or summoner.get('summonerId')
+                    or (summoner.get('summonerName') or '').strip()]
+        return None
+
+    def summoner_names(self, region, tier, division, page, mode='RANKED_SOLO_5x5'):
+        """
+            Fetch all the summoner names in a tier and division
+
+            Parameters:
+            region(String): a server region
+            mode(String): type of queue
+            tier(String): tier of the queue
+            division(String): division of the queue
+
+            Returns:
+                List(str): list of players' summoner name or None if call is unsuccessful
+        """
+        entries = self.summoner_entries(region, tier, division, page, mode)
+        if entries is not None:
+            names = [summoner.get('summonerName') or '' for summoner in entries]
             return list(filter(lambda x: bool(x.strip()), names))  # filter empty names
         return None
 
@@ -201,88 +565,472 @@ class Crawler():
                               for each <role> in ADC, SUPPORT, MID, JUNGLE, TOP
         """
         big_region = REGION2BIG_REGION[region]
-        match_docs = []
-        for g_id in match_list:
+        match_docs = self.api_map(big_region, partial(self.match_doc, region=region), match_list)
+        return [doc for doc in match_docs if doc is not None and doc != FETCH_FAILED]
 
-            # get match by id
-            is_successful, match = self.safe_api_call(['match', 'by_id'],
-                                                      (big_region,
-                                                       g_id))
-            if not is_successful:
-                continue  # unlucky
+    def match_doc(self, g_id, region):
+        """
+            Fetch the details of a single match and build its doc.
+            Roles are taken from the positions in the match data, the timeline is requested
+            only when they are missing or contradictory (or always if timeline_roles is set).
+
+        Parameters:
+            g_id(str): the clash game id
+            region(String): a server region
 
+        Returns:
+            dict: the doc of the match (see match_details), None if the match is invalid or doesn't exist,
+                  FETCH_FAILED if the calls are unsuccessful
+        """
+        big_region = REGION2BIG_REGION[region]
+
+        # get match by id
+        is_successful, match = self.safe_api_call(['match', 'by_id'],
+                                                  (big_region,
+                                                   g_id))
+        if not is_successful:
+            return None if match == NOT_FOUND else FETCH_FAILED  # unlucky
+        self.store_raw(g_id, "match", match)
+        if not Crawler.is_valid_match(match['info']):
+            self.count_role_source("rejected")
+            return None
+
+        roles = None
+        if not self.timeline_roles:
+            roles = Crawler.roles_from_participants(match['info']["participants"])
+        if roles is not None:
+            self.count_role_source("participants")
+        else:
             # get timeline to enstablish roles
             is_successful, timeline = self.safe_api_call(['match', 'timeline_by_match'],
                                                          (big_region,
                                                           g_id))
             if not is_successful:
-                continue  # unlucky part2
-
-            m2_frame = timeline['info']['frames'][2]['participantFrames']
-            m_last_frame = timeline['info']['frames'][-1]['participantFrames']
-            m2_pos = {int(num): m2_frame[num]['position'] for num in m2_frame.keys()}
-            new_doc = {"_id": g_id, "region": region, "duration": match['info']["gameDuration"],
-                       "patch": re.search(r'^\d+[.]\d+', match['info']["gameVersion"]).group()}
-            teams = [team["teamId"] for team in match['info']["teams"]]
-            new_doc["winner"] = teams[0] if match['info']["teams"][0]["win"] is True else teams[1]
-            i = 0
-            bans = [[], []]
-            for team in match['info']["teams"]:
-                for ban in team["bans"]:
-                    bans[i].append(ban["championId"])
-                i += 1
-            teams = ({"teamId": teams[0], "bans": bans[0]}, {"teamId": teams[1], "bans": bans[0]})
-            identities = {part["participantId"]: part["puuid"] for part in
-                          match['info']["participants"]}
-            bot = [[], []]
-            for player in match['info']["participants"]:
-                team = 0 if player["teamId"] == teams[0]["teamId"] else 1
-                role = Crawler.get_role(m2_pos[player["participantId"]], player)
-                champion = player["championId"]
-                sum_id = identities[player["participantId"]]
-                if role != "BOT":
-                    teams[team][role] = {"summonerId": sum_id, "champion": champion}
+                return None if timeline == NOT_FOUND else FETCH_FAILED  # unlucky part2
+            self.store_raw(g_id, "timeline", timeline)
+            self.count_role_source("timeline")
+            roles = Crawler.roles_from_timeline(match['info']["participants"], timeline)
+            if roles is None:
+                return None
+        return Crawler.build_match_doc(g_id, region, match['info'], roles)
+
+    def store_raw(self, g_id, kind, payload):
+        """
+        Keeps the payload in the raw store, if any. A failing store is logged
+        and doesn't stop the crawling, the doc is built anyway.
+        """
+        if self.raw_store is None:
+            return
+        try:
+            self.raw_store.put(g_id, kind, payload)
+        except Exception as err:
+            log(WARNING, "Could not store the raw %s of %s: %s", kind, g_id, err)
+
+    def count_role_source(self, source):
+        """
+        Keeps track of how the roles of the matches are assigned, logging how often
+        the timeline is needed every ROLE_STATS_EVERY matches
+        """
+        with self.role_sources_lock:
+            self.role_sources[source] += 1
+            total = sum(self.role_sources.values())
+            stats = dict(self.role_sources)
+        if total % ROLE_STATS_EVERY == 0:
+            log(INFO, "Roles assigned from participants: %d, from timeline: %d (%.1f%% fallback), "
+                      "rejected before timeline: %d",
+                stats.get('participants', 0), stats.get('timeline', 0),
+                100 * stats.get('timeline', 0) / total, stats.get('rejected', 0))
+
+    @staticmethod
+    def is_valid_match(info):
+        """
+        Checks that the match has two full teams and it's not a remake,
+        so that no timeline is requested for games that would be discarded
+
+        Args:
+            info (dict): the info of a match-v5 match
+        """
+        if len(info.get("participants", [])) != 10 or len(info.get("teams", [])) != 2:
+            return False
+        if any(player.get("gameEndedInEarlySurrender") for player in info["participants"]):
+            return False
+        duration = info["gameDuration"]
+        if "gameEndTimestamp" not in info:
+            duration //= 1000  # before patch 11.20 the duration was in milliseconds
+        return duration >= MIN_GAME_DURATION
+
+    @staticmethod
+    def roles_from_participants(participants):
+        """
+        Assigns the roles from the positions riot computes for each participant, trying
+        teamPosition first and individualPosition then. As for the timeline, the bot lane
+        is split in ADC and SUPPORT by farm, so that both ways give the same roles.
+
+        Args:
+            participants (list(dict)): the participants of a match-v5 match
+
+        Returns:
+            dict: participantId -> role (TOP, JUNGLE, MID, ADC, SUPPORT), None if the positions
+                  are missing or contradictory
+        """
+        roles = {}
+        for team_id in {player["teamId"] for player in participants}:
+            team = [player for player in participants if player["teamId"] == team_id]
+            for field in ("teamPosition", "individualPosition"):
+                positions = [POSITION2ROLE.get(player.get(field)) for player in team]
+                if sorted(positions, key=str) == ["BOT", "BOT", "JUNGLE", "MID", "TOP"]:
+                    break
+            else:
+                return None
+            bot = []
+            for player, role in zip(team, positions):
+                if role == "JUNGLE" and not Crawler.is_jungler(player):
+                    return None  # no smite, riot got it wrong
+                if role == "BOT":
+                    if "totalMinionsKilled" not in player:
+                        return None
+                    # summonerId holds the participant id so that it can be mapped back
+                    bot.append({"summonerId": player["participantId"],
+                                "champion": player["championId"],
+                                "id": player["participantId"]})
                 else:
-                    bot[team].append({"summonerId": sum_id,
-                                      "champion": champion,
-                                      "id": player["participantId"]})
-            if len(bot[0]) == 2 and len(bot[1]) == 2 and len(teams[0]) == 5 and len(teams[1]) == 5:
-                for team in range(2):
-                    bot_roles = Crawler.check_bot_roles(bot[team], m_last_frame)
-                    teams[team]["SUPPORT"] = bot_roles["SUPPORT"]
-                    teams[team]["ADC"] = bot_roles["ADC"]
-                new_doc["team1"] = teams[0]
-                new_doc["team2"] = teams[1]
-                match_docs.append(new_doc)
-        return match_docs
+                    roles[player["participantId"]] = role
+            farm = {str(player["participantId"]): {"minionsKilled": player.get("totalMinionsKilled")}
+                    for player in team}
+            for role, player in Crawler.check_bot_roles(bot, farm).items():
+                roles[player["summonerId"]] = role
+        return roles
 
-    def start_crawling(self):
-        for id, region, tier, division, page in self.db.ranks2crawl():
-            is_last_page = False
-            while not is_last_page:
-                log(INFO, f"Crawling {region}, {tier}, {division}, {page}")
-                names = self.summoner_names(region, tier, division, page)
-                if names is None:
+    @staticmethod
+    def roles_from_timeline(participants, timeline):
+        """
+        Assigns the roles from the positions at the second minute and the farm at the end of the game
+
+        Args:
+            participants (list(dict)): the participants of a match-v5 match
+            timeline (RawTimeline | dict): the timeline of the match, decoded or not
+
+        Returns:
+            dict: participantId -> role (TOP, JUNGLE, MID, ADC, SUPPORT), None if the bot lanes
+                  are not made of two players
+        """
+        m2_frame, m_last_frame = role_frames(timeline)
+        m2_pos = {int(num): m2_frame[num]['position'] for num in m2_frame.keys()}
+        roles = {}
+        bot = {}
+        for player in participants:
+            role = Crawler.get_role(m2_pos[player["participantId"]], player)
+            if role != "BOT":
+                roles[player["participantId"]] = role
+            else:
+                # summonerId holds the participant id so that it can be mapped back
+                bot.setdefault(player["teamId"], []).append({"summonerId": player["participantId"],
+                                                             "champion": player["championId"],
+                                                             "id": player["participantId"]})
+        if len(bot) != 2 or any(len(botlane) != 2 for botlane in bot.values()):
+            return None
+        for botlane in bot.values():
+            for role, player in Crawler.check_bot_roles(botlane, m_last_frame).items():
+                roles[player["summonerId"]] = role
+        return roles
+
+    @staticmethod
+    def build_match_doc(g_id, region, info, roles):
+        """
+        Builds the doc of a match (see match_details)
+
+        Args:
+            g_id (str): the match id
+            region (str): a server region
+            info (dict): the info of a match-v5 match
+            roles (dict): participantId -> role
+
+        Returns:
+            dict: the doc, None if a team does not have exactly one player for each role
+        """
+        new_doc = {"_id": g_id, "region": region, "duration": info["gameDuration"],
+                   "patch": re.search(r'^\d+[.]\d+', info["gameVersion"]).group()}
+        teams = [team["teamId"] for team in info["teams"]]
+        new_doc["winner"] = teams[0] if info["teams"][0]["win"] is True else teams[1]
+        teams = tuple({"teamId": team["teamId"], "bans": [ban["championId"] for ban in team["bans"]]}
+                      for team in info["teams"])
+        team_by_id = {team["teamId"]: team for team in teams}
+        for player in info["participants"]:
+            role = roles.get(player["participantId"])
+            if role is None:
+                return None
+            team_by_id[player["teamId"]][role] = {"summonerId": player["puuid"],
+                                                  "champion": player["championId"]}
+        if any(len(team) != 2 + len(ROLES) for team in teams):
+            return None  # some role was assigned twice
+        new_doc["team1"] = teams[0]
+        new_doc["team2"] = teams[1]
+        return new_doc
+
+    def crawl_ranks(self, ranks):
+        """
+        Crawls the given ranks one after the other, page by page,
+        recording what each crawl cost and gave to schedule the next cycles.
+        A rank whose crawl raises is released and the next one is crawled.
+
+        Args:
+            ranks (iterable(tuple)): tuples with the _id, region, tier, division and page to crawl
+
+        Returns:
+            int: the number of ranks crawled up to their last page
+        """
+        finished_ranks = 0
+        for id, region, tier, division, page in ranks:
+            tally = self.rank_thread.tally = RankTally()
+            try:
+                finished = self.crawl_rank(id, region, tier, division, page)
+            except Exception as err:
+                # given back, another worker or the next pass crawls it again from its journal
+                log(WARNING, "Crawl of %s, %s, %s failed, rank released: %r", region, tier, division, err)
+                self.db.release_rank(id)
+            else:
+                if finished:
+                    self.db.mark_as_crawled(id, datetime.utcnow() + self.revisit_every)
+                    finished_ranks += 1
+                else:
+                    self.db.release_rank(id)
+                stats = self.db.record_yield(id, region, tier, division, tally.totals())
+                log(INFO, "%s, %s, %s: %s, %.3f expected docs per call, %.0f%% duplicates",
+                    region, tier, division, tally.totals(), stats['yield'], 100 * stats['duplicate_ratio'])
+            finally:
+                self.rank_thread.tally = None
+            if self.stopped.is_set():
+                # the next rank is claimed only when asked for, nothing is left leased
+                break
+        return finished_ranks
+
+    def stage_pool(self, route):
+        return self.pool(route) if self.concurrent else None
+
+    def crawl_rank(self, id, region, tier, division, page):
+        """
+        Crawls a rank starting from the given page, streaming the summoners of each page
+        through the stages league entries -> puuids -> new clash match ids -> match docs,
+        while the docs are handed to the bulk writer as they come.
+        The players listed and the matches found and done are recorded in the crawl journal,
+        so that after a restart only the matches that were in flight are requested again.
+        The matches whose calls failed are requested again at the start of the next crawl of the rank.
+
+        Args:
+            id (Any): the _id of the rank in the ReDiTi collection
+            region (str): the server region (euw1, kr, ...)
+            tier (str): the tier to crawl
+            division (str): the division to crawl
+            page (int): the first page to crawl
+
+        Returns:
+            bool: True if the last page of the rank was reached
+        """
+        big_region = REGION2BIG_REGION[region]
+        outcome = {'last_page': False}
+
+        rank_tally = getattr(self.rank_thread, 'tally', None)
+        known_fingerprints = self.db.page_fingerprints(id)
+        fingerprints = {}
+
+        def entries_batches():
+            # the body runs in the thread of the pipeline source
+            self.rank_thread.tally = rank_tally
+            current_page = page
+            while True:
+                log(INFO, "Crawling %s, %s, %s, %s", region, tier, division, current_page)
+                entries = self.summoner_entries(region, tier, division, current_page)
+                if entries is None:
                     # call is unsuccessful
-                    log(WARNING, f"Call to look up summoner names for {region}, {tier}, {division}, {page} was unsuccessful")
-                    break
-                elif len(names) == 0:
+                    log(WARNING, "Call to look up summoner names for %s, %s, %s, %s was unsuccessful",
+                        region, tier, division, current_page)
+                    return
+                if len(entries) == 0:
                     # No names on that page
-                    log(INFO, f"Crawled last page for {region}, {tier}, {division}, {page}")
-                    is_last_page = True
+                    log(INFO, "Crawled last page for %s, %s, %s, %s", region, tier, division, current_page)
+                    outcome['last_page'] = True
+                    return
+                fingerprints[current_page] = Crawler.page_fingerprint(entries)
+                if known_fingerprints.get(str(current_page)) == fingerprints[current_page]:
+                    log(INFO, "Skipping %s, %s, %s, %s, nobody moved nor played", region, tier, division, current_page)
                 else:
-                    page += 1
-
-                    # retrieve matches by batches of summoner names
-                    batch_size = 100
-                    for index in range(0, len(names), batch_size):
-                        batch_names = names[index: min(index+batch_size, len(names))]
-                        match_list = self.clash_matches(region,
-                                                        batch_names)
-                        match_docs = self.match_details(match_list, region)
-                        if match_docs:
-                            self.db.insert_match_page(id, match_docs, page)
-            if is_last_page:
-                self.db.mark_as_crawled(id)
-        log(INFO, 'Finished crawling, resetting rediti and starting again')
-        self.db.reset_rediti()
+                    for index in range(0, len(entries), PUUID_BATCH_SIZE):
+                        yield current_page, entries[index: index + PUUID_BATCH_SIZE]
+                current_page += 1
+                yield Marker(current_page)
+
+        # resume what was left in flight by a previous run
+        journal = self.db.get_journal(id)
+        in_flight = [(journal_page, g_id)
+                     for journal_page, entry in journal.items()
+                     for g_id in entry['pending'] if g_id not in entry['done']]
+        if in_flight:
+            log(INFO, "Resuming %d matches of %s, %s, %s from the journal", len(in_flight), region, tier, division)
+        # the pages of the failed matches may be checkpointed since, they are marked done on the first one
+        failed = self.db.get_retries(id)
+        if failed:
+            log(INFO, "Retrying %d matches of %s, %s, %s", len(failed), region, tier, division)
+        in_flight.extend((page, g_id) for g_id in failed)
+        sent = set()
+
+        def puuids(item):
+            batch_page, entries = item
+            listed = journal.get(batch_page, {}).get('listed', ())
+            return [(batch_page, puuid) for puuid in self.puuids_by_entries(region, entries)
+                    if puuid is not None and puuid not in listed]
+
+        def matchlist(item):
+            batch_page, puuid = item
+            return [(batch_page, g_id) for g_id in self.clash_matches_by_puuid(region, [puuid],
+                                                                               journal=(id, batch_page))]
+
+        def unique(item):
+            # two players of the rank might have played the same match
+            if item[1] not in sent:
+                sent.add(item[1])
+                yield item
+
+        def match(item):
+            return [(*item, self.match_doc(item[1], region))]
+
+        self.write(id, region, Pipeline(in_flight,
+                                        [Stage("unique", unique),
+                                         Stage("matches", self.with_tally(match), self.stage_pool(big_region))],
+                                        maxsize=PIPELINE_QUEUE_SIZE))
+        self.write(id, region, Pipeline(entries_batches(),
+                                        [Stage("puuids", self.with_tally(puuids)),
+                                         Stage("matchlists", self.with_tally(matchlist), self.stage_pool(big_region)),
+                                         Stage("unique", unique),
+                                         Stage("matches", self.with_tally(match), self.stage_pool(big_region))],
+                                        maxsize=PIPELINE_QUEUE_SIZE),
+                   fingerprints)
+        self.writer.flush()
+        return outcome['last_page']
+
+    def write(self, id, region, pipeline, fingerprints=None):
+        """
+        Hands the docs coming out of the pipeline to the bulk writer, marking the matches
+        as done in the journal, and checkpoints the pages as their markers come out.
+        The depths of the queues of the pipeline are sampled on the way.
+
+        Args:
+            id (Any): the _id of the rank in the ReDiTi collection
+            region (str): the server region of the rank
+            pipeline (Pipeline): a pipeline yielding (page, match id, doc, None or FETCH_FAILED) and page markers
+            fingerprints (dict, optional): page -> fingerprint of its league entries, checkpointed
+                                           with the page. Defaults to None.
+        """
+        sampled_at = 0
+        for item in pipeline:
+            if time.monotonic() - sampled_at > QUEUE_DEPTH_SAMPLE_EVERY:
+                sampled_at = time.monotonic()
+                for stage, depth in pipeline.depths().items():
+                    metrics.set("mooncaker_pipeline_queue_depth", depth, stage=stage, region=region)
+            if isinstance(item, Marker):
+                # every doc of the page is in, the page is done
+                self.writer.checkpoint(id, item.value, (fingerprints or {}).get(item.value - 1))
+            else:
+                page, g_id, doc = item
+                if doc == FETCH_FAILED:
+                    # the watermarks are past the match, it's kept to be retried instead of marked done
+                    self.writer.add([], failed=[(id, g_id)])
+                    continue
+                if doc is not None:
+                    self.tally('docs')
+                self.writer.add([doc] if doc is not None else [], done=[(id, page, g_id)])
+
+    def publish_metrics(self, stopped):
+        """
+        Publishes the metrics of this process every METRICS_PUBLISH_EVERY seconds until stopped
+        """
+        while not stopped.wait(METRICS_PUBLISH_EVERY):
+            self.try_publish_metrics()
+
+    def try_publish_metrics(self):
+        try:
+            self.db.publish_metrics()
+        except PyMongoError as err:
+            log(WARNING, "Could not publish the metrics: %s", err)
+
+    @contextmanager
+    def publishing_metrics(self):
+        stopped = Event()
+        publisher = Thread(target=self.publish_metrics, args=(stopped,), name="metrics-publisher", daemon=True)
+        publisher.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            publisher.join()
+            self.try_publish_metrics()
+
+    def start_crawling(self):
+        """
+        Crawls once every rank left to crawl
+        """
+        with self.publishing_metrics():
+            try:
+                self.crawl()
+            finally:
+                self.db.stop_heartbeat()
+
+    def run_daemon(self):
+        """
+        Keeps crawling until stop is called: every crawled rank is crawled again once it's due,
+        as set by revisit_every, starting from its first page but keeping its statistics and
+        the fingerprints of its pages, so that the pages where nothing changed are skipped.
+        Between two passes it waits for the next rank due, or for DAEMON_IDLE_POLL at most.
+        A pass that raises is logged and followed by a longer and longer wait, the daemon keeps going.
+        """
+        log(INFO, "Crawl daemon started, revisiting the ranks every %s", self.revisit_every)
+        backoff = DAEMON_ERROR_BACKOFF
+        with self.publishing_metrics():
+            while not self.stopped.is_set():
+                try:
+                    self.db.prepare_crawl()
+                    self.db.reopen_due_ranks(self.revisit_every)
+                    crawled = self.crawl()
+                except Exception as err:
+                    log(WARNING, "Crawl pass failed, retrying in %ds: %r", backoff, err)
+                    self.stopped.wait(backoff)
+                    backoff = min(2 * backoff, DAEMON_IDLE_POLL)
+                    continue
+                backoff = DAEMON_ERROR_BACKOFF
+                if crawled:
+                    continue
+                # nothing finished, either nothing is due or every rank is failing
+                next_visit = self.db.next_visit()
+                wait = DAEMON_IDLE_POLL if next_visit is None else (next_visit - datetime.utcnow()).total_seconds()
+                self.stopped.wait(min(max(wait, 1), DAEMON_IDLE_POLL))
+        self.db.stop_heartbeat()
+        log(INFO, "Crawl daemon stopped")
+
+    def stop(self):
+        """
+        Makes run_daemon return once the ranks being crawled are done
+        """
+        self.stopped.set()
+
+    def crawl(self):
+        """
+        Crawls the ranks left to crawl, leaving the crawled ones to be reopened when due
+
+        Returns:
+            int: the number of ranks crawled up to their last page
+        """
+        self.db.prepare_crawl()
+        if self.concurrent:
+            # one worker per platform, they share the pools of the routing values
+            with ThreadPoolExecutor(max_workers=len(REGIONS),
+                                    thread_name_prefix="crawler-worker") as workers:
+                futures = [workers.submit(self.crawl_ranks, self.db.ranks2crawl(region)) for region in REGIONS]
+                finished = sum(future.result() for future in futures)
+        else:
+            finished = self.crawl_ranks(self.db.ranks2crawl())
+        self.writer.flush()
+        stats = self.writer.stats()
+        log(INFO, "Stored %d matches (%d duplicates) in %d flushes, %.1f docs per flush, "
+                  "%.3fs average flush, %.3fs max",
+            stats['written'], stats['duplicates'], stats['flushes'], stats['avg_batch'],
+            stats['avg_latency'], stats['max_latency'])
+        return finished
@@ -0,0 +1,417 @@
+"""
+    Writes the matches collection as a columnar dataset of typed .npy files, partitioned by patch and region,
+    that numpy memory-maps instead of parsing. Every export appends a new part to the partitions
+    with matches stored since the previous one. The partitions whose matches were rebuilt by reprocess,
+    deleted or committed after the previous export are written again as a single part.
+
+    Usage: python -m mooncaker.external_tools.dataset_export <directory> <db url> [--rebuild]
+"""
+import argparse
+import ast
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import partial
+from logging import INFO
+from pymongo import ASCENDING
+from .csv_export import ROLES, field_value
+from .db_interactor import Database
+from .logger import log as log_raw
+
+
+log = partial(log_raw, "dataset_export")
+MANIFEST = "manifest.json"
+# the puuid of every player code, in code order
+PLAYERS = "players.npy"
+PUUID_LENGTH = 78
+# matches stored this recently are left to the next export, their write may still be in flight
+EXPORT_SETTLE = timedelta(minutes=1)
+# rows buffered for each column before being written
+DATASET_BATCH_SIZE = 10000
+# missing bans, champions and players
+NO_VALUE = -1
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+# the header always takes this many bytes, so that the shape can be rewritten in place once the rows are counted
+NPY_HEADER_SIZE = 128
+ENDIAN = "<" if sys.byteorder == "little" else ">"
+# array typecode -> numpy type
+NPY_TYPES = {"q": "i8", "i": "i4", "h": "i2"}
+
+
+def team_columns(team):
+    columns = [(f"{team}_id", f"{team}.teamId", "h")]
+    columns += [(f"{team}_ban{ban}", f"{team}.bans.{ban}", "h") for ban in range(5)]
+    for role in ROLES:
+        columns.append((f"{team}_{role.lower()}_champion", f"{team}.{role}.champion", "h"))
+        # the code of the puuid in PLAYERS
+        columns.append((f"{team}_{role.lower()}_player", f"{team}.{role}.summonerId", "i"))
+    return columns
+
+
+# name, dotted path in the match docs and array typecode of every column,
+# the platform of the match id is the region of the partition
+COLUMNS = ([("game_id", "_id", "q"), ("duration", "duration", "i"), ("winner", "winner", "h")]
+           + team_columns("team1") + team_columns("team2"))
+PROJECTION = {path.split(".")[0]: 1 for _, path, _ in COLUMNS}
+
+
+def npy_header(descr, rows):
+    """
+    Returns:
+        bytes: the header of a one dimensional .npy file (format 1.0), NPY_HEADER_SIZE bytes long
+    """
+    header = repr({'descr': descr, 'fortran_order': False, 'shape': (rows,)})
+    header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 2 - 1) + "\n"
+    return NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def read_npy_header(npy_file):
+    """
+    Reads the header of a .npy file written by this module
+
+    Args:
+        npy_file (file): the file, opened in binary mode at its start
+
+    Returns:
+        (str, int, int): the numpy type, the number of rows and the offset of the data
+    """
+    prefix = npy_file.read(len(NPY_MAGIC) + 2)
+    if prefix[:len(NPY_MAGIC)] != NPY_MAGIC:
+        raise ValueError(f"{npy_file.name} is not a .npy file of format 1.0")
+    header_length = struct.unpack("<H", prefix[len(NPY_MAGIC):])[0]
+    header = ast.literal_eval(npy_file.read(header_length).decode("latin1"))
+    return header['descr'], header['shape'][0], len(prefix) + header_length
+
+
+class NpyColumn():
+    """
+    A one dimensional .npy file written a chunk at a time, after the rows it already holds
+    """
+
+    def __init__(self, path, descr, keep=None):
+        """
+        Args:
+            path (str): the file, created if missing
+            descr (str): the numpy type of the values, e.g. <i2
+            keep (int, optional): the rows of an existing file to keep, the others are dropped.
+                                  Defaults to None, all of them.
+        """
+        self.descr = descr
+        if os.path.exists(path):
+            self.file = open(path, "r+b")
+            stored_descr, self.rows, offset = read_npy_header(self.file)
+            if stored_descr != descr:
+                raise ValueError(f"{path} holds {stored_descr} values, not {descr}")
+            if keep is not None and keep < self.rows:
+                self.rows = keep
+                self.file.truncate(offset + keep * int(descr[2:]))
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, "wb")
+            self.rows = 0
+            self.file.write(npy_header(descr, 0))
+
+    def append(self, data, rows):
+        self.file.write(data)
+        self.rows += rows
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(npy_header(self.descr, self.rows))
+        self.file.close()
+
+
+class PlayerDictionary():
+    """
+    Gives every puuid a code, its row in PLAYERS, the same one across the whole dataset
+    """
+
+    def __init__(self, root, size):
+        """
+        Args:
+            root (str): the directory of the dataset
+            size (int): the players of the manifest, the ones written after it by an interrupted export are dropped
+        """
+        path = os.path.join(root, PLAYERS)
+        self.codes = {}
+        if os.path.exists(path):
+            for code, puuid in enumerate(load_players(root)[:size]):
+                self.codes[puuid] = code
+        self.column = NpyColumn(path, f"|S{PUUID_LENGTH}", keep=size)
+
+    def code(self, puuid):
+        code = self.codes.get(puuid)
+        if code is None:
+            if len(puuid) > PUUID_LENGTH:
+                raise ValueError(f"{puuid} is longer than {PUUID_LENGTH} characters")
+            code = self.codes[puuid] = len(self.codes)
+            self.column.append(puuid.encode("ascii").ljust(PUUID_LENGTH, b"\0"), 1)
+        return code
+
+    def __len__(self):
+        return len(self.codes)
+
+    def close(self):
+        self.column.close()
+
+
+def game_id(match_id):
+    """
+    Returns:
+        int: the number of a match id like EUW1_5380000000, NO_VALUE if it has none
+    """
+    number = str(match_id).rpartition("_")[2]
+    return int(number) if number.isdigit() else NO_VALUE
+
+
+def row_value(name, value, players):
+    if name == "game_id":
+        return game_id(value)
+    if value == "":
+        return NO_VALUE
+    if name.endswith("_player"):
+        return players.code(value)
+    return value
+
+
+def write_part(directory, docs, players):
+    """
+    Writes the docs as a new part, moved in place only once complete
+
+    Args:
+        directory (str): the directory of the part
+        docs (iterable(dict)): the match docs, typically a cursor
+        players (PlayerDictionary): the codes of the players
+
+    Returns:
+        int: the number of rows written
+    """
+    tmp_directory = directory + ".tmp"
+    os.makedirs(tmp_directory)
+    files = {name: NpyColumn(os.path.join(tmp_directory, f"{name}.npy"), f"{ENDIAN}{NPY_TYPES[typecode]}")
+             for name, _, typecode in COLUMNS}
+    buffers = {name: array(typecode) for name, _, typecode in COLUMNS}
+
+    def flush():
+        for name, values in buffers.items():
+            files[name].append(values.tobytes(), len(values))
+            del values[:]
+
+    rows = 0
+    for doc in docs:
+        for name, path, _ in COLUMNS:
+            buffers[name].append(row_value(name, field_value(doc, path), players))
+        rows += 1
+        if rows % DATASET_BATCH_SIZE == 0:
+            flush()
+    flush()
+    for column in files.values():
+        column.close()
+    os.rename(tmp_directory, directory)
+    return rows
+
+
+def partition_path(patch, region, part):
+    return os.path.join(f"patch={patch}", f"region={region}", f"part-{part:05d}")
+
+
+def read_manifest(root):
+    """
+    Returns:
+        dict: the parts of the dataset, with the players they refer to and until when the matches were exported
+    """
+    try:
+        with open(os.path.join(root, MANIFEST)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {'exported_until': None, 'last_updated': None, 'players': 0, 'partitions': [],
+                'columns': {name: f"{ENDIAN}{NPY_TYPES[typecode]}" for name, _, typecode in COLUMNS}}
+
+
+def write_manifest(root, manifest):
+    # a reader never sees half a manifest
+    tmp_path = os.path.join(root, MANIFEST + ".tmp")
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(tmp_path, os.path.join(root, MANIFEST))
+
+
+def remove_orphan_parts(root, manifest):
+    """
+    Deletes the parts an interrupted export wrote but didn't add to the manifest,
+    their matches are exported again
+    """
+    listed = {os.path.normpath(partition['path']) for partition in manifest['partitions']}
+    for patch_dir in os.listdir(root):
+        if not patch_dir.startswith("patch="):
+            continue
+        for region_dir in os.listdir(os.path.join(root, patch_dir)):
+            for part in os.listdir(os.path.join(root, patch_dir, region_dir)):
+                path = os.path.join(patch_dir, region_dir, part)
+                if path not in listed:
+                    shutil.rmtree(os.path.join(root, path))
+
+
+def stale_partitions(database, manifest, until):
+    """
+    Finds the partitions whose exported parts no longer hold their matches: the ones with matches
+    rebuilt by reprocess since the previous export, and the ones whose matches stored before it
+    don't add up to the rows exported, because some were deleted or committed late
+
+    Args:
+        database (Database): the database holding the matches
+        manifest (dict): the manifest of the previous export, which has an exported_until
+        until (datetime.datetime): until when the matches are exported this time
+
+    Returns:
+        set(tuple): the patch and region of the stale partitions
+    """
+    matches = database.db_matches
+    exported_until = datetime.fromisoformat(manifest['exported_until'])
+    exported = {'stored': {'$not': {'$gte': exported_until}}}
+    if manifest.get('last_updated') is None:
+        rebuilt = {'updated': {'$exists': True}}
+    else:
+        rebuilt = {'updated': {'$gt': datetime.fromisoformat(manifest['last_updated'])}}
+    stale = {(group['_id']['patch'], group['_id']['region']) for group in matches.aggregate(
+        [{'$match': dict(exported, **rebuilt)}, {'$group': {'_id': {'patch': '$patch', 'region': '$region'}}}])}
+    rows = Counter()
+    for partition in manifest['partitions']:
+        rows[(partition['patch'], partition['region'])] += partition['rows']
+    # counting every partition is a scan of the collection, only done when the total is off
+    newer = matches.count_documents({'stored': {'$gte': exported_until}})
+    if matches.estimated_document_count() - newer != sum(rows.values()):
+        counts = Counter({(group['_id']['patch'], group['_id']['region']): group['rows']
+                          for group in matches.aggregate([{'$match': exported},
+                                                          {'$group': {'_id': {'patch': '$patch', 'region': '$region'},
+                                                                      'rows': {'$sum': 1}}}])})
+        stale.update(partition for partition in set(rows) | set(counts) if rows[partition] != counts[partition])
+    return stale
+
+
+def clear_dataset(root):
+    for entry in os.listdir(root):
+        if entry.startswith("patch="):
+            shutil.rmtree(os.path.join(root, entry))
+        elif entry in (MANIFEST, PLAYERS):
+            os.remove(os.path.join(root, entry))
+
+
+def export_dataset(database, root, rebuild=False, now=None):
+    """
+    Appends to the dataset the matches stored since the previous export, a new part for each
+    patch and region they belong to. The partitions gone stale since (see stale_partitions)
+    are exported again whole, as a single part replacing their previous ones.
+
+    Args:
+        database (Database): the database holding the matches
+        root (str): the directory of the dataset, created if missing
+        rebuild (bool, optional): drop the dataset and export every match. Defaults to False.
+        now (datetime.datetime, optional): the current UTC time. Defaults to None, the clock's.
+
+    Returns:
+        dict: number of matches exported and of parts written
+    """
+    now = now or datetime.utcnow()
+    os.makedirs(root, exist_ok=True)
+    if rebuild:
+        clear_dataset(root)
+    manifest = read_manifest(root)
+    remove_orphan_parts(root, manifest)
+    until = now - EXPORT_SETTLE
+    # read first, the matches rebuilt during the export are checked again by the next one
+    updated = database.last_updated()
+    # the matches stored before their time was recorded come with the first export, and with a stale partition
+    whole = {'stored': {'$not': {'$gte': until}}}
+    if manifest['exported_until'] is None:
+        query, stale = whole, set()
+    else:
+        query = {'stored': {'$gte': datetime.fromisoformat(manifest['exported_until']), '$lt': until}}
+        stale = stale_partitions(database, manifest, until)
+    next_part = Counter()
+    for partition in manifest['partitions']:
+        key = (partition['patch'], partition['region'])
+        next_part[key] = max(next_part[key], int(partition['path'][-5:]) + 1)
+    pending = {(group['_id']['patch'], group['_id']['region']) for group in database.db_matches.aggregate(
+        [{'$match': query}, {'$group': {'_id': {'patch': '$patch', 'region': '$region'}}}])}
+    replaced = [partition for partition in manifest['partitions']
+                if (partition['patch'], partition['region']) in stale]
+    manifest['partitions'] = [partition for partition in manifest['partitions'] if partition not in replaced]
+    players = PlayerDictionary(root, manifest['players'])
+    counts = {"matches": 0, "parts": 0}
+    try:
+        for patch, region in sorted(pending | stale):
+            path = partition_path(patch, region, next_part[(patch, region)])
+            os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+            docs = database.db_matches.find(dict(whole if (patch, region) in stale else query,
+                                                 patch=patch, region=region), PROJECTION,
+                                            sort=[('_id', ASCENDING)], batch_size=DATASET_BATCH_SIZE)
+            rows = write_part(os.path.join(root, path), docs, players)
+            if not rows:
+                # every match of a stale partition may have been deleted
+                shutil.rmtree(os.path.join(root, path))
+                continue
+            manifest['partitions'].append({'patch': patch, 'region': region, 'path': path, 'rows': rows})
+            counts["matches"] += rows
+            counts["parts"] += 1
+            log(INFO, "Exported %d matches of patch %s in %s", rows, patch, region)
+    finally:
+        # the players the parts refer to are written before the manifest listing them
+        players.close()
+    manifest['players'] = len(players)
+    manifest['exported_until'] = until.isoformat()
+    manifest['last_updated'] = updated
+    write_manifest(root, manifest)
+    # only once the manifest no longer lists them, an interrupted export leaves them as orphans
+    for partition in replaced:
+        shutil.rmtree(os.path.join(root, partition['path']))
+    if stale:
+        log(INFO, "Exported again %d stale partitions: %s", len(stale),
+            ", ".join(f"{patch} {region}" for patch, region in sorted(stale)))
+    return counts
+
+
+def open_column(path):
+    """
+    Memory-maps a numeric column without copying it, as numpy.load(path, mmap_mode="r") does
+
+    Args:
+        path (str): the .npy file of the column
+
+    Returns:
+        memoryview: the values
+    """
+    with open(path, "rb") as npy_file:
+        descr, rows, offset = read_npy_header(npy_file)
+        typecode = {f"{ENDIAN}{npy_type}": typecode for typecode, npy_type in NPY_TYPES.items()}.get(descr)
+        if typecode is None:
+            raise ValueError(f"{path} holds {descr} values, not numbers in the byte order of this machine")
+        mapped = mmap.mmap(npy_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped)[offset:].cast(typecode)
+
+
+def load_players(root):
+    """
+    Returns:
+        list(str): the puuid of every player code of the dataset
+    """
+    with open(os.path.join(root, PLAYERS), "rb") as npy_file:
+        _, rows, _ = read_npy_header(npy_file)
+        data = npy_file.read(rows * PUUID_LENGTH)
+    return [data[start:start + PUUID_LENGTH].rstrip(b"\0").decode("ascii")
+            for start in range(0, len(data), PUUID_LENGTH)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Appends the new matches to the columnar dataset")
+    parser.add_argument("directory", help="the directory of the dataset")
+    parser.add_argument("db_url", help="the url of the Mongo DB holding the matches")
+    parser.add_argument("--rebuild", action="store_true", help="drop the dataset and export every match")
+    args = parser.parse_args()
+    print(export_dataset(Database(args.db_url), args.directory, args.rebuild))
@@ -1,92 +1,795 @@
 """
     This file is responsible for the interaction with the mongo db
 """
-from pymongo import MongoClient
+import socket
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import partial
+from logging import INFO, DEBUG, WARNING
+from threading import Event, Lock, Thread, current_thread
+from pymongo import UpdateOne, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
 from . import REGIONS, TIERS, DIVISIONS
+from .csv_export import export_matches
+from .logger import log as log_raw
+from .match_query import MATCH_INDEXES, QUERY_LIMIT, QUERY_MAX_LIMIT, match_query, query_projection
+from .metrics import metrics, timed, publish
+from .mongo_client import get_database
+from .scheduler import rank_key, merge, plan, priority
 import os
 
 
+log = partial(log_raw, "database")
+
+
+# how long a resolved summoner is trusted before asking riot again
+PUUID_TTL = timedelta(days=30)
+# names of deleted accounts might get taken again, so they are retried sooner
+NOT_FOUND_TTL = timedelta(days=7)
+# how many ids are sent to the database in a single query
+ID_CHUNK_SIZE = 1000
+DUPLICATE_KEY_ERROR = 11000
+# a rank claimed by a worker that stops renewing its lease for this long is given to another worker
+LEASE_TTL = timedelta(minutes=5)
+# seconds between two renewals of the leases, and before the first retry of a failed one, doubled up to the former
+LEASE_RENEW_EVERY = LEASE_TTL.total_seconds() / 3
+LEASE_RETRY_EVERY = 10
+# a match whose calls failed this many times is given up
+MAX_MATCH_FAILURES = 3
+# returned by the puuid cache for the summoners it doesn't hold, None being the puuid of the ones not found
+NOT_CACHED = object()
+
+
+class LRUCache():
+    """
+    A dictionary holding at most max_size items, dropping the least recently used ones
+    and the ones past their expiry time. It can be shared by threads.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # key -> (value, expires)
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None, now=None):
+        """
+        Args:
+            key: the key of the item
+            default (optional): returned when the item is missing or expired. Defaults to None.
+            now (datetime, optional): the current time. Defaults to None, datetime.utcnow().
+
+        Returns:
+            the value of the item, default if there is none
+        """
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires <= (now or datetime.utcnow()):
+                del self.items[key]
+                return default
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value, expires=None):
+        """
+        Args:
+            key: the key of the item
+            value: its value
+            expires (datetime, optional): when the item stops being returned. Defaults to None, never.
+        """
+        with self.lock:
+            self.items[key] = (value, expires)
+            self.items.move_to_end(key)
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+class KnownMatchIndex():
+    """
+    Compact in-memory set of the ids of the stored matches.
+    Riot match ids (e.g. EUW1_5312345678) are packed in a single integer holding the game
+    number and the platform, any other id is kept as it is in a separate set.
+    """
+    PLATFORMS = {region.upper(): code for code, region in enumerate(REGIONS, start=1)}
+
+    def __init__(self):
+        self.packed = set()
+        self.others = set()
+        self.lock = Lock()
+
+    @staticmethod
+    def pack(match_id):
+        """
+        Returns the integer representation of a riot match id, None if the id has a different format
+        """
+        if isinstance(match_id, str):
+            platform, _, number = match_id.partition("_")
+            if platform in KnownMatchIndex.PLATFORMS and number.isdigit():
+                return int(number) << 4 | KnownMatchIndex.PLATFORMS[platform]
+        return None
+
+    def add(self, match_ids):
+        with self.lock:
+            for match_id in match_ids:
+                packed = KnownMatchIndex.pack(match_id)
+                if packed is not None:
+                    self.packed.add(packed)
+                else:
+                    self.others.add(match_id)
+
+    def __contains__(self, match_id):
+        packed = KnownMatchIndex.pack(match_id)
+        if packed is not None:
+            return packed in self.packed
+        return match_id in self.others
+
+    def __len__(self):
+        return len(self.packed) + len(self.others)
+
+    def memory_usage(self):
+        """
+        Returns:
+            int: the approximate number of bytes used by the index
+        """
+        with self.lock:
+            return sys.getsizeof(self.packed) + sys.getsizeof(self.others) \
+                + sum(sys.getsizeof(packed) for packed in self.packed) \
+                + sum(sys.getsizeof(match_id) for match_id in self.others)
+
+    def rebuild(self, matches_collection):
+        """
+        Loads the ids of all the matches in the collection, reading only the _id index
+        """
+        start = time.time()
+        with self.lock:
+            self.packed.clear()
+            self.others.clear()
+        ids = []
+        for doc in matches_collection.find({}, {"_id": 1}, batch_size=10000):
+            ids.append(doc["_id"])
+            if len(ids) == 10000:
+                self.add(ids)
+                ids = []
+        self.add(ids)
+        log(INFO, "Loaded %d known match ids in %.2fs, using %.2f MB",
+            len(self), time.time() - start, self.memory_usage() / 1024 ** 2)
+
+
+class BulkWriter():
+    """
+    Write-behind buffer for the match docs and the page checkpoints of the crawler.
+    The buffer is flushed with a single unordered bulk write when it holds max_docs docs
+    or when its oldest item has been waiting for max_delay seconds.
+    """
+
+    def __init__(self, database, max_docs=100, max_delay=5.0):
+        """
+        Args:
+            database (Database): the database to write to
+            max_docs (int, optional): docs that trigger a flush. Defaults to 100.
+            max_delay (float, optional): seconds after which buffered items are flushed. Defaults to 5.0.
+        """
+        self.database = database
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self.docs = []
+        self.done = []
+        self.failed = []
+        self.pages = {}
+        self.fingerprints = {}
+        self.oldest = None
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.closed = Event()
+        self.timer = None
+        self.flushes = 0
+        self.written = 0
+        self.duplicates = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def start_timer(self):
+        if self.timer is None:
+            self.timer = Thread(target=self.flush_periodically, name="bulk-writer", daemon=True)
+            self.timer.start()
+
+    def flush_periodically(self):
+        while not self.closed.wait(self.max_delay / 2):
+            oldest = self.oldest
+            if oldest is not None and time.time() - oldest >= self.max_delay:
+                try:
+                    self.flush()
+                except Exception as err:
+                    # the batch is back in the buffer, the next round tries again
+                    log(WARNING, "Periodic flush failed, retrying in %.1fs: %s", self.max_delay / 2, err)
+
+    def add(self, match_docs, done=(), failed=()):
+        """
+        Args:
+            match_docs (list(dict)): the docs to store
+            done (list(tuple), optional): (rank _id, page, match id) of the matches to mark as done
+                                          in the crawl journal. Defaults to ().
+            failed (list(tuple), optional): (rank _id, match id) of the matches to retry. Defaults to ().
+        """
+        with self.lock:
+            self.docs.extend(match_docs)
+            self.done.extend(done)
+            self.failed.extend(failed)
+            if self.oldest is None:
+                self.oldest = time.time()
+            is_full = len(self.docs) >= self.max_docs
+        self.start_timer()
+        if is_full:
+            self.flush()
+
+    def checkpoint(self, id, page, fingerprint=None):
+        """
+        Moves the rank to the given page together with the docs buffered so far
+
+        Args:
+            id (Any): the _id of the rank in ReDiTi
+            page (int): the page to continue from
+            fingerprint (str, optional): the fingerprint of the page just finished, stored with the
+                                         checkpoint so that the page is skipped only once it's done.
+                                         Defaults to None.
+        """
+        with self.lock:
+            self.pages[id] = page
+            if fingerprint is not None:
+                self.fingerprints[(id, page - 1)] = fingerprint
+            if self.oldest is None:
+                self.oldest = time.time()
+        self.start_timer()
+
+    def flush(self):
+        # flushes are serialized so that checkpoints are never written before the docs preceding them
+        with self.flush_lock:
+            with self.lock:
+                docs, done, failed = self.docs, self.done, self.failed
+                pages, fingerprints = self.pages, self.fingerprints
+                self.docs, self.done, self.failed, self.pages, self.fingerprints, self.oldest = [], [], [], {}, {}, None
+            if not docs and not done and not failed and not pages:
+                return
+            start = time.time()
+            try:
+                stored, duplicates = self.database.write_batch(docs, pages, done, fingerprints, failed)
+            except Exception:
+                self.restore(docs, done, failed, pages, fingerprints, start)
+                raise
+            latency = time.time() - start
+            self.flushes += 1
+            self.written += stored
+            self.duplicates += duplicates
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        log(DEBUG, "Flushed %d docs (%d already stored) and %d checkpoints in %.3fs",
+            len(docs), duplicates, len(pages), latency)
+
+    def restore(self, docs, done, failed, pages, fingerprints, oldest):
+        """
+        Puts a batch that could not be written back in front of the buffer, the docs are upserted
+        and the journal updates are idempotent, so writing part of it again is harmless
+        """
+        with self.lock:
+            self.docs = docs + self.docs
+            self.done = done + self.done
+            self.failed = failed + self.failed
+            # a later checkpoint of the same rank wins
+            self.pages = {**pages, **self.pages}
+            self.fingerprints = {**fingerprints, **self.fingerprints}
+            self.oldest = oldest if self.oldest is None else min(oldest, self.oldest)
+
+    def close(self):
+        self.closed.set()
+        self.flush()
+
+    def stats(self):
+        """
+        Returns:
+            dict: number of flushes, docs written, duplicates skipped,
+                  average batch size and average/max flush latency in seconds
+        """
+        flushes = max(self.flushes, 1)
+        return {'flushes': self.flushes,
+                'written': self.written,
+                'duplicates': self.duplicates,
+                'avg_batch': (self.written + self.duplicates) / flushes,
+                'avg_latency': self.total_latency / flushes,
+                'max_latency': self.max_latency}
+
+
+class ProcessCollection():
+    """
+    A collection of the Database, taken from the Mongo client of the current process every time,
+    so that a Database created before a fork can be used in the child process.
+    A value assigned on the instance (the mongomock collections) takes its place.
+    """
+
+    def __init__(self, name=None):
+        """
+        Args:
+            name (str, optional): the name of the collection. Defaults to None, the database itself.
+        """
+        self.name = name
+
+    def __get__(self, database, owner):
+        if database is None:
+            return self
+        db = get_database(database.db_url)
+        return db if self.name is None else db.get_collection(self.name)
+
+
 class Database():
 
-    def __init__(self, db_url=None):
+    db = ProcessCollection()
+    db_matches = ProcessCollection("matches")
+    db_rediti = ProcessCollection("ReDiTi")
+    db_summoners = ProcessCollection("summoners")
+    db_watermarks = ProcessCollection("watermarks")
+    db_journal = ProcessCollection("journal")
+    db_metrics = ProcessCollection("metrics")
+    db_rank_stats = ProcessCollection("rank_stats")
+    db_retries = ProcessCollection("match_retries")
+
+    def __init__(self, db_url=None, puuid_cache_size=100000):
         """
-        Initializes the object by connecting to the Mongo DB if a url is given
-        otherwise it connects to a mock of a Mongo DB (testing only)
+        Initializes the object without touching the Mongo DB if a url is given,
+        the connection is made by the shared client of the process on the first query,
+        otherwise it connects to a mock of a Mongo DB (testing only).
+        What only the crawler needs is set up by prepare_crawl.
 
         Args:
             db_url (str, optional): The url on which to find the Mongo DB. Defaults to None.
+            puuid_cache_size (int, optional): how many resolved summoners are kept in memory.
+                                              Defaults to 100000.
         """
-        if db_url is not None:
-            self.db_url = db_url
-            self.db = MongoClient(db_url, connect=False).get_database("mooncaker")
-            self.db_matches = self.db.get_collection("matches")
-            self.db_rediti = self.db.get_collection("ReDiTi")
-
-            self.set_rediti()
-            self.to_crawl = [elem for elem in self.db_rediti.find({'crawled': False})]
-            if not self.to_crawl:
-                # nothing to crawl, reset rediti
-                self.reset_rediti()
-                self.to_crawl = [elem for elem in self.db_rediti.find({'crawled': False})]
-        else:
+        self.db_url = db_url
+        self.puuid_cache = LRUCache(puuid_cache_size)
+        self.known_matches = KnownMatchIndex()
+        self.prepared = False
+        self.prepare_lock = Lock()
+        if db_url is None:
             # No db, testing functionality
             import mongomock
             self.db = mongomock.MongoClient().db
-            self.db_matches = self.db.collection
-            self.db_rediti = self.db.collection
+            self.db_matches = self.db.get_collection("matches")
+            self.db_rediti = self.db.get_collection("ReDiTi")
+            self.db_summoners = self.db.get_collection("summoners")
+            self.db_watermarks = self.db.get_collection("watermarks")
+            self.db_journal = self.db.get_collection("journal")
+            self.db_metrics = self.db.get_collection("metrics")
+            self.db_rank_stats = self.db.get_collection("rank_stats")
+            self.db_retries = self.db.get_collection("match_retries")
             import random
             region = random.choice(REGIONS)
             tier = random.choice(TIERS)
             division = random.choice(DIVISIONS)
-            self.to_crawl = [{'_id': 101010,
-                              'region': region,
-                              'tier': tier,
-                              'division': division,
-                              'page': 1}]
+            self.db_rediti.insert_one({'_id': 101010,
+                                       'region': region,
+                                       'tier': tier,
+                                       'division': division,
+                                       'page': 1,
+                                       'crawled': False})
+        # identifies this crawler among the ones sharing the database
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leases = set()
+        self.leases_lock = Lock()
+        self.heartbeat = None
+        self.heartbeat_stopped = None
+
+    def prepare_crawl(self):
+        """
+        Creates the indexes used by the crawler, loads the ids of the stored matches
+        and initializes ReDiTi if needed. Only the first call does anything.
+        """
+        with self.prepare_lock:
+            if self.prepared:
+                return
+            self.db_summoners.create_index("expires", expireAfterSeconds=0)
+            self.db_journal.create_index("rank")
+            self.db_retries.create_index("rank")
+            # the patches of an export are resolved with a distinct on it, the dataset export
+            # reads each patch and region stored since the previous one
+            self.db_matches.create_index([("patch", ASCENDING), ("region", ASCENDING), ("stored", ASCENDING)])
+            self.db_matches.create_index("stored")
+            # the export cache is built again when a doc was rebuilt since
+            self.db_matches.create_index("updated")
+            # the ones of query_matches, on region and patch, champion by role, winner and duration
+            for keys in MATCH_INDEXES:
+                self.db_matches.create_index(keys)
+            self.known_matches.rebuild(self.db_matches)
+            self.set_rediti()
+            self.prepared = True
 
     def set_rediti(self):
         """
         If the collection used to track the crawler region, tier, division is empty
-        it gets initialized
+        it gets initialized, each rank with the priority given by its past yield.
+        The ranks not worth crawling in this cycle are inserted as already crawled (see scheduler).
         """
         if self.db_rediti.count_documents({}) == 0:
+            now = datetime.utcnow()
+            stats = {doc['_id']: doc for doc in self.db_rank_stats.find()}
+            planned = plan([(reg, tier, div) for reg in REGIONS for tier in TIERS for div in DIVISIONS],
+                           stats, now)
             comb = [{'region': reg,
                      'tier': tier,
                      'division': div,
                      'page': 1,
-                     'crawled': False}
-                    for reg in REGIONS
-                    for tier in TIERS
-                    for div in DIVISIONS]
+                     'crawled': skipped,
+                     'priority': rank_priority}
+                    for (reg, tier, div), rank_priority, skipped in planned]
             self.db["ReDiTi"].insert_many(comb)
+            skipped = [rank_key(*rank) for rank, _, is_skipped in planned if is_skipped]
+            if skipped:
+                self.db_rank_stats.update_many({'_id': {'$in': skipped}}, {'$inc': {'skipped': 1}})
+                log(INFO, "%d ranks with a low yield sit out this cycle", len(skipped))
 
     def reset_rediti(self):
         """
-        Resets the tracking of the crawling process
+        Resets the tracking of the crawling process, dropping the progress of every rank.
+        The crawl daemon doesn't need it, it reopens the ranks as they are due (see reopen_due_ranks).
         """
         self.db_rediti.drop()
         self.set_rediti()
 
-    def ranks2crawl(self):
+    def ranks2crawl(self, region=None):
         """
-        A generator that yields the ranks that needs to be crawled
+        A generator that yields the ranks that needs to be crawled.
+        Each rank is claimed with a lease right before being yielded, so that several
+        crawlers sharing the database never crawl the same rank. A rank is yielded at most
+        once, the lease should be given back with release_rank or mark_as_crawled.
+
+        Args:
+            region (str, optional): only yield the ranks of this region. Defaults to None.
 
         Yields:
             (tuple): a tuple with the _id, region, tier, division and page to crawl
         """
-        for elem in self.to_crawl:
+        claimed = []
+        while True:
+            elem = self.claim_rank(region, claimed)
+            if elem is None:
+                return
+            claimed.append(elem['_id'])
             yield elem['_id'], elem['region'], elem['tier'], elem['division'], elem['page']
 
-    def mark_as_crawled(self, id):
-        self.db_rediti.update_one({'_id': id}, {'$set': {'crawled': True}})
+    @timed("claim_rank")
+    def claim_rank(self, region=None, exclude=()):
+        """
+        Atomically takes the rank with the highest priority among the ones
+        not crawled and not leased to a live worker
+
+        Args:
+            region (str, optional): only claim a rank of this region. Defaults to None.
+            exclude (list, optional): _ids of the ranks not to claim. Defaults to ().
+
+        Returns:
+            dict | None: the claimed rank, None if there is nothing left to claim
+        """
+        now = datetime.utcnow()
+        query = {'crawled': False,
+                 '_id': {'$nin': list(exclude)},
+                 '$or': [{'owner': None}, {'lease_expires': {'$lt': now}}]}
+        if region is not None:
+            query['region'] = region
+        elem = self.db_rediti.find_one_and_update(query,
+                                                  {'$set': {'owner': self.worker_id,
+                                                            'lease_expires': now + LEASE_TTL}},
+                                                  sort=[('priority', DESCENDING), ('_id', ASCENDING)],
+                                                  return_document=ReturnDocument.AFTER)
+        if elem is not None:
+            with self.leases_lock:
+                self.leases.add(elem['_id'])
+            self.start_heartbeat()
+        return elem
+
+    def start_heartbeat(self):
+        with self.leases_lock:
+            if self.heartbeat is None:
+                self.heartbeat_stopped = Event()
+                self.heartbeat = Thread(target=self.renew_leases, args=(self.heartbeat_stopped,),
+                                        name="lease-heartbeat", daemon=True)
+                self.heartbeat.start()
+
+    def stop_heartbeat(self):
+        """
+        Stops renewing the leases, waiting for the heartbeat to end
+        """
+        with self.leases_lock:
+            heartbeat, self.heartbeat = self.heartbeat, None
+            if heartbeat is not None:
+                self.heartbeat_stopped.set()
+        if heartbeat is not None:
+            heartbeat.join()
+
+    def renew_leases(self, stopped):
+        """
+        Extends the leases of the ranks held until stopped is set or no rank is held anymore,
+        claim_rank starts a new heartbeat then. A failed renewal is logged and tried again sooner,
+        so that a short outage of Mongo doesn't let the leases expire.
+
+        Args:
+            stopped (threading.Event): set by stop_heartbeat
+        """
+        delay = LEASE_RENEW_EVERY
+        while not stopped.wait(delay):
+            with self.leases_lock:
+                leases = list(self.leases)
+                if not leases:
+                    if self.heartbeat is current_thread():
+                        self.heartbeat = None
+                    return
+            try:
+                result = self.db_rediti.update_many({'_id': {'$in': leases}, 'owner': self.worker_id},
+                                                    {'$set': {'lease_expires': datetime.utcnow() + LEASE_TTL}})
+            except Exception as err:
+                delay = LEASE_RETRY_EVERY if delay == LEASE_RENEW_EVERY else min(2 * delay, LEASE_RENEW_EVERY)
+                log(WARNING, "Could not renew the lease of %d ranks, retrying in %ds: %s", len(leases), delay, err)
+                continue
+            delay = LEASE_RENEW_EVERY
+            if result.matched_count < len(leases):
+                log(WARNING, "Lost the lease of %d ranks", len(leases) - result.matched_count)
+
+    def release_rank(self, id):
+        """
+        Gives back the lease of a rank, so that it can be claimed again
+        """
+        with self.leases_lock:
+            self.leases.discard(id)
+        self.db_rediti.update_one({'_id': id, 'owner': self.worker_id},
+                                  {'$set': {'owner': None, 'lease_expires': None}})
+
+    def mark_as_crawled(self, id, next_visit=None):
+        """
+        Args:
+            id (Any): the _id of the rank in ReDiTi
+            next_visit (datetime.datetime, optional): when the rank should be crawled again.
+                                                      Defaults to None, as soon as it's reopened.
+        """
+        self.db_rediti.update_one({'_id': id}, {'$set': {'crawled': True, 'next_visit': next_visit}})
+        self.db_journal.delete_many({'rank': id})
+        self.release_rank(id)
+
+    def record_yield(self, id, region, tier, division, tally):
+        """
+        Adds a crawl to the yield statistics of a rank and updates its priority
+
+        Args:
+            id (Any): the _id of the rank in the ReDiTi collection
+            region (str): the server region of the rank
+            tier (str): the tier of the rank
+            division (str): the division of the rank
+            tally (dict): the totals of the RankTally of the crawl
+
+        Returns:
+            dict: the new statistics of the rank
+        """
+        now = datetime.utcnow()
+        key = rank_key(region, tier, division)
+        stats = merge(self.db_rank_stats.find_one({'_id': key}) or {}, tally, now)
+        self.db_rank_stats.replace_one({'_id': key}, dict(stats, _id=key), upsert=True)
+        self.db_rediti.update_one({'_id': id}, {'$set': {'priority': priority(stats, now)}})
+        return stats
+
+    def reopen_due_ranks(self, revisit_every, now=None):
+        """
+        Makes the crawled ranks whose next visit is due crawlable again from their first page,
+        keeping everything else they carry (fingerprints of the pages, priority, statistics).
+        The due ranks worth too little compared to the best one are postponed instead (see scheduler.plan).
+
+        Args:
+            revisit_every (datetime.timedelta): how long a postponed rank waits for its next visit
+            now (datetime.datetime, optional): the current UTC time. Defaults to now.
+
+        Returns:
+            int: the number of ranks reopened
+        """
+        now = now or datetime.utcnow()
+        due = list(self.db_rediti.find({'crawled': True,
+                                        '$or': [{'next_visit': None}, {'next_visit': {'$lte': now}}]}))
+        if not due:
+            return 0
+        stats = {doc['_id']: doc for doc in self.db_rank_stats.find()}
+        best = max((priority(rank_stats, now) for rank_stats in stats.values()), default=None)
+        ids = {(rank['region'], rank['tier'], rank['division']): rank['_id'] for rank in due}
+        reopen, postpone = [], []
+        for rank, rank_priority, skipped in plan(list(ids), stats, now, best):
+            if skipped:
+                postpone.append(rank)
+            else:
+                reopen.append(UpdateOne({'_id': ids[rank]}, {'$set': {'crawled': False, 'page': 1,
+                                                                       'priority': rank_priority}}))
+        if reopen:
+            self.db_rediti.bulk_write(reopen, ordered=False)
+        if postpone:
+            self.db_rediti.update_many({'_id': {'$in': [ids[rank] for rank in postpone]}},
+                                       {'$set': {'next_visit': now + revisit_every}})
+            self.db_rank_stats.update_many({'_id': {'$in': [rank_key(*rank) for rank in postpone]}},
+                                           {'$inc': {'skipped': 1}})
+        log(INFO, "Reopened %d ranks, postponed %d with a low yield", len(reopen), len(postpone))
+        return len(reopen)
+
+    def next_visit(self):
+        """
+        Returns:
+            datetime.datetime | None: when the next crawled rank is due, None if no rank is waiting
+        """
+        rank = self.db_rediti.find_one({'crawled': True}, sort=[('next_visit', ASCENDING)])
+        return None if rank is None else rank.get('next_visit') or datetime.utcnow()
+
+    def page_fingerprints(self, id):
+        """
+        Returns:
+            dict: page (as string) -> fingerprint of the league entries found the last time it was crawled
+        """
+        rank = self.db_rediti.find_one({'_id': id}, {'fingerprints': 1})
+        return (rank or {}).get('fingerprints', {})
+
+    @timed("write_batch")
+    def write_batch(self, match_docs, pages, done=(), fingerprints=None, failed=()):
+        """
+        Stores the match docs with unordered upserts, so that a match already present
+        doesn't stop the others from being written, marks the matches as done in the journal,
+        keeps the failed ones to be retried, then moves the ranks to their new page
+        dropping the journal of the previous pages
+
+        Args:
+            match_docs (list(dict)): the docs to store
+            pages (dict): _id of the rank in ReDiTi -> page to continue from
+            done (list(tuple), optional): (rank _id, page, match id) of the matches done. Defaults to ().
+            fingerprints (dict, optional): (rank _id, page) -> fingerprint of the pages done. Defaults to None.
+            failed (list(tuple), optional): (rank _id, match id) of the matches whose calls failed.
+                                            Defaults to ().
+
+        Returns:
+            (int, int): the number of docs stored and of those already present
+        """
+        stored = duplicates = 0
+        if match_docs:
+            # when the match was first stored, to export only the new ones
+            now = datetime.utcnow()
+            updates = [UpdateOne({'_id': doc['_id']},
+                                 {'$setOnInsert': dict({key: value for key, value in doc.items() if key != '_id'},
+                                                       stored=now)},
+                                 upsert=True)
+                       for doc in match_docs]
+            try:
+                result = self.db_matches.bulk_write(updates, ordered=False)
+                stored, duplicates = result.upserted_count, result.matched_count
+            except BulkWriteError as err:
+                # two upserts of the same new match raced, the match is there anyway
+                if any(error['code'] != DUPLICATE_KEY_ERROR for error in err.details['writeErrors']):
+                    raise
+                stored = err.details['nUpserted']
+                duplicates = len(match_docs) - stored
+            self.known_matches.add(doc['_id'] for doc in match_docs)
+            metrics.inc("mooncaker_matches_stored_total", stored)
+            metrics.inc("mooncaker_matches_duplicate_total", duplicates)
+        if done:
+            done_by_page = {}
+            for id, page, g_id in done:
+                done_by_page.setdefault((id, page), []).append(g_id)
+            self.db_journal.bulk_write([UpdateOne({'_id': Database.journal_id(id, page)},
+                                                  {'$set': {'rank': id, 'page': page},
+                                                   '$addToSet': {'done': {'$each': g_ids}}},
+                                                  upsert=True)
+                                        for (id, page), g_ids in done_by_page.items()],
+                                       ordered=False)
+            # some of them were retried
+            self.db_retries.delete_many({'_id': {'$in': [g_id for _, _, g_id in done]}})
+        if failed:
+            self.db_retries.bulk_write([UpdateOne({'_id': g_id}, {'$set': {'rank': id}, '$inc': {'failures': 1}},
+                                                  upsert=True)
+                                        for id, g_id in failed],
+                                       ordered=False)
+        page_fingerprints = {}
+        for (id, page), fingerprint in (fingerprints or {}).items():
+            page_fingerprints.setdefault(id, {})[f'fingerprints.{page}'] = fingerprint
+        for id, page in pages.items():
+            self.db_rediti.update_one({'_id': id}, {'$set': dict(page_fingerprints.get(id, {}), page=page)})
+            self.db_journal.delete_many({'rank': id, 'page': {'$lt': page}})
+        return stored, duplicates
+
+    @staticmethod
+    def journal_id(id, page):
+        return f"{id}:{page}"
+
+    @timed("journal_listed")
+    def journal_listed(self, id, page, puuids, match_ids):
+        """
+        Records in the crawl journal that the match lists of the players were fetched
+        and which new matches they contained
+
+        Args:
+            id (Any): the _id of the rank in ReDiTi
+            page (int): the page the players belong to
+            puuids (list(str)): the players whose match list was fetched
+            match_ids (list(str)): the new matches found
+        """
+        self.db_journal.update_one({'_id': Database.journal_id(id, page)},
+                                   {'$set': {'rank': id, 'page': page},
+                                    '$addToSet': {'listed': {'$each': puuids},
+                                                  'pending': {'$each': match_ids}}},
+                                   upsert=True)
+
+    def get_retries(self, id):
+        """
+        Returns the matches of a rank whose calls failed, giving up the ones that failed MAX_MATCH_FAILURES times
+
+        Args:
+            id (Any): the _id of the rank in ReDiTi
+
+        Returns:
+            list(str): the match ids
+        """
+        given_up = self.db_retries.delete_many({'rank': id, 'failures': {'$gte': MAX_MATCH_FAILURES}}).deleted_count
+        if given_up:
+            log(WARNING, "Gave up %d matches of rank %s after %d failures", given_up, id, MAX_MATCH_FAILURES)
+        return [doc['_id'] for doc in self.db_retries.find({'rank': id}, {'_id': 1})]
+
+    @timed("get_journal")
+    def get_journal(self, id):
+        """
+        Returns the state of the pages of a rank that were started but not completed
+
+        Args:
+            id (Any): the _id of the rank in ReDiTi
+
+        Returns:
+            dict: page -> {'listed': set of puuids, 'pending': list of match ids, 'done': set of match ids}
+        """
+        return {doc['page']: {'listed': set(doc.get('listed', [])),
+                              'pending': doc.get('pending', []),
+                              'done': set(doc.get('done', []))}
+                for doc in self.db_journal.find({'rank': id})}
+
+    def insert_matches(self, match_docs):
+        self.write_batch(match_docs, {})
 
     def insert_match_page(self, id, match_docs, page):
-        self.db_matches.insert_many(match_docs)
-        self.db_rediti.update_one({'_id': id}, {'$set': {'page': page}})
+        """
+        Stores the last docs of a page and moves the rank to the given page
+        """
+        self.write_batch(match_docs, {id: page})
+
+    @timed("replace_matches")
+    def replace_matches(self, match_docs, removed=()):
+        """
+        Overwrites the stored docs with the given ones, used when the docs are rebuilt
+        from the raw store, and deletes the matches that are no longer valid.
+        The docs keep when they were stored and record when they were updated,
+        so that the exports know their content changed.
 
+        Args:
+            match_docs (list(dict)): the new docs
+            removed (list(str), optional): ids of the matches to delete. Defaults to ().
+        """
+        if match_docs:
+            now = datetime.utcnow()
+            self.db_matches.bulk_write([UpdateOne({'_id': doc['_id']},
+                                                  {'$set': dict({key: value for key, value in doc.items()
+                                                                 if key != '_id'}, updated=now),
+                                                   '$setOnInsert': {'stored': now}},
+                                                  upsert=True)
+                                        for doc in match_docs],
+                                       ordered=False)
+            self.known_matches.add(doc['_id'] for doc in match_docs)
+        if removed:
+            self.db_matches.delete_many({'_id': {'$in': list(removed)}})
+
+    @timed("filter_match_duplicates")
     def filter_match_duplicates(self, match_list):
         """
-            Clean match lists by removing duplicated games, both present inside the list and the database
+            Clean match lists by removing duplicated games, both present inside the list and the database.
+            The ids known to be stored are dropped in memory, the others are checked against
+            the database with a query every ID_CHUNK_SIZE ids.
 
             Parameters:
             match_lists(List[Dict]): List of clash games for each account
@@ -94,34 +797,166 @@ class Database():
             Returns:
             List[Dict]: list of clash games ids
         """
-        not_pres = [g_id for g_id in match_list
-                    if not self.db_matches.count_documents({"_id": g_id}) > 0]
-        not_pres = list(dict.fromkeys(not_pres))
-        return not_pres
+        candidates = [g_id for g_id in dict.fromkeys(match_list)
+                      if g_id not in self.known_matches]
+        stored = set()
+        for index in range(0, len(candidates), ID_CHUNK_SIZE):
+            chunk = candidates[index: index + ID_CHUNK_SIZE]
+            stored.update(doc['_id'] for doc in self.db_matches.find({"_id": {"$in": chunk}}, {"_id": 1}))
+        # matches inserted by someone else
+        self.known_matches.add(stored)
+        return [g_id for g_id in candidates if g_id not in stored]
+
+    @timed("cached_puuids")
+    def cached_puuids(self, region, keys):
+        """
+        Looks up already resolved summoners, first in memory then in the database
+
+        Args:
+            region (str): the server region of the summoners (euw1, kr, ...)
+            keys (list(str)): the keys of the summoners, see Crawler.summoner_key
+
+        Returns:
+            dict: key -> puuid for the known summoners, the puuid is None for the summoners
+                  that were not found by riot. Unknown keys are left out.
+        """
+        known = {}
+        missing = []
+        for key in keys:
+            # None is the puuid of the summoners not found
+            puuid = self.puuid_cache.get((region, key), NOT_CACHED)
+            if puuid is not NOT_CACHED:
+                known[key] = puuid
+            else:
+                missing.append(f"{region}:{key}")
+        if missing:
+            # the docs past their expiry time wait for the TTL monitor of Mongo to be deleted
+            for doc in self.db_summoners.find({"_id": {"$in": missing}, "expires": {"$gt": datetime.utcnow()}}):
+                key = doc["_id"].split(":", 1)[1]
+                known[key] = doc["puuid"]
+                self.puuid_cache.put((region, key), doc["puuid"], doc["expires"])
+        return known
+
+    @timed("cache_puuids")
+    def cache_puuids(self, region, puuids):
+        """
+        Stores the result of summoner resolutions
+
+        Args:
+            region (str): the server region of the summoners (euw1, kr, ...)
+            puuids (dict): key -> puuid, None if riot did not find the summoner
+        """
+        if not puuids:
+            return
+        now = datetime.utcnow()
+        updates = []
+        for key, puuid in puuids.items():
+            expires = now + (PUUID_TTL if puuid is not None else NOT_FOUND_TTL)
+            self.puuid_cache.put((region, key), puuid, expires)
+            updates.append(UpdateOne({"_id": f"{region}:{key}"},
+                                     {"$set": {"puuid": puuid, "expires": expires}},
+                                     upsert=True))
+        self.db_summoners.bulk_write(updates, ordered=False)
+
+    @timed("get_watermarks")
+    def get_watermarks(self, puuids):
+        """
+        Retrieves the point up to which the match lists of the players were crawled
+
+        Args:
+            puuids (list(str)): the PUUIDs of the players
+
+        Returns:
+            dict: puuid -> {'time': epoch seconds from which to ask the match list,
+                            'match': id of the newest match seen}
+                  for the players that were already crawled
+        """
+        return {doc['_id']: {'time': doc['time'], 'match': doc['match']}
+                for doc in self.db_watermarks.find({'_id': {'$in': puuids}})}
+
+    @timed("set_watermarks")
+    def set_watermarks(self, watermarks):
+        """
+        Stores the watermarks of the players
+
+        Args:
+            watermarks (dict): puuid -> watermark, see get_watermarks
+        """
+        if watermarks:
+            self.db_watermarks.bulk_write([UpdateOne({'_id': puuid}, {'$set': watermark}, upsert=True)
+                                           for puuid, watermark in watermarks.items()],
+                                          ordered=False)
+
+    def publish_metrics(self):
+        """
+        Stores the metrics of this process, so that the web app can serve them
+        """
+        publish(self.db_metrics, self.worker_id)
 
     def count_matches(self):
         return self.db_matches.count_documents({})
 
+    def last_updated(self):
+        """
+        Returns:
+            str: when a match was last rebuilt by reprocess in ISO format, None if none was
+        """
+        doc = self.db_matches.find_one({'updated': {'$exists': True}}, {'updated': 1},
+                                       sort=[('updated', DESCENDING)])
+        return doc['updated'].isoformat() if doc else None
+
     def get_rediti(self):
         return self.db_rediti.find({}, {'_id': 0})
 
-    def create_matches_csv(self, filename="matches.csv"):
-        command_mongoexport = 'mongoexport --uri='\
-            + self.db_url \
-            + '/mooncaker --collection=matches --type=csv --fields=' \
-            + '_id,region,duration,patch,winner,team1.teamId,' \
-            + 'team1.bans.0,team1.bans.1,team1.bans.2,team1.bans.3,' \
-            + 'team1.bans.4,team1.TOP.summonerId,team1.TOP.champion,' \
-            + 'team1.JUNGLE.summonerId,team1.JUNGLE.champion,' \
-            + 'team1.MID.summonerId,team1.MID.champion,team1.ADC.summonerId' \
-            + ',team1.ADC.champion,team1.SUPPORT.summonerId,' \
-            + 'team1.SUPPORT.champion,team2.teamId,team2.bans.0,' \
-            + 'team2.bans.1,team2.bans.2,team2.bans.3,team2.bans.4,' \
-            + 'team2.TOP.summonerId,team2.TOP.champion,' \
-            + 'team2.JUNGLE.summonerId,team2.JUNGLE.champion,' \
-            + 'team2.MID.summonerId,team2.MID.champion,team2.ADC.summonerId' \
-            + ',team2.ADC.champion,team2.SUPPORT.summonerId,' \
-            + f'team2.SUPPORT.champion --out="{filename}"'
-        os.system(f'rm "{filename}"')
-        os.system(command_mongoexport)
-        return os.path.join(os.getcwd(), filename)
+    def export_matches_csv(self, region=None, min_patch=None, max_patch=None, since=None):
+        """
+        Streams the matches as a gzip compressed csv, see csv_export.export_matches for the filters
+
+        Returns:
+            generator(bytes): the compressed csv
+
+        Raises:
+            ValueError: if a patch bound is not a patch
+        """
+        return export_matches(self.db_matches, region, min_patch, max_patch, since)
+
+    def query_matches(self, fields=None, limit=QUERY_LIMIT, **filters):
+        """
+        Finds a page of matches in the order of their ids, the next page starts after the last id of this one
+
+        Args:
+            fields (list(str), optional): the fields returned, see match_query.query_projection. Defaults to None.
+            limit (int, optional): the most matches returned, up to QUERY_MAX_LIMIT. Defaults to QUERY_LIMIT.
+            **filters: see match_query.match_query, e.g. region="euw1", patch="11.14", champion=64, role="JUNGLE"
+
+        Returns:
+            (list(dict), str): the matches and the after of the next page, None if this is the last one
+
+        Raises:
+            ValueError: if a filter or a field is not valid
+        """
+        if not 0 < limit <= QUERY_MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {QUERY_MAX_LIMIT}")
+        query = match_query(lambda: self.db_matches.distinct("patch"), **filters)
+        # one more match tells whether there is a next page
+        matches = list(self.db_matches.find(query, query_projection(fields), sort=[('_id', ASCENDING)],
+                                            limit=limit + 1))
+        if len(matches) > limit:
+            return matches[:limit], matches[limit - 1]['_id']
+        return matches, None
+
+    def create_matches_csv(self, filename, **filters):
+        """
+        Writes the matches to a gzip compressed csv file, one chunk at a time
+
+        Args:
+            filename (str): the path of the file, e.g. in a temporary directory
+            **filters: see export_matches_csv
+
+        Returns:
+            str: the absolute path of the file
+        """
+        with open(filename, "wb") as csv_file:
+            for chunk in self.export_matches_csv(**filters):
+                csv_file.write(chunk)
+        return os.path.abspath(filename)
@@ -0,0 +1,211 @@
+"""
+    Keeps the gzip compressed csv of all the matches on disk, brought up to date by appending the matches
+    stored since it was built, so that repeated downloads don't read the whole collection again.
+    It is built again when matches were deleted or rebuilt by reprocess.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from logging import INFO
+from threading import Lock
+from pymongo import ASCENDING, DESCENDING
+from .csv_export import EXPORT_BATCH_SIZE, PROJECTION, csv_chunks, gzip_stream
+from .logger import log as log_raw
+
+
+log = partial(log_raw, "export_cache")
+EXPORT_CACHE_DIR = "export-cache"
+EXPORT_NAME = "matches.csv.gz"
+# the state of the cached export, replaced with the export it describes
+META = "matches.json"
+# locked by the process reading or updating the export, the web app workers and the bot share the directory
+LOCK = "matches.lock"
+
+
+class ExportCache():
+    """
+    The csv export of every match, ordered by id when built and followed by one gzip member for each batch
+    of matches appended since. Every version is a new file, so that a download in progress is never changed,
+    identified by an ETag that changes with the rows it holds and the last match stored.
+    The previous version is removed only by the next update, a process that has just been given it
+    has the time of a whole update to open it.
+    """
+
+    def __init__(self, database, directory=EXPORT_CACHE_DIR):
+        """
+        Args:
+            database (Database): the database holding the matches
+            directory (str, optional): where the export is kept, shared by every process serving it.
+                                       Defaults to EXPORT_CACHE_DIR.
+        """
+        self.database = database
+        self.directory = os.path.abspath(directory)
+        self.lock = Lock()
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the lock of the directory, against the threads of this process and the other processes
+        """
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, LOCK), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_meta(self):
+        try:
+            with open(os.path.join(self.directory, META)) as meta_file:
+                meta = json.load(meta_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta if os.path.exists(meta['path']) else None
+
+    def write_meta(self, meta):
+        tmp_path = os.path.join(self.directory, f"{META}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_path, os.path.join(self.directory, META))
+
+    def last_stored(self):
+        """
+        Returns:
+            str: when the last match was stored in ISO format, None if no match recorded it
+        """
+        doc = self.database.db_matches.find_one({'stored': {'$exists': True}}, {'stored': 1},
+                                                sort=[('stored', DESCENDING)])
+        return doc['stored'].isoformat() if doc else None
+
+    def last_updated(self):
+        return self.database.last_updated()
+
+    def consistent(self, meta):
+        """
+        Checks that the export holds every match stored up to its last one, which is not the case
+        if matches were deleted, rebuilt by reprocess or committed late by a crawler
+        """
+        matches = self.database.db_matches
+        total = matches.estimated_document_count()
+        if meta['last_stored'] is None:
+            newer = matches.count_documents({'stored': {'$exists': True}})
+        else:
+            newer = matches.count_documents({'stored': {'$gt': datetime.fromisoformat(meta['last_stored'])}})
+        return meta['rows'] == total - newer
+
+    def write(self, chunks, base=None):
+        """
+        Writes a new version of the export, the given one followed by the chunks
+
+        Returns:
+            str: the path of the new version
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as export_file:
+            if base is not None:
+                with open(base, "rb") as base_file:
+                    shutil.copyfileobj(base_file, export_file)
+            for chunk in chunks:
+                export_file.write(chunk)
+        return tmp_path
+
+    def update(self, meta, until, updated=None):
+        """
+        Builds the export again if meta is None, otherwise appends the matches stored after it up to until
+
+        Args:
+            meta (dict): the state of the export to append to, None to build it again
+            until (str): when the last match to export was stored in ISO format,
+                         None if no match recorded it, then the export is built again
+            updated (str, optional): when a match was last rebuilt, see last_updated. Defaults to None.
+
+        Returns:
+            dict: the state of the new export
+        """
+        if until is None:
+            meta = None  # there is no stored time to append after
+        # the matches stored later, or still being written, are left to the next update
+        query = {'stored': {'$not': {'$gt': datetime.fromisoformat(until)}}} if until else {}
+        if meta is not None:
+            query['stored'] = {'$gt': datetime.fromisoformat(meta['last_stored']),
+                               '$lte': datetime.fromisoformat(until)}
+        docs = self.database.db_matches.find(query, PROJECTION, sort=[('_id', ASCENDING)],
+                                             batch_size=EXPORT_BATCH_SIZE)
+        counts = {"rows": 0}
+
+        def counted(docs):
+            for doc in docs:
+                counts["rows"] += 1
+                yield doc
+
+        tmp_path = self.write(gzip_stream(csv_chunks(counted(docs), header=meta is None)),
+                              None if meta is None else meta['path'])
+        total = counts["rows"] + (0 if meta is None else meta['rows'])
+        etag = hashlib.sha1(f"{total}:{until}:{updated}:{os.path.basename(tmp_path)}".encode()).hexdigest()[:20]
+        path = os.path.join(self.directory, f"matches-{etag}.csv.gz")
+        os.replace(tmp_path, path)
+        new_meta = {'path': path, 'etag': etag, 'rows': total, 'last_stored': until, 'last_updated': updated,
+                    'size': os.path.getsize(path), 'file_id': None}
+        self.write_meta(new_meta)
+        if meta is not None:
+            log(INFO, "Appended %d matches to the export", counts['rows'])
+        else:
+            log(INFO, "Built the export of %d matches", total)
+        return new_meta
+
+    def current(self):
+        """
+        Returns the export of every match, appending the matches stored since the cached one was updated,
+        or building it again when it misses some or some were rebuilt since
+
+        Returns:
+            dict: the path of the export, its ETag, rows, size and Telegram file_id if it was uploaded
+        """
+        with self.locked():
+            previous = self.read_meta()
+            until = self.last_stored()
+            updated = self.last_updated()
+            if (previous is None or not self.consistent(previous)
+                    or previous.get('last_updated') != updated
+                    or (until is None) != (previous['last_stored'] is None)):
+                meta = self.update(None, until, updated)
+            elif until != previous['last_stored']:
+                meta = self.update(previous, until, updated)
+            else:
+                return previous
+            self.remove_old_versions([meta['path']] + ([previous['path']] if previous is not None else []))
+            return meta
+
+    def remove_old_versions(self, keep):
+        """
+        Removes the versions of the export but the ones to keep, and what a process stopped while
+        writing left behind. Called with the lock held, no other process is writing.
+        """
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if ((name.startswith("matches-") and name.endswith(".csv.gz") and path not in keep)
+                    or name.endswith(".tmp")):
+                # a download of an old version keeps its open file
+                os.remove(path)
+
+    def set_file_id(self, etag, file_id):
+        """
+        Remembers the Telegram file_id of a version of the export, as long as it's the current one
+
+        Args:
+            etag (str): the ETag of the version uploaded
+            file_id (str): the id of the file on the Telegram servers
+        """
+        with self.locked():
+            meta = self.read_meta()
+            if meta is not None and meta['etag'] == etag:
+                meta['file_id'] = file_id
+                self.write_meta(meta)
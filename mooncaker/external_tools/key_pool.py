@@ -0,0 +1,108 @@
+"""
+    A pool of riot api keys, each with its own watcher and rate limiter, so that the crawl
+    keeps going on the other keys when one expires and gets faster with every key added
+"""
+import time
+from functools import partial
+from itertools import count
+from logging import DEBUG, INFO, WARNING
+from threading import Lock
+from .metrics import metrics
+from .logger import log as log_raw
+
+
+log = partial(log_raw, "keypool")
+KEY_POLL_EVERY = 1  # seconds between two checks for keys added by the admins
+
+
+class KeyPool():
+    """
+    Hands out, for every call, the watcher of the key that can make it the soonest,
+    ties going to the keys in turn. A key answered with a 403 is retired;
+    only when no key is left the caller waits for a new one.
+    """
+
+    def __init__(self, make_watcher, get_key_blocking, poll_new_keys=None):
+        """
+        Args:
+            make_watcher (callable): creates the watcher and the rate limiter of a key,
+                                     returned as (watcher, rate_limiter)
+            get_key_blocking (callable): called (and waited on) when the pool is empty
+            poll_new_keys (callable, optional): returns the keys added since the last call, without
+                                                waiting. Defaults to None, keys come only from get_key_blocking.
+        """
+        self.make_watcher = make_watcher
+        self.get_key_blocking = get_key_blocking
+        self.poll_new_keys = poll_new_keys
+        self.keys = {}  # key -> (watcher, rate limiter)
+        self.lock = Lock()
+        self.refill_lock = Lock()
+        self.turn = count()
+        self.polled_at = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        """
+        Adds a key to the pool, a key already in it keeps its watcher and its budget
+        """
+        with self.lock:
+            if key in self.keys:
+                return
+            self.keys[key] = self.make_watcher(key)
+            size = len(self.keys)
+        metrics.set("mooncaker_api_keys", size)
+        log(INFO, "Added the api key ending with %s, %d keys in the pool", key[-5:], size)
+
+    def retire(self, watcher):
+        """
+        Removes the key of the given watcher, if it wasn't removed already
+
+        Returns:
+            bool: True if the key was in the pool
+        """
+        with self.lock:
+            stale = [key for key, (key_watcher, _) in self.keys.items() if key_watcher is watcher]
+            for key in stale:
+                del self.keys[key]
+            size = len(self.keys)
+        if stale:
+            metrics.set("mooncaker_api_keys", size)
+            log(WARNING, "Retired the api key ending with %s, %d keys left in the pool", stale[0][-5:], size)
+        return bool(stale)
+
+    def poll(self):
+        if self.poll_new_keys is None or time.monotonic() - self.polled_at < KEY_POLL_EVERY:
+            return
+        self.polled_at = time.monotonic()
+        for key in self.poll_new_keys():
+            self.add(key)
+
+    def wait_for_key(self):
+        """
+        Blocks until the pool has a key. When several threads find the pool empty
+        only the first one asks for a key, the others find it added and go on.
+        """
+        with self.refill_lock:
+            while not self.keys:
+                log(DEBUG, "The key pool is empty, going to possibly hang while waiting new api key")
+                self.add(self.get_key_blocking())
+
+    def watcher(self, region, endpoint_name, method_name):
+        """
+        Returns:
+            LolWatcher: the watcher of the key whose rate limits allow the call the soonest
+        """
+        self.poll()
+        while True:
+            with self.lock:
+                entries = list(self.keys.values())
+            if entries:
+                break
+            self.wait_for_key()
+        # rotating the keys spreads the calls when several of them are free
+        start = next(self.turn) % len(entries)
+        entries = entries[start:] + entries[:start]
+        watcher, _ = min(entries, key=lambda entry: entry[1].next_free(region, endpoint_name, method_name))
+        return watcher
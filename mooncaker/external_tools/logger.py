@@ -1,21 +1,229 @@
+"""
+    The log of every mooncaker process. A record is put on an in-memory queue by the caller and formatted
+    and written by a listener thread of the process, so that no api call waits on the file.
+    The file is rotated once it reaches LOG_MAX_BYTES, it is read from its end or from an offset.
+"""
+import atexit
+import itertools
 import logging
-from os import getcwd, path
+import os
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from multiprocessing import util
+from os import environ, path
+from queue import Queue
+from threading import Lock
 from . import LOGGER_NAME, LOG_FILENAME
 
 
-# app.config['LOG_FILENAME'] = LOG_FILENAME
-handler = logging.FileHandler(LOG_FILENAME)
-handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+LOG_FORMAT = '%(asctime)s %(levelname)-8s %(domain)s: %(message)s'
+# the log and its backups never take more than LOG_MAX_BYTES * (LOG_BACKUPS + 1)
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+# bytes read at a time from the end of the log to tail it
+TAIL_BLOCK_SIZE = 64 * 1024
+# bytes read at most by each read of a follower of the log
+READ_MAX_BYTES = 1024 * 1024
 logger = logging.getLogger(LOGGER_NAME)
 logger.setLevel(logging.DEBUG)
-logger.addHandler(handler)
+# domain -> logger, the level of each domain can be set on its own
+domain_loggers = {}
+# (domain, text) -> count of the calls of a sampled message
+sampled = {}
+listener = None
+listener_pid = None
+listener_lock = Lock()
 
 
-def log(domain, level: int, text):
-    logger.log(level=level, msg=f"{domain}: "
-               + text)
+class DomainFormatter(logging.Formatter):
+    def format(self, record):
+        record.domain = record.name[len(LOGGER_NAME) + 1:]
+        return super().format(record)
 
 
-def get_log():
-    with open(path.join(getcwd(), LOG_FILENAME)) as logfile:
-        return logfile.readlines()
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """
+    A RotatingFileHandler for a file written by several processes, each with its own handler:
+    when another process rotated the file, it opens the new one instead of rotating it again
+    """
+
+    def shouldRollover(self, record):
+        if self.stream is not None:
+            try:
+                rotated = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = True
+            if rotated:
+                self.stream.close()
+                self.stream = self._open()
+        return super().shouldRollover(record)
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Puts the records on the queue as they are, the listener thread formats them.
+    The arguments of a message must not be changed after it is logged.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def stop_listener():
+    # writes what is left in the queue, both at exit and when a multiprocessing child ends
+    global listener, listener_pid
+    with listener_lock:
+        if listener is not None and listener_pid == os.getpid():
+            listener.stop()
+            listener.handlers[0].close()
+        listener = listener_pid = None
+
+
+def start_listener():
+    """
+    Starts the listener thread of this process, the ones of the parent are not copied by a fork
+    """
+    global listener, listener_pid
+    with listener_lock:
+        if listener_pid == os.getpid():
+            return
+        for handler in list(logger.handlers):
+            if isinstance(handler, QueueHandler):
+                logger.removeHandler(handler)
+        file_handler = SharedRotatingFileHandler(log_path(), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS,
+                                                 delay=True)
+        file_handler.setFormatter(DomainFormatter(LOG_FORMAT))
+        queue = Queue()
+        listener = QueueListener(queue, file_handler)
+        listener.start()
+        listener_pid = os.getpid()
+        logger.addHandler(LazyQueueHandler(queue))
+    atexit.register(stop_listener)
+    util.Finalize(None, stop_listener, exitpriority=0)
+
+
+def domain_logger(domain):
+    domain_log = domain_loggers.get(domain)
+    if domain_log is None:
+        domain_log = domain_loggers[domain] = logging.getLogger(f"{LOGGER_NAME}.{domain}")
+    return domain_log
+
+
+def set_levels(levels):
+    """
+    Sets the level of some domains, the others log everything
+
+    Args:
+        levels (str): space or comma separated domain=LEVEL pairs, e.g. "datacrawler=WARNING database=INFO"
+    """
+    for pair in levels.replace(",", " ").split():
+        domain, _, level = pair.partition("=")
+        domain_logger(domain).setLevel(level.upper())
+
+
+def log(domain, level: int, text, *args, every=1):
+    """
+    Logs a message, formatted with the % operator only if its level is enabled
+
+    Args:
+        domain (str): the part of mooncaker logging, e.g. datacrawler
+        level (int): the level of the message
+        text (str): the message, with a %s for each argument
+        *args: the arguments of the message
+        every (int, optional): only one in every such calls of the same message is logged,
+                               for the messages of every api call. Defaults to 1.
+    """
+    domain_log = domain_logger(domain)
+    if not domain_log.isEnabledFor(level):
+        return
+    if every > 1:
+        counter = sampled.get((domain, text)) or sampled.setdefault((domain, text), itertools.count())
+        if next(counter) % every:
+            return
+    if listener_pid != os.getpid():
+        start_listener()
+    domain_log.log(level, text, *args)
+
+
+def log_path():
+    """
+    Returns:
+        str: the absolute path of the log, set by the mooncaker-log environment variable,
+             LOG_FILENAME in the current directory otherwise
+    """
+    return path.abspath(environ.get("mooncaker-log", LOG_FILENAME))
+
+
+def tail_log(n_lines, filename=None):
+    """
+    Reads the last lines of the log backwards from its end, a block at a time,
+    in a time that depends on the lines asked for and not on the size of the log
+
+    Args:
+        n_lines (int): how many lines
+        filename (str, optional): the log. Defaults to None, the one of mooncaker.
+
+    Returns:
+        list(str): the lines, oldest first
+    """
+    if n_lines <= 0:
+        return []
+    try:
+        log_file = open(filename or log_path(), "rb")
+    except FileNotFoundError:
+        return []
+    with log_file:
+        position = log_file.seek(0, os.SEEK_END)
+        blocks = []
+        newlines = 0
+        # the first line of the blocks may be cut, one more newline than the lines asked for is needed
+        while position > 0 and newlines <= n_lines:
+            size = min(TAIL_BLOCK_SIZE, position)
+            position -= size
+            log_file.seek(position)
+            blocks.append(log_file.read(size))
+            newlines += blocks[-1].count(b"\n")
+    data = b"".join(reversed(blocks))
+    return [line.decode("utf-8", errors="replace") for line in data.splitlines(keepends=True)[-n_lines:]]
+
+
+def log_position(filename=None):
+    """
+    Returns:
+        (int, int): the offset of the end of the log and its inode, to follow it with read_log from now on
+    """
+    try:
+        stat = os.stat(filename or log_path())
+    except FileNotFoundError:
+        return 0, None
+    return stat.st_size, stat.st_ino
+
+
+def read_log(offset, inode=None, filename=None, max_bytes=READ_MAX_BYTES):
+    """
+    Reads the complete lines written to the log after an offset, to follow it
+
+    Args:
+        offset (int): where the previous read stopped
+        inode (int, optional): the file the previous read was made on, when it's not the log anymore
+                               because the log was rotated the new one is read from its start. Defaults to None.
+        filename (str, optional): the log. Defaults to None, the one of mooncaker.
+        max_bytes (int, optional): the most that is read at once. Defaults to READ_MAX_BYTES.
+
+    Returns:
+        (list(str), int, int): the lines, the offset and the inode to give to the next read
+    """
+    try:
+        log_file = open(filename or log_path(), "rb")
+    except FileNotFoundError:
+        return [], 0, None
+    with log_file:
+        stat = os.fstat(log_file.fileno())
+        if (inode is not None and inode != stat.st_ino) or offset > stat.st_size:
+            offset = 0
+        log_file.seek(offset)
+        data = log_file.read(min(max_bytes, stat.st_size - offset))
+    end = data.rfind(b"\n") + 1
+    if end == 0 and len(data) == max_bytes:
+        end = len(data)  # a line longer than max_bytes comes in pieces
+    lines = data[:end].decode("utf-8", errors="replace").splitlines(keepends=True)
+    return lines, offset + end, stat.st_ino
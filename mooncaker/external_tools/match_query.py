@@ -0,0 +1,123 @@
+"""
+    Filtered and projected queries on the matches collection, paginated on the match id,
+    and the indexes that turn them into index scans
+"""
+from pymongo import ASCENDING
+from .csv_export import PROJECTION, ROLES, export_query, parse_patch
+
+
+TEAMS = ("team1", "team2")
+# matches returned by a query when no limit is given, and at most
+QUERY_LIMIT = 100
+QUERY_MAX_LIMIT = 1000
+# the fields a query can project: the csv columns and every doc or list they are part of
+QUERY_FIELDS = {".".join(field.split(".")[:end]) for field in PROJECTION for end in range(1, field.count(".") + 2)}
+# equality first, then the match id, which is the order of the pages and the bound of the next one.
+# A champion in any role or team is one branch of an $or for each of these.
+CHAMPION_INDEXES = [[(f"{team}.{role}.champion", ASCENDING), ("patch", ASCENDING), ("region", ASCENDING),
+                     ("_id", ASCENDING)] for team in TEAMS for role in ROLES]
+MATCH_INDEXES = [[("region", ASCENDING), ("patch", ASCENDING), ("_id", ASCENDING)],
+                 [("winner", ASCENDING), ("patch", ASCENDING), ("_id", ASCENDING)],
+                 [("duration", ASCENDING)]] + CHAMPION_INDEXES
+# the query string arguments converted to int, every other one is a string
+INT_ARGUMENTS = ("champion", "winner", "min_duration", "max_duration", "limit")
+QUERY_ARGUMENTS = ("region", "patch", "min_patch", "max_patch", "role", "fields", "after") + INT_ARGUMENTS
+
+
+def parse_arguments(arguments):
+    """
+    Converts the arguments of a query given as text, by the REST api or the console
+
+    Args:
+        arguments (dict): name -> value, the ones that are not arguments of a query are ignored
+
+    Returns:
+        dict: the keyword arguments of Database.query_matches
+
+    Raises:
+        ValueError: if a number is not a number
+    """
+    parsed = {}
+    for name in QUERY_ARGUMENTS:
+        value = arguments.get(name)
+        if not value:
+            continue
+        if name in INT_ARGUMENTS:
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError(f"{name} must be a number, not {value}") from None
+        elif name == "fields":
+            value = value.split(",")
+        parsed[name] = value
+    return parsed
+
+
+def match_query(patches, region=None, patch=None, min_patch=None, max_patch=None, champion=None, role=None,
+                winner=None, min_duration=None, max_duration=None, after=None):
+    """
+    Builds the filter of a query, every argument is optional
+
+    Args:
+        patches (callable): returns the distinct patches of the matches collection, only called for a range
+        region (str, optional): the region of the matches. Defaults to None.
+        patch (str, optional): the patch of the matches. Defaults to None.
+        min_patch (str, optional): this patch or a later one, compared as versions. Defaults to None.
+        max_patch (str, optional): this patch or an earlier one, compared as versions. Defaults to None.
+        champion (int, optional): a champion played by either team. Defaults to None.
+        role (str, optional): the role the champion was played in, e.g. JUNGLE. Defaults to None, any.
+        winner (int, optional): the teamId of the winning team, 100 or 200. Defaults to None.
+        min_duration (int, optional): the shortest duration, in seconds. Defaults to None.
+        max_duration (int, optional): the longest duration, in seconds. Defaults to None.
+        after (str, optional): the last match id of the previous page. Defaults to None.
+
+    Returns:
+        dict: the Mongo filter
+
+    Raises:
+        ValueError: if a patch is not a patch, the role is unknown or given without a champion
+    """
+    if patch:
+        parse_patch(patch)
+        min_patch = max_patch = None
+    query = export_query(patches() if min_patch or max_patch else (), region, min_patch, max_patch, after)
+    if patch:
+        query['patch'] = patch
+    if role is not None:
+        if champion is None:
+            raise ValueError("a role needs a champion")
+        if role.upper() not in ROLES:
+            raise ValueError(f"{role} is not a role, one of {', '.join(ROLES)}")
+    if champion is not None:
+        roles = (role.upper(),) if role else ROLES
+        query['$or'] = [{f"{team}.{played}.champion": champion} for team in TEAMS for played in roles]
+    if winner is not None:
+        query['winner'] = winner
+    if min_duration is not None or max_duration is not None:
+        query['duration'] = {}
+        if min_duration is not None:
+            query['duration']['$gte'] = min_duration
+        if max_duration is not None:
+            query['duration']['$lte'] = max_duration
+    return query
+
+
+def query_projection(fields=None):
+    """
+    Args:
+        fields (list(str), optional): dotted paths like team1.JUNGLE or duration. Defaults to None,
+                                      the columns of the csv export.
+
+    Returns:
+        dict: the Mongo projection, the match id is always returned
+
+    Raises:
+        ValueError: if a field is not part of the matches
+    """
+    if not fields:
+        return PROJECTION
+    unknown = [field for field in fields if field not in QUERY_FIELDS]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    # Mongo refuses a path along with one of its parents
+    return {field: 1 for field in fields if not any(field.startswith(f"{other}.") for other in fields)}
@@ -0,0 +1,178 @@
+"""
+    Counters, gauges and latency histograms of the crawler.
+    Each crawler process keeps its own and publishes them in the metrics collection,
+    where the web app reads them to expose them in the Prometheus text format.
+"""
+import time
+from bisect import bisect_left
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+from .mongo_client import get_database
+
+
+# upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# how often a crawler publishes its metrics
+METRICS_PUBLISH_EVERY = 15
+STALE_AFTER = 5 * METRICS_PUBLISH_EVERY
+HELP = {"mooncaker_api_requests_total": "Calls to the riot api by endpoint, region and status code",
+        "mooncaker_api_request_seconds": "Latency of the calls to the riot api, rate limiter waits included",
+        "mooncaker_api_retries_total": "Calls to the riot api that were retried",
+        "mooncaker_api_429_sleep_seconds_total": "Seconds slept after a 429",
+        "mooncaker_db_operation_seconds": "Latency of the database operations",
+        "mooncaker_matches_stored_total": "Match docs stored",
+        "mooncaker_matches_duplicate_total": "Match docs that were already stored",
+        "mooncaker_pipeline_queue_depth": "Items waiting in front of each stage of the crawl pipeline",
+        "mooncaker_api_keys": "Api keys in the pool of the crawler"}
+
+
+class Metrics():
+    """
+    A thread safe registry of counters, gauges and histograms, each identified
+    by its name and its labels
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = Metrics.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = Metrics.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = Metrics.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+            histogram = self.histograms[key]
+            histogram['buckets'][bisect_left(LATENCY_BUCKETS, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        """
+        Returns:
+            list(dict): every metric with its type, name, labels and value(s), ready to be stored in Mongo
+        """
+        with self.lock:
+            return ([{'type': 'counter', 'name': name, 'labels': dict(labels), 'value': value}
+                     for (name, labels), value in self.counters.items()]
+                    + [{'type': 'gauge', 'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in self.gauges.items()]
+                    + [{'type': 'histogram', 'name': name, 'labels': dict(labels),
+                        'buckets': list(histogram['buckets']), 'sum': histogram['sum'], 'count': histogram['count']}
+                       for (name, labels), histogram in self.histograms.items()])
+
+
+metrics = Metrics()
+
+
+def timed(operation):
+    """
+    Decorator recording the latency of a database operation
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe("mooncaker_db_operation_seconds", time.perf_counter() - start,
+                                operation=operation)
+        return wrapper
+    return decorator
+
+
+def publish(collection, worker_id, snapshot=None):
+    """
+    Stores the metrics of this process under its worker id
+
+    Args:
+        collection (pymongo.collection.Collection): the metrics collection
+        worker_id (str): identifies the crawler process
+        snapshot (list(dict), optional): the metrics to store. Defaults to the ones of this process.
+    """
+    collection.replace_one({'_id': worker_id},
+                           {'_id': worker_id, 'updated': datetime.utcnow(),
+                            'metrics': snapshot if snapshot is not None else metrics.snapshot()},
+                           upsert=True)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in sorted(labels.items())) + "}"
+
+
+def render(snapshots):
+    """
+    Merges the metrics published by the crawlers, summing counters and histograms
+    and keeping gauges apart by worker, in the Prometheus text format
+
+    Args:
+        snapshots (list(dict)): the docs of the metrics collection
+
+    Returns:
+        str: the text to serve at /metrics
+    """
+    merged = {}
+    for doc in snapshots:
+        # the counters of a stopped crawler still count, its gauges are not true anymore
+        is_stale = (datetime.utcnow() - doc['updated']).total_seconds() > STALE_AFTER
+        for metric in doc['metrics']:
+            labels = dict(metric['labels'])
+            if metric['type'] == 'gauge':
+                if is_stale:
+                    continue
+                labels['worker'] = doc['_id']
+            key = (metric['name'], metric['type'], tuple(sorted(labels.items())))
+            if key not in merged:
+                merged[key] = dict(metric, labels=labels)
+            elif metric['type'] == 'counter':
+                merged[key]['value'] += metric['value']
+            elif metric['type'] == 'histogram':
+                merged[key] = dict(merged[key],
+                                   buckets=[a + b for a, b in zip(merged[key]['buckets'], metric['buckets'])],
+                                   sum=merged[key]['sum'] + metric['sum'],
+                                   count=merged[key]['count'] + metric['count'])
+    lines = []
+    described = set()
+    for (name, kind, _), metric in sorted(merged.items(), key=lambda item: item[0]):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+        labels = metric['labels']
+        if kind != 'histogram':
+            lines.append(f"{name}{format_labels(labels)} {metric['value']}")
+            continue
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], metric['buckets']):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {metric['sum']}")
+        lines.append(f"{name}_count{format_labels(labels)} {metric['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def read_metrics(db_url):
+    """
+    Returns:
+        str: the metrics published by every crawler using the database, in the Prometheus text format
+    """
+    return render(get_database(db_url).get_collection("metrics").find())
@@ -0,0 +1,61 @@
+"""
+    One Mongo client per process and database url, shared by every Database, raw store and metrics reader
+"""
+import os
+from threading import Lock
+from urllib.parse import urlsplit
+from pymongo import MongoClient
+
+
+DB_NAME = "mooncaker"
+# connection pool settings, used unless the url sets them
+CLIENT_OPTIONS = {"maxPoolSize": 50,
+                  "minPoolSize": 0,
+                  "maxIdleTimeMS": 5 * 60 * 1000,
+                  "connectTimeoutMS": 10 * 1000,
+                  "serverSelectionTimeoutMS": 10 * 1000}
+clients = {}
+clients_lock = Lock()
+
+
+def forget_clients():
+    # the clients of the parent process can't be used after a fork, nor its lock trusted
+    global clients_lock
+    clients.clear()
+    clients_lock = Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=forget_clients)
+
+
+def get_client(db_url):
+    """
+    Returns the client of this process for the given url, created on first use without connecting.
+    The pid is part of the key, so that a process started after the client was created,
+    even without a fork, never uses it.
+
+    Args:
+        db_url (str): the url of the Mongo DB
+
+    Returns:
+        pymongo.MongoClient: the client
+    """
+    key = (os.getpid(), db_url)
+    client = clients.get(key)
+    if client is None:
+        with clients_lock:
+            if key not in clients:
+                query = urlsplit(db_url).query.lower()
+                options = {name: value for name, value in CLIENT_OPTIONS.items() if f"{name.lower()}=" not in query}
+                clients[key] = MongoClient(db_url, connect=False, **options)
+            client = clients[key]
+    return client
+
+
+def get_database(db_url):
+    """
+    Returns:
+        pymongo.database.Database: the mooncaker database at the given url
+    """
+    return get_client(db_url).get_database(DB_NAME)
@@ -1,13 +1,16 @@
 from functools import partial
+from io import BytesIO
 from os import getcwd, path, remove
 import os
+from tempfile import TemporaryDirectory
 import requests
 from telegram import Update, ForceReply, Sticker, InlineKeyboardButton, \
     InlineKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, \
     CallbackContext, CallbackQueryHandler, ConversationHandler
-from mooncaker.external_tools.logger import get_log
+from mooncaker.external_tools.logger import log_path, tail_log
 from mooncaker.external_tools.db_interactor import Database
+from mooncaker.external_tools.export_cache import ExportCache, EXPORT_CACHE_DIR
 
 
 class MooncakerBot:
@@ -18,13 +21,15 @@ class MooncakerBot:
     NAME_TO_STICKER = {name: Sticker(name, name, 512, 512, False) for name in
                        [SAD_ZOE, MEGUMIN_THUMB_UP, PARTY_GIRL, LOLI]}
 
-    def __init__(self, token, set_api, whitelist, db_url, reminder_chat_id, client_user):
+    def __init__(self, token, set_api, whitelist, db_url, reminder_chat_id, client_user,
+                 export_cache_dir=EXPORT_CACHE_DIR):
         """
             Initializes the bot, stores the telegram token, connects to the
             database and saves the url of the log and
             the function to call when setting a new api_key
         """
         self.db = Database(db_url)
+        self.export_cache = ExportCache(self.db, export_cache_dir)
         self.token = token
         self.set_api = set_api
         self.whitelist = whitelist
@@ -93,36 +98,53 @@ class MooncakerBot:
 
     def send_log(self, update: Update, context: CallbackContext, n_lines=0):
         """
-        Dispatcher for the commands which have to retrieve the log. Retrieves the whole log if the argument lines is
-        None, otherwise it returns the last n_lines lines of the log.
+        Dispatcher for the commands which have to retrieve the log. Retrieves the whole log if the number of lines
+        in the message, or n_lines without one, is 0, otherwise it returns the last lines of the log.
         """
-        log = get_log()
-        n_lines = int(update.message.text) if update.message.text.isnumeric() else 0
-        with open("tmp.txt", "a") as log2send:
-            log2send.writelines(log[-n_lines:])
-        with open("tmp.txt", "r") as log2send:
+        n_lines = int(update.message.text) if update.message.text.isnumeric() else n_lines
+        if n_lines > 0:
+            lines = tail_log(n_lines)
+            if not lines:
+                update.message.reply_text("no log yet")
+                return ConversationHandler.END
+            context.bot.send_document(chat_id=update.effective_chat.id,
+                                      document=BytesIO("".join(lines).encode("utf-8")),
+                                      filename="mooncaker.log")
+            return ConversationHandler.END
+        try:
+            # rotated, it's never larger than LOG_MAX_BYTES
+            log2send = open(log_path(), "rb")
+        except FileNotFoundError:
+            # not written yet, or just rotated
+            update.message.reply_text("no log yet")
+            return ConversationHandler.END
+        with log2send:
             context.bot.send_document(chat_id=update.effective_chat.id,
                                       document=log2send,
                                       filename="mooncaker.log")
-        os.system('rm tmp.txt')
         return ConversationHandler.END
 
     def get_csv(self, update: Update, context: CallbackContext):
         """
-        Generates and sends csv file for matches collection. Since telegram bots are limited to sending at most 
+        Generates and sends the gzip compressed csv file of the matches collection. Since telegram bots are limited to sending at most 
         50 MB files, the file is first sent by a Client (not bot instance) of Telegram to the bot, then sent by 
         their file_id in the Telegram server to the requiring user, except the case of the requiring user being
-        the user which is used for the Client instance. 
-        """
-        matches_filename = self.db.create_matches_csv()
-        update.message.reply_text("Oki! sending you the csv! \n It may take a while, so hang on please! \n File size is: " + str(round(os.stat(matches_filename).st_size/(1024**2), 2)) + " MB")
-        os.system(f'telegram-upload --to Mooncaker_bot --print-file-id "{matches_filename}" > tmp.txt')
-        with open('tmp.txt') as tmp:
-            tmp_file = tmp.read()
-            file_id = tmp_file.split("file_id ", 1)[1].strip().replace(')', '')
-        os.system('rm tmp.txt')
-        if update.effective_user.username != self.client_user:
-            context.bot.send_document(chat_id=update.effective_chat.id, document=file_id)
+        the user which is used for the Client instance. The file_id is reused until a match is added.
+        """
+        export = self.export_cache.current()
+        file_id = export['file_id']
+        if file_id is None:
+            update.message.reply_text("Oki! sending you the csv! \n It may take a while, so hang on please! \n File size is: " + str(round(export['size']/(1024**2), 2)) + " MB")
+            # every request gets its own directory, concurrent ones don't overwrite each other's output
+            with TemporaryDirectory() as tmp_dir:
+                os.system(f'telegram-upload --to Mooncaker_bot --print-file-id "{export["path"]}" > "{tmp_dir}/tmp.txt"')
+                with open(path.join(tmp_dir, 'tmp.txt')) as tmp:
+                    tmp_file = tmp.read()
+                    file_id = tmp_file.split("file_id ", 1)[1].strip().replace(')', '')
+            self.export_cache.set_file_id(export['etag'], file_id)
+            if update.effective_user.username == self.client_user:
+                return  # the Client already sent it to the bot chat
+        context.bot.send_document(chat_id=update.effective_chat.id, document=file_id)
 
     def set_api_key_req(self, update: Update, context: CallbackContext) -> int:
         """
@@ -0,0 +1,177 @@
+"""
+    Client side rate limiting for the riot api, driven by the rate limit headers of the responses
+"""
+import datetime
+import time
+from bisect import insort
+from threading import Lock
+from riotwatcher import RateLimiter
+
+
+# limits of a development key, used until riot tells us the real ones
+DEFAULT_APP_LIMITS = "20:1,100:120"
+
+
+def parse_limits(header):
+    """
+    Parses a rate limit header of the form "20:1,100:120"
+
+    Args:
+        header (str): the value of the header
+
+    Returns:
+        dict: window in seconds -> number of requests
+    """
+    limits = {}
+    for limit in header.split(","):
+        requests, window = limit.split(":")
+        limits[int(window)] = int(requests)
+    return limits
+
+
+class TokenBucket():
+    """
+    A bucket holding `limit` tokens that are given back `window` seconds after being spent.
+    The bucket remembers when each token was (or is going to be) spent, so that a call
+    can be scheduled in the future instead of being rejected.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.spent = []
+        self.blocked_until = 0
+
+    def expire(self, now):
+        expired = 0
+        while expired < len(self.spent) and self.spent[expired] <= now - self.window:
+            expired += 1
+        del self.spent[:expired]
+
+    def next_free(self, now):
+        """
+        Returns the first moment, not before now, at which a token can be spent
+        """
+        self.expire(now)
+        free_at = max(now, self.blocked_until)
+        if len(self.spent) >= self.limit:
+            free_at = max(free_at, self.spent[-self.limit] + self.window)
+        return free_at
+
+    def spend(self, when):
+        insort(self.spent, when)
+
+    def sync(self, count, now):
+        """
+        Aligns the bucket with the count reported by riot for the current window,
+        which also includes the requests made with the same key by other tools
+        """
+        self.expire(now)
+        used = sum(1 for when in self.spent if when <= now)
+        for _ in range(count - used):
+            self.spend(now)
+
+
+class HeaderRateLimiter(RateLimiter):
+    """
+    Rate limiter for a single api key, plugged into the riotwatcher handler chain.
+    It keeps a set of token buckets for the application limits of each routing value
+    (euw1, europe, ...) and for the method limits of each (routing value, method) pair,
+    learns the limits and the counts from the X-App-Rate-Limit / X-Method-Rate-Limit headers
+    and delays the calls so that the limits are never exceeded.
+    """
+
+    def __init__(self, reserved=0.0, app_limits=DEFAULT_APP_LIMITS):
+        """
+        Args:
+            reserved (float, optional): fraction of every limit left unused, so that other tools
+                                        can share the same key. Defaults to 0.0.
+            app_limits (str, optional): application limits assumed before the first response,
+                                        in the same format of the header. Defaults to the ones
+                                        of a development key.
+        """
+        self.reserved = reserved
+        self.default_app_limits = parse_limits(app_limits)
+        self.app_buckets = {}
+        self.method_buckets = {}
+        self.lock = Lock()
+
+    def usable(self, limit):
+        return max(1, int(limit * (1 - self.reserved)))
+
+    def buckets(self, region, endpoint_name, method_name):
+        if region not in self.app_buckets:
+            self.app_buckets[region] = [TokenBucket(self.usable(limit), window)
+                                        for window, limit in self.default_app_limits.items()]
+        method_buckets = self.method_buckets.setdefault((region, endpoint_name, method_name), [])
+        return self.app_buckets[region] + method_buckets
+
+    def next_free(self, region, endpoint_name, method_name):
+        """
+        Returns:
+            float: the first moment at which the call could be made, without reserving it
+        """
+        with self.lock:
+            now = time.time()
+            return max([bucket.next_free(now) for bucket in self.buckets(region, endpoint_name, method_name)],
+                       default=now)
+
+    def wait_until(self, region, endpoint_name, method_name):
+        """
+        Reserves a token in every bucket involved in the call
+
+        Returns:
+            datetime.datetime | None: when the call can be made, None if it can be made right away
+        """
+        with self.lock:
+            now = time.time()
+            buckets = self.buckets(region, endpoint_name, method_name)
+            when = max([bucket.next_free(now) for bucket in buckets], default=now)
+            for bucket in buckets:
+                bucket.spend(when)
+        if when > now:
+            return datetime.datetime.fromtimestamp(when)
+        return None
+
+    def update_buckets(self, buckets, limits_header, counts_header, now):
+        """
+        Updates the buckets with the limits and the counts sent by riot
+
+        Returns:
+            list(TokenBucket): the updated buckets, one for each window in the headers
+        """
+        limits = parse_limits(limits_header)
+        counts = parse_limits(counts_header) if counts_header else {}
+        by_window = {bucket.window: bucket for bucket in buckets}
+        updated = []
+        for window, limit in limits.items():
+            bucket = by_window.get(window, TokenBucket(0, window))
+            bucket.limit = self.usable(limit)
+            bucket.sync(counts.get(window, 0), now)
+            updated.append(bucket)
+        return updated
+
+    def record_response(self, region, endpoint_name, method_name, status, headers):
+        with self.lock:
+            now = time.time()
+            self.buckets(region, endpoint_name, method_name)
+            method_key = (region, endpoint_name, method_name)
+            if headers.get("X-App-Rate-Limit"):
+                self.app_buckets[region] = self.update_buckets(self.app_buckets[region],
+                                                               headers["X-App-Rate-Limit"],
+                                                               headers.get("X-App-Rate-Limit-Count"),
+                                                               now)
+            if headers.get("X-Method-Rate-Limit"):
+                self.method_buckets[method_key] = self.update_buckets(self.method_buckets[method_key],
+                                                                      headers["X-Method-Rate-Limit"],
+                                                                      headers.get("X-Method-Rate-Limit-Count"),
+                                                                      now)
+            if status == 429 and headers.get("Retry-After") is not None:
+                # application limits block every method of the routing value,
+                # method and service limits only the method that was called
+                if headers.get("X-Rate-Limit-Type") == "application":
+                    blocked = self.app_buckets[region]
+                else:
+                    blocked = self.method_buckets[method_key] or self.app_buckets[region]
+                for bucket in blocked:
+                    bucket.blocked_until = now + int(headers["Retry-After"])
@@ -0,0 +1,189 @@
+"""
+    Keeps the raw match and timeline payloads received from riot, compressed,
+    so that the match docs can be rebuilt later without asking riot again
+"""
+import hashlib
+import json
+import os
+import zlib
+from pymongo.errors import DuplicateKeyError
+import gridfs
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used when it is missing
+    zstandard = None
+from .mongo_client import get_database
+
+
+# the first byte of a blob tells how the rest of it was compressed
+CODEC_ZLIB = b"z"
+CODEC_ZSTD = b"s"
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+
+
+def compress(payload):
+    """
+    Serializes and compresses a payload, with zstd if available and zlib otherwise
+
+    Args:
+        payload (dict | str): the json returned by riot, decoded or not
+
+    Returns:
+        bytes: the blob to store
+    """
+    if isinstance(payload, str):
+        data = payload.encode()
+    else:
+        data = json.dumps(payload, separators=(",", ":")).encode()
+    if zstandard is not None:
+        return CODEC_ZSTD + zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return CODEC_ZLIB + zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(blob):
+    """
+    Inverse of compress, works with blobs written with either codec
+
+    Args:
+        blob (bytes): a blob created by compress
+
+    Returns:
+        dict: the payload
+    """
+    codec, data = blob[:1], blob[1:]
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("The raw store contains zstd blobs, install zstandard to read them")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif codec == CODEC_ZLIB:
+        data = zlib.decompress(data)
+    else:
+        raise ValueError(f"Unknown raw blob codec {codec!r}")
+    return json.loads(data)
+
+
+class DiskRawStore():
+    """
+    Stores each payload in its own file, under <root>/<platform>/<2 hex digits of the
+    hash of the match id>/<match id>.<kind>, so that no directory grows too much.
+    Match ids never change their content, so a payload already stored is never rewritten.
+    """
+
+    def __init__(self, root):
+        """
+        Args:
+            root (str): the directory holding the store, created if missing
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, match_id, kind):
+        platform = match_id.split("_")[0].lower()
+        bucket = hashlib.sha1(match_id.encode()).hexdigest()[:2]
+        return os.path.join(self.root, platform, bucket, f"{match_id}.{kind}")
+
+    def put(self, match_id, kind, payload):
+        """
+        Args:
+            match_id (str): the match the payload belongs to
+            kind (str): match or timeline
+            payload (dict | str): the json returned by riot, decoded or not
+        """
+        path = self.path(match_id, kind)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and moved, so that a crash never leaves half a blob behind
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as blob_file:
+            blob_file.write(compress(payload))
+        os.replace(temp_path, path)
+
+    def get(self, match_id, kind):
+        """
+        Returns:
+            dict: the payload, None if it was never stored
+        """
+        try:
+            with open(self.path(match_id, kind), "rb") as blob_file:
+                return decompress(blob_file.read())
+        except FileNotFoundError:
+            return None
+
+    def match_ids(self):
+        """
+        Yields the ids of the matches whose match payload is stored
+        """
+        suffix = ".match"
+        for _, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(suffix):
+                    yield filename[:-len(suffix)]
+
+
+class GridFSRawStore():
+    """
+    Stores each payload as a GridFS file named <match id>.<kind>, in the same database of the matches
+    """
+
+    def __init__(self, database, collection="raw"):
+        """
+        Args:
+            database (str | pymongo.database.Database): the url of the Mongo DB holding the store,
+                                                        whose client is taken from the current process
+                                                        at every use, or the database itself
+            collection (str, optional): the prefix of the GridFS collections. Defaults to "raw".
+        """
+        self.database = database
+        self.collection = collection
+        self.indexed = False
+
+    @property
+    def db(self):
+        return get_database(self.database) if isinstance(self.database, str) else self.database
+
+    @property
+    def files(self):
+        return self.db.get_collection(f"{self.collection}.files")
+
+    @property
+    def fs(self):
+        return gridfs.GridFS(self.db, collection=self.collection)
+
+    def put(self, match_id, kind, payload):
+        if not self.indexed:
+            self.files.create_index("filename", unique=True)
+            self.indexed = True
+        filename = f"{match_id}.{kind}"
+        if self.fs.exists(filename=filename):
+            return
+        try:
+            self.fs.put(compress(payload), filename=filename, match_id=match_id, kind=kind)
+        except DuplicateKeyError:
+            pass  # another crawler stored the same payload in the meantime
+
+    def get(self, match_id, kind):
+        try:
+            return decompress(self.fs.get_last_version(filename=f"{match_id}.{kind}").read())
+        except gridfs.errors.NoFile:
+            return None
+
+    def match_ids(self):
+        for raw_file in self.files.find({"kind": "match"}, {"match_id": 1}):
+            yield raw_file["match_id"]
+
+
+def open_raw_store(location):
+    """
+    Opens the raw store at the given location
+
+    Args:
+        location (str): a mongodb:// url for a GridFS store, a directory otherwise
+
+    Returns:
+        DiskRawStore | GridFSRawStore: the store
+    """
+    if location.startswith(("mongodb://", "mongodb+srv://")):
+        return GridFSRawStore(location)
+    return DiskRawStore(location)
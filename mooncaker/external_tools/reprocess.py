@@ -0,0 +1,121 @@
+"""
+    Rebuilds the matches collection from the raw store, spreading the work over the cpu cores,
+    so that a change to the docs or to the role heuristics doesn't need a new crawl.
+
+    Usage: python -m mooncaker.external_tools.reprocess <raw store> <db url> [--processes N]
+"""
+import argparse
+from functools import partial
+from logging import INFO
+from multiprocessing import Pool
+from .data_crawler import Crawler
+from .db_interactor import Database
+from .raw_store import open_raw_store
+from .logger import log as log_raw
+
+
+log = partial(log_raw, "reprocess")
+REPROCESS_CHUNK_SIZE = 50  # matches handed to a worker process at a time
+REPROCESS_WRITE_SIZE = 500  # docs written to the database at a time
+REPROCESS_LOG_EVERY = 10000
+# returned by rebuild_doc instead of a doc when a payload is missing, the stored match is kept as it is
+SKIPPED = "SKIPPED"
+
+# opened once in every worker process
+worker_store = None
+
+
+def init_worker(location):
+    global worker_store
+    worker_store = open_raw_store(location)
+
+
+def rebuild_doc(match_id, timeline_roles=False, store=None):
+    """
+    Builds the doc of a match from its raw payloads, the same way the crawler does
+
+    Args:
+        match_id (str): the id of the match
+        timeline_roles (bool, optional): always assign the roles from the timeline. Defaults to False.
+        store (DiskRawStore | GridFSRawStore, optional): the raw store, defaults to the one of the worker
+
+    Returns:
+        (str, dict): the match id and its doc, None if the match is invalid,
+                     SKIPPED if a payload needed is missing, e.g. the timeline of a match
+                     whose roles were taken from the participants when it was crawled
+    """
+    store = store or worker_store
+    match = store.get(match_id, "match")
+    if match is None:
+        return match_id, SKIPPED
+    if not Crawler.is_valid_match(match["info"]):
+        return match_id, None
+    info = match["info"]
+    roles = None
+    if not timeline_roles:
+        roles = Crawler.roles_from_participants(info["participants"])
+    if roles is None:
+        timeline = store.get(match_id, "timeline")
+        if timeline is None:
+            return match_id, SKIPPED
+        roles = Crawler.roles_from_timeline(info["participants"], timeline)
+        if roles is None:
+            return match_id, None
+    region = info.get("platformId", match_id.split("_")[0]).lower()
+    return match_id, Crawler.build_match_doc(match_id, region, info, roles)
+
+
+def reprocess(location, database, processes=None, timeline_roles=False):
+    """
+    Rebuilds the doc of every match in the raw store and overwrites the stored ones,
+    deleting the matches that are not valid anymore. The matches missing a payload are left as they are.
+
+    Args:
+        location (str): the raw store, a directory or a mongodb:// url
+        database (Database): the database holding the matches
+        processes (int, optional): number of worker processes. Defaults to the number of cpus.
+        timeline_roles (bool, optional): always assign the roles from the timeline. Defaults to False.
+
+    Returns:
+        dict: number of docs rebuilt, of matches removed and of matches skipped
+    """
+    docs, removed = [], []
+    counts = {"rebuilt": 0, "removed": 0, "skipped": 0}
+
+    def write():
+        database.replace_matches(docs, removed)
+        counts["rebuilt"] += len(docs)
+        counts["removed"] += len(removed)
+        docs.clear()
+        removed.clear()
+
+    match_ids = open_raw_store(location).match_ids()
+    with Pool(processes, initializer=init_worker, initargs=(location,)) as pool:
+        results = pool.imap_unordered(partial(rebuild_doc, timeline_roles=timeline_roles),
+                                      match_ids, chunksize=REPROCESS_CHUNK_SIZE)
+        for done, (match_id, doc) in enumerate(results, 1):
+            if doc == SKIPPED:
+                counts["skipped"] += 1
+            elif doc is None:
+                removed.append(match_id)
+            else:
+                docs.append(doc)
+            if len(docs) + len(removed) >= REPROCESS_WRITE_SIZE:
+                write()
+            if done % REPROCESS_LOG_EVERY == 0:
+                log(INFO, "Reprocessed %d matches", done)
+    write()
+    log(INFO, "Reprocessing done, %d docs rebuilt, %d matches removed and %d skipped for a missing payload",
+        counts['rebuilt'], counts['removed'], counts['skipped'])
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuilds the matches collection from the raw store")
+    parser.add_argument("raw_store", help="the directory or mongodb:// url of the raw store")
+    parser.add_argument("db_url", help="the url of the Mongo DB holding the matches")
+    parser.add_argument("--processes", type=int, default=None, help="defaults to the number of cpus")
+    parser.add_argument("--timeline-roles", action="store_true",
+                        help="always assign the roles from the timeline")
+    args = parser.parse_args()
+    print(reprocess(args.raw_store, Database(args.db_url), args.processes, args.timeline_roles))
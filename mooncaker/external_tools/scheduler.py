@@ -0,0 +1,118 @@
+"""
+    Decides the order in which the ranks of ReDiTi are crawled, and which ones sit out a cycle,
+    from what their previous crawls cost and gave
+"""
+from collections import Counter
+from datetime import timedelta
+from threading import Lock
+
+
+# a rank never crawled is assumed to give PRIOR_YIELD match docs per api call, as if seen for PRIOR_CALLS calls
+PRIOR_YIELD = 0.2
+PRIOR_CALLS = 50
+# weight kept by the previous crawls of a rank each time it is crawled again, so that the yield follows the meta
+YIELD_DECAY = 0.5
+# the players of a rank need about this long to play enough new clash matches
+REFRESH_AFTER = timedelta(days=1)
+# ranks worth less than this share of the best one sit out the cycle...
+SKIP_BELOW = 0.25
+# ...but never more than this many cycles in a row
+MAX_SKIPPED = 3
+COUNTS = ('calls', 'listed', 'new', 'docs')
+
+
+class RankTally():
+    """
+    Counts, from every thread working on a rank, the api calls made (retries included),
+    the match ids listed and the new ones, and the valid match docs produced
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = Lock()
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def totals(self):
+        with self.lock:
+            return {name: self.counts[name] for name in COUNTS}
+
+
+def rank_key(region, tier, division):
+    return f"{region}:{tier}:{division}"
+
+
+def expected_yield(stats):
+    """
+    Returns:
+        float: the match docs a rank is expected to give per api call, smoothed towards PRIOR_YIELD
+    """
+    return (stats.get('docs', 0) + PRIOR_YIELD * PRIOR_CALLS) / (stats.get('calls', 0) + PRIOR_CALLS)
+
+
+def priority(stats, now):
+    """
+    The expected yield of a rank, scaled down while its last crawl is recent,
+    since its players haven't had the time to play new clash matches
+
+    Args:
+        stats (dict): the yield statistics of the rank, empty if it was never crawled
+        now (datetime.datetime): the current UTC time
+
+    Returns:
+        float: the priority, the higher the sooner the rank is crawled
+    """
+    last_crawled = stats.get('last_crawled')
+    freshness = 1.0 if last_crawled is None else min(1.0, max(0.0, (now - last_crawled) / REFRESH_AFTER))
+    return expected_yield(stats) * freshness
+
+
+def merge(stats, tally, now):
+    """
+    Adds a crawl to the statistics of a rank
+
+    Args:
+        stats (dict): the yield statistics of the rank, empty if it was never crawled
+        tally (dict): the totals of the RankTally of the crawl
+        now (datetime.datetime): when the crawl ended
+
+    Returns:
+        dict: the new statistics, the previous crawls weighted by YIELD_DECAY
+    """
+    merged = {name: stats.get(name, 0) * YIELD_DECAY + tally.get(name, 0) for name in COUNTS}
+    merged['crawls'] = stats.get('crawls', 0) + 1
+    merged['skipped'] = 0
+    merged['last_crawled'] = now
+    merged['yield'] = expected_yield(merged)
+    merged['duplicate_ratio'] = 1 - merged['new'] / merged['listed'] if merged['listed'] else 0.0
+    return merged
+
+
+def plan(ranks, stats, now, best=None):
+    """
+    Gives each rank its priority for a new cycle, or a new visit, and picks the ones sitting it out.
+    Given the same statistics it always gives the same plan.
+
+    Args:
+        ranks (list(tuple)): the region, tier and division of every rank
+        stats (dict): rank_key -> yield statistics, missing for the ranks never crawled
+        now (datetime.datetime): the current UTC time
+        best (float, optional): the priority the ranks are compared to. Defaults to None,
+                                the best one among the given ranks.
+
+    Returns:
+        list((tuple, float, bool)): every rank with its priority and whether it's skipped,
+                                    the ones to crawl first coming first
+    """
+    priorities = {rank: priority(stats.get(rank_key(*rank), {}), now) for rank in ranks}
+    if best is None:
+        best = max(priorities.values(), default=0.0)
+    planned = []
+    # the sort is stable, ranks with the same priority keep the given order
+    for rank in sorted(ranks, key=lambda rank: -priorities[rank]):
+        skipped = (priorities[rank] < SKIP_BELOW * best
+                   and stats.get(rank_key(*rank), {}).get('skipped', 0) < MAX_SKIPPED)
+        planned.append((rank, priorities[rank], skipped))
+    return planned
@@ -0,0 +1,80 @@
+"""
+    Extracts from the text of a timeline only the frames used to assign the roles,
+    without decoding the several MB of events around them
+"""
+import json
+from riotwatcher import Deserializer
+from riotwatcher.Handlers import DictionaryDeserializer
+
+
+FRAMES_KEY = '"participantFrames"'
+ROLE_FRAME = 2  # positions are read at the second minute, when the laning phase started
+decoder = json.JSONDecoder()
+
+
+class RawTimeline(str):
+    """
+    The undecoded text of a timeline, as returned by the watcher for timeline_by_match
+    """
+
+
+class TimelineDeserializer(Deserializer):
+    """
+    Decodes every response as usual but the timelines, which are handed over as RawTimeline
+    so that only the frames needed are decoded
+    """
+
+    def __init__(self):
+        self.dictionary = DictionaryDeserializer()
+
+    def deserialize(self, endpoint_name, method_name, data):
+        if endpoint_name == "MatchApiV5" and method_name == "timeline_by_match" and data:
+            return RawTimeline(data)
+        return self.dictionary.deserialize(endpoint_name, method_name, data)
+
+
+def decode_value(text, key_at):
+    """
+    Decodes the json value following the key found at the given position
+
+    Args:
+        text (str): the json text
+        key_at (int): where the key starts
+
+    Returns:
+        Any: the decoded value
+    """
+    value_at = text.index(":", key_at + len(FRAMES_KEY)) + 1
+    while text[value_at] in " \t\r\n":
+        value_at += 1
+    return decoder.raw_decode(text, value_at)[0]
+
+
+def role_frames(timeline):
+    """
+    Returns the participant frames at the second minute and at the end of the game.
+    A RawTimeline is scanned for the occurrences of "participantFrames", which appear once for
+    each frame and nowhere else, decoding only the two objects needed; a dict is simply indexed.
+
+    Args:
+        timeline (RawTimeline | dict): the timeline of a match-v5 match
+
+    Returns:
+        (dict, dict): participant id (as string) -> participant frame, for both frames
+    """
+    if isinstance(timeline, str):
+        key_at = -1
+        for _ in range(ROLE_FRAME + 1):
+            key_at = timeline.find(FRAMES_KEY, key_at + 1)
+            if key_at == -1:
+                break
+        last_at = timeline.rfind(FRAMES_KEY)
+        if key_at != -1:
+            try:
+                return decode_value(timeline, key_at), decode_value(timeline, last_at)
+            except (ValueError, IndexError):
+                pass
+        # not laid out as expected, the whole timeline is decoded
+        timeline = json.loads(timeline)
+    frames = timeline['info']['frames']
+    return frames[ROLE_FRAME]['participantFrames'], frames[-1]['participantFrames']
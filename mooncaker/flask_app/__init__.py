@@ -1,7 +1,9 @@
 from os import path, getcwd, environ
+from datetime import timedelta
 from functools import partial
 from logging import WARNING, DEBUG, INFO
 from multiprocessing import Process, Queue
+from queue import Empty
 from flask import Flask
 from flask_restful import Api
 from flask_bootstrap import Bootstrap
@@ -10,7 +12,7 @@ from flask_talisman import Talisman
 from dotenv import load_dotenv
 from mooncaker.external_tools.data_crawler import Crawler
 from mooncaker.external_tools.mooncaker_bot import MooncakerBot
-from mooncaker.external_tools.logger import log as log_raw
+from mooncaker.external_tools.logger import log as log_raw, set_levels
 
 app = Flask(__name__)
 api = Api(app)
@@ -45,18 +47,33 @@ try:
 except KeyError:
     print("The .env file was improperly set, please check the README for further information")
     exit()
+# optional crawler settings
+app.config['CRAWLER_CONCURRENT'] = environ.get('crawler-concurrent', 'false').lower() == 'true'
+app.config['CRAWLER_MAX_IN_FLIGHT'] = int(environ.get('crawler-max-in-flight', 4))
+app.config['CRAWLER_RESERVED_BUDGET'] = float(environ.get('crawler-reserved-budget', 0.0))
+app.config['CRAWLER_TIMELINE_ROLES'] = environ.get('crawler-timeline-roles', 'false').lower() == 'true'
+app.config['CRAWLER_RAW_STORE'] = environ.get('crawler-raw-store')
+app.config['CRAWLER_RECORD'] = environ.get('crawler-record')
+app.config['CRAWLER_API_KEYS'] = environ.get('crawler-api-keys', '').split()
+app.config['CRAWLER_REVISIT_HOURS'] = float(environ.get('crawler-revisit-hours', 24))
+# the Bearer token Prometheus sends to scrape /metrics, without it only an admin session can read them
+app.config['METRICS_TOKEN'] = environ.get('metrics-token')
+app.config['EXPORT_CACHE_DIR'] = environ.get('export-cache-dir', path.join(getcwd(), 'export-cache'))
+# e.g. "datacrawler=WARNING database=INFO", the domains not listed log everything
+set_levels(environ.get('log-levels', ''))
 
 mail = Mail(app)
 Bootstrap(app)
 
-api_key_queue = Queue()  # Where the new API key will be put
+api_key_queue = Queue()  # Where the new API keys will be put, they are added to the key pool of the crawler
 
 bot = MooncakerBot(app.config['TELEGRAM_TOKEN'],
                    api_key_queue.put,
                    app.config['TELEGRAM_WHITELIST'],
                    app.config['DB_URL'],
                    app.config['TELEGRAM_REMINDER_CHAT_ID'],
-                   app.config['TELEGRAM_CLIENT_USER'])
+                   app.config['TELEGRAM_CLIENT_USER'],
+                   app.config['EXPORT_CACHE_DIR'])
 
 bot_process = Process(target=bot.start_bot)
 bot_process.start()
@@ -65,7 +82,7 @@ log(INFO, "Starting telegram bot")
 
 def get_api_key():
     """
-    Function that get called when a new api key is required
+    Function that get called when every api key of the crawler has expired
     It sends an email and a telegram message to warn the admins of this need
     and hangs waiting for a new key
 
@@ -85,8 +102,29 @@ def get_api_key():
     return api_key_queue.get()
 
 
-crawler = Crawler("NotAnAPIKey", get_api_key, app.config['DB_URL'])
-crawling_process = Process(target=crawler.start_crawling)
+def new_api_keys():
+    """
+    Returns:
+        list(str): the api keys set by the admins since the last call, without waiting
+    """
+    keys = []
+    while True:
+        try:
+            keys.append(api_key_queue.get_nowait())
+        except Empty:
+            return keys
+
+
+crawler = Crawler(app.config['CRAWLER_API_KEYS'] or "NotAnAPIKey", get_api_key, app.config['DB_URL'],
+                  concurrent=app.config['CRAWLER_CONCURRENT'],
+                  max_in_flight=app.config['CRAWLER_MAX_IN_FLIGHT'],
+                  reserved_budget=app.config['CRAWLER_RESERVED_BUDGET'],
+                  timeline_roles=app.config['CRAWLER_TIMELINE_ROLES'],
+                  raw_store=app.config['CRAWLER_RAW_STORE'],
+                  record=app.config['CRAWLER_RECORD'],
+                  poll_new_keys=new_api_keys,
+                  revisit_every=timedelta(hours=app.config['CRAWLER_REVISIT_HOURS']))
+crawling_process = Process(target=crawler.run_daemon)
 crawling_process.start()
 log(INFO, "Starting datacrawling")
 
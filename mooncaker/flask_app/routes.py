@@ -1,16 +1,38 @@
 from functools import partial
 import hashlib
+import hmac
+from html import escape
+import json
+import time
 from logging import WARNING, INFO, DEBUG
-from flask import redirect, session, render_template, url_for, g, request, send_file
+from flask import redirect, session, render_template, url_for, g, request, abort, send_file, stream_with_context
 from flask_restful import Resource
 from flask_mail import Message
 from flask_app.forms import AdminForm, ConsoleForm
-from flask_app import app, mail, api_key_queue
+from flask_app import app, api, mail, api_key_queue
 from mooncaker.external_tools.logger import log as log_raw
-from mooncaker.external_tools.logger import get_log
+from mooncaker.external_tools.logger import log_position, read_log, tail_log
 from mooncaker.external_tools.db_interactor import Database
+from mooncaker.external_tools.export_cache import ExportCache, EXPORT_NAME
+from mooncaker.external_tools.match_query import parse_arguments
+from mooncaker.external_tools.metrics import read_metrics
 
 log = partial(log_raw, "mooncaker")
+# the filters of /data, also given to get-data as name=value
+EXPORT_FILTERS = ("region", "min_patch", "max_patch", "since")
+# lines of the log shown by get-log without a number
+CONSOLE_LOG_LINES = 100
+# seconds between two looks for new lines of the live log, and between two keepalives while there are none,
+# which is when a closed connection is noticed
+LOG_STREAM_POLL = 1.0
+LOG_STREAM_KEEPALIVE = 15
+# a stream ends after this many seconds so that it doesn't hold a worker for good, the browser reconnects
+# after LOG_STREAM_RETRY milliseconds and resumes from the id of the last event it received
+LOG_STREAM_DURATION = 5 * 60
+LOG_STREAM_RETRY = 1000
+# queries go through the Mongo client of the worker process, created on the first one
+database = Database(app.config['DB_URL'])
+export_cache = ExportCache(database, app.config['EXPORT_CACHE_DIR'])
 
 # set REST API
 # @deprecated
@@ -28,6 +50,25 @@ log = partial(log_raw, "mooncaker")
 # api.add_resource(ApiKeyUpdate, '/set_api_key') #deprecated
 # api.add_resource(DownloadLog, '/get_log') #deprecated
 
+
+class MatchQuery(Resource):
+    def get(self):
+        """
+        A page of the matches, filtered by the query string (see match_query.match_query),
+        the next one is asked for with after=<next>
+        """
+        if g.user is None:
+            abort(401)
+        try:
+            matches, after = database.query_matches(**parse_arguments(request.args))
+        except ValueError as error:
+            abort(400, str(error))
+        return {"matches": matches, "next": after}
+
+
+api.add_resource(MatchQuery, '/matches')
+
+
 @app.before_request
 def before_request():
     g.user = None
@@ -90,28 +131,103 @@ def admin():
 
 
 def parse_command(command, args):
-    # todo: implement database queries
     if command == "set-api-key":
-        api_key_queue.put(args[0])
-        log(INFO, "Received a new API key")
-        return 'New API key set correctly'
+        # every key is added to the pool of the crawler, the expired ones are retired by the crawler itself
+        for key in args:
+            api_key_queue.put(key)
+        log(INFO, "Received %d new API keys", len(args))
+        return f'{len(args)} API keys added to the pool'
     elif command == "get-log":
-        return "<br>".join(get_log())
+        n_lines = int(args[0]) if args and args[0].isnumeric() else CONSOLE_LOG_LINES
+        return "<br>".join(escape(line) for line in tail_log(n_lines))
     elif command == "get-data":
-        return f'You can download the file <a href="{url_for("download_data")}" target="_blank" rel="noopener noreferrer">here</a>'
+        filters = dict(arg.split("=", 1) for arg in args if "=" in arg)
+        filters = {name: value for name, value in filters.items() if name in EXPORT_FILTERS}
+        return f'You can download the file <a href="{url_for("download_data", **filters)}" target="_blank" rel="noopener noreferrer">here</a>'
+    elif command == "query":
+        filters = dict(arg.split("=", 1) for arg in args if "=" in arg)
+        try:
+            matches, after = database.query_matches(**parse_arguments(filters))
+        except ValueError as error:
+            return escape(str(error))
+        lines = [escape(json.dumps(match)) for match in matches]
+        if after is not None:
+            lines.append(escape(" ".join(["next page: query"] + [f"{name}={value}" for name, value in filters.items()
+                                                                  if name != "after"] + [f"after={after}"])))
+        return "<br>".join(lines) or "No match found"
     elif command == "help":
-        return "Currently available commands are: <br> set-api-key [key] <br> get-log <br> get-data <br>"
+        return ("Currently available commands are: <br> set-api-key [key ...] <br> get-log [lines] <br> "
+                "get-data [region=euw1] [min_patch=11.10] [max_patch=11.12] [since=EUW1_5380000000] <br> "
+                "query [region=euw1] [patch=11.14 | min_patch=11.10 max_patch=11.12] [champion=64 [role=JUNGLE]] "
+                "[winner=100] [min_duration=1200] [max_duration=1800] [fields=patch,team1.JUNGLE] [limit=100] "
+                "[after=EUW1_5380000000] <br>")
     return 'Something when wrong parsing your command. Please report to the admins'
 
 
 @app.route("/data")
 def download_data():
     if g.user is not None:
-        matches_filename = Database(app.config['DB_URL']).create_matches_csv()
-        return send_file(matches_filename, as_attachment=True)
+        filters = {name: request.args[name] for name in EXPORT_FILTERS if request.args.get(name)}
+        if not filters:
+            # the whole collection comes from the cache, answering If-None-Match and Range requests
+            export = export_cache.current()
+            return send_file(export['path'], mimetype="application/gzip", as_attachment=True,
+                             download_name=EXPORT_NAME, conditional=True, etag=export['etag'])
+        try:
+            chunks = database.export_matches_csv(**filters)
+        except ValueError as error:
+            abort(400, str(error))
+        # rows are sent as they are read, the file never exists on the server
+        return app.response_class(stream_with_context(chunks), mimetype="application/gzip",
+                                  headers={"Content-Disposition": "attachment; filename=matches.csv.gz"})
     return redirect(url_for('admin'))
 
 
+@app.route("/metrics")
+def serve_metrics():
+    # scraped by Prometheus with the metrics token, the keys and crawl internals are not public
+    token = app.config['METRICS_TOKEN']
+    authorization = request.headers.get("Authorization", "")
+    if g.user is None and not (token and hmac.compare_digest(authorization, f"Bearer {token}")):
+        abort(401)
+    return app.response_class(read_metrics(app.config['DB_URL']), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/console/log")
+def stream_log():
+    """
+    Pushes the lines appended to the log as server-sent events, following it across rotations.
+    The id of an event is where it ends in the log, a reconnection sends it back as Last-Event-ID
+    and the lines written in between are not lost.
+    """
+    if g.user is None:
+        return redirect(url_for('admin'))
+    try:
+        offset, inode = (int(part) for part in request.headers["Last-Event-ID"].split(":"))
+    except (KeyError, ValueError):
+        offset, inode = log_position()
+
+    def events():
+        nonlocal offset, inode
+        yield f"retry: {LOG_STREAM_RETRY}\n\n"
+        end = time.monotonic() + LOG_STREAM_DURATION
+        idle = 0.0
+        while time.monotonic() < end:
+            lines, offset, inode = read_log(offset, inode)
+            if lines:
+                yield f"id: {offset}:{inode}\n" + "".join(f"data: {line.rstrip()}\n" for line in lines) + "\n"
+                idle = 0.0
+                continue
+            time.sleep(LOG_STREAM_POLL)
+            idle += LOG_STREAM_POLL
+            if idle >= LOG_STREAM_KEEPALIVE:
+                yield ": keepalive\n\n"
+                idle = 0.0
+
+    return app.response_class(stream_with_context(events()), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.route('/console/', methods=['GET', 'POST'])
 def console():
     if g.user is not None:
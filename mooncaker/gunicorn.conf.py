@@ -1 +1,5 @@
 preload_app = True
+# a streamed response (the live log of the console, the csv exports) holds a thread instead of a whole worker,
+# and a sync worker would be killed by the arbiter once a stream outlasts the timeout
+worker_class = "gthread"
+threads = 8
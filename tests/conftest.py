@@ -0,0 +1,10 @@
+import pytest
+from mooncaker.external_tools import LOG_FILENAME
+
+
+@pytest.fixture(autouse=True, scope="session")
+def log_in_tmp_dir(tmp_path_factory):
+    # the log of the tests, and of the processes they start, is not written in the repository
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("mooncaker-log", str(tmp_path_factory.mktemp("log") / LOG_FILENAME))
+        yield
@@ -0,0 +1,60 @@
+import gzip
+import json
+from threading import Thread
+import pytest
+from mooncaker.external_tools.cassette import CassettePlayer, request_key
+from mooncaker.external_tools.data_crawler import Crawler
+from benchmarks.fake_riot_api import FakeRiotApi
+from benchmarks.crawl_throughput import set_ranks
+from benchmarks.replay_crawl import recorded_ranks
+from tests.test_data_crawler import increase_key_counter
+
+
+@pytest.fixture()
+def cassette(tmp_path):
+    path = str(tmp_path / "crawl.jsonl.gz")
+    api = FakeRiotApi(pages=1, entries_per_page=3, matches_per_player=3, match_pool=6, timeline_rate=0.5,
+                      events_per_frame=2, error_rate=0.1, seed=1)
+    server = api.server()
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        crawler = Crawler("RGAPI-notanapi", increase_key_counter, None, record=path,
+                          api_url=f"http://127.0.0.1:{server.server_address[1]}/{{platform}}")
+        set_ranks(crawler.db, 2)
+        crawler.start_crawling()
+    finally:
+        server.shutdown()
+        server.server_close()
+    crawler.cassette.close()
+    return path, sorted(crawler.db.db_matches.find({}, {'stored': 0}), key=lambda doc: doc['_id'])
+
+
+def test_replay(cassette):
+    path, docs = cassette
+    slept = []
+    crawler = Crawler("RGAPI-notanapi", increase_key_counter, None, replay=path)
+    crawler.sleep = slept.append
+    crawler.db.db_rediti.delete_many({})
+    crawler.db.db_rediti.insert_many(recorded_ranks(crawler.cassette))
+    crawler.start_crawling()
+    assert crawler.cassette.missing == 0
+    # the replayed 429s are never waited for
+    assert slept == []
+    # only when the matches were stored differs between the two crawls
+    assert sorted(crawler.db.db_matches.find({}, {'stored': 0}), key=lambda doc: doc['_id']) == docs
+
+
+def test_recorded_order(tmp_path):
+    path = str(tmp_path / "cassette.gz")
+    key = request_key("europe", "MatchApiV5", "by_id", "https://europe.api.riotgames.com/lol/match/v5/matches/EUW1_1", {})
+    with gzip.open(path, "wt") as cassette:
+        for status in (503, 200):
+            cassette.write(json.dumps({"key": key, "status": status, "headers": {}, "body": "{}"}) + "\n")
+        cassette.write('{"key": "trunc')
+    player = CassettePlayer(path)
+    # replayed with a different root
+    url = "http://127.0.0.1:1/europe/lol/match/v5/matches/EUW1_1"
+    assert [player.preview_request("europe", "MatchApiV5", "by_id", url, {}).status_code
+            for _ in range(3)] == [503, 200, 200]
+    assert player.preview_request("europe", "MatchApiV5", "by_id", url + "2", {}).status_code == 404
+    assert player.missing == 1
@@ -0,0 +1,49 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from mooncaker.external_tools.crawl_pipeline import Pipeline, Stage, Marker
+
+
+def slow_double(x):
+    time.sleep(0.001 * (x % 3))
+    return [x * 2]
+
+
+def test_order_with_markers():
+    source = [1, 2, Marker('a'), 3, Marker('b')]
+    with ThreadPoolExecutor(4) as pool:
+        items = list(Pipeline(source, [Stage("double", slow_double, pool),
+                                       Stage("plus", lambda x: [x + 1])]))
+    assert [item.value if isinstance(item, Marker) else item for item in items] == [3, 5, 'a', 7, 'b']
+
+
+def test_stage_can_drop_and_split():
+    items = list(Pipeline(range(4), [Stage("even", lambda x: [x] if x % 2 == 0 else []),
+                                     Stage("split", lambda x: [x, x])]))
+    assert items == [0, 0, 2, 2]
+
+
+def test_failure_reaches_consumer():
+    def fail(x):
+        raise ValueError(x)
+
+    with pytest.raises(ValueError):
+        list(Pipeline([1], [Stage("fail", fail)]))
+
+
+def test_bounded_queues():
+    produced = []
+
+    def source():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    pipeline = Pipeline(source(), [Stage("identity", lambda x: [x])], maxsize=5)
+    iterator = iter(pipeline)
+    assert next(iterator) == 0
+    time.sleep(0.1)
+    # source, stage and the queues hold only a handful of items
+    assert len(produced) < 20
+    assert all(depth <= 5 for depth in pipeline.depths().values())
+    iterator.close()
@@ -0,0 +1,64 @@
+import csv
+import gzip
+import io
+import zlib
+import pytest
+from mooncaker.external_tools.csv_export import CSV_FIELDS, GZIP_WBITS, export_query, field_value
+from mooncaker.external_tools.db_interactor import Database
+
+
+def match(match_id, region, patch):
+    team = {"teamId": 100, "bans": [1, 2, 3, 4, 5],
+            **{role: {"summonerId": f"{match_id}-{role}", "champion": 7}
+               for role in ["TOP", "JUNGLE", "MID", "ADC", "SUPPORT"]}}
+    return {"_id": match_id, "region": region, "duration": 1800, "patch": patch, "winner": 100,
+            "team1": team, "team2": dict(team, teamId=200)}
+
+
+@pytest.fixture
+def db():
+    db = Database(None)
+    db.db_matches.insert_many([match("EUW1_1", "euw1", "11.9"), match("EUW1_2", "euw1", "11.10"),
+                               match("KR_1", "kr", "11.10"), match("KR_2", "kr", "11.12")])
+    return db
+
+
+def read(chunks):
+    return list(csv.reader(io.StringIO(gzip.decompress(b"".join(chunks)).decode("utf-8"))))
+
+
+class TestExport:
+
+    def test_all(self, db):
+        rows = read(db.export_matches_csv())
+        assert rows[0] == CSV_FIELDS
+        assert [row[0] for row in rows[1:]] == ["EUW1_1", "EUW1_2", "KR_1", "KR_2"]
+        assert rows[1][CSV_FIELDS.index("team2.bans.4")] == "5"
+        assert rows[1][CSV_FIELDS.index("team2.teamId")] == "200"
+
+    def test_filters(self, db):
+        assert [row[0] for row in read(db.export_matches_csv(region="KR"))[1:]] == ["KR_1", "KR_2"]
+        # patches are compared as versions, not as strings
+        assert [row[0] for row in read(db.export_matches_csv(min_patch="11.10", max_patch="11.11"))[1:]] \
+            == ["EUW1_2", "KR_1"]
+        assert [row[0] for row in read(db.export_matches_csv(since="EUW1_2"))[1:]] == ["KR_1", "KR_2"]
+
+    def test_wrong_patch(self, db):
+        with pytest.raises(ValueError):
+            db.export_matches_csv(min_patch="eleven")
+
+    def test_header_first(self, db):
+        # the header can be read before a single match is
+        first = next(db.export_matches_csv())
+        assert zlib.decompressobj(GZIP_WBITS).decompress(first).decode("utf-8").startswith("_id,region")
+
+    def test_file(self, db, tmp_path):
+        filename = db.create_matches_csv(str(tmp_path / "matches.csv.gz"), region="euw1")
+        with open(filename, "rb") as csv_file:
+            assert len(read([csv_file.read()])) == 3
+
+
+def test_missing_fields():
+    assert field_value({"team1": {"bans": [1]}}, "team1.bans.3") == ""
+    assert field_value({"team1": {"bans": [1]}}, "team1.TOP.champion") == ""
+    assert export_query(["11.9", "11.10"], max_patch="11.9") == {'patch': {'$in': ["11.9"]}}
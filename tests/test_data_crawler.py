@@ -1,7 +1,8 @@
-import time
+from datetime import timedelta
 import pytest
 import random
-from mooncaker.external_tools.data_crawler import Crawler
+from mooncaker.external_tools import data_crawler
+from mooncaker.external_tools.data_crawler import Crawler, FETCH_FAILED
 from mooncaker.external_tools.db_interactor import Database
 from riotwatcher._apis.league_of_legends import LeagueApiV4
 from riotwatcher._apis.league_of_legends import MatchApiV5
@@ -66,8 +67,8 @@ def mock_entries_429_error(monkeypatch):
 
 
 @pytest.fixture
-def mock_sleep(monkeypatch):
-    monkeypatch.setattr(time, "sleep", increase_sleep_counter)
+def mock_sleep(crawler, monkeypatch):
+    monkeypatch.setattr(crawler, "sleep", increase_sleep_counter)
 
 
 # test summoner names function
@@ -157,6 +158,53 @@ class TestPuuidIdBySumName:
         assert sleep_called_counter - old_counter > 0
 
 
+class TestPuuidCache:
+    entries = [{'summonerName': 'Mock Name1', 'summonerId': 'id1'},
+               {'summonerName': 'mockName2', 'puuid': 'puuid2'},
+               {'summonerName': 'mockName3'},
+               {'summonerName': 'deletedName'}]
+    calls = []
+
+    def by_id(self, _, region, summoner_id):
+        self.calls.append(summoner_id)
+        return {'puuid': 'puuid1'}
+
+    def by_name(self, _, region, name):
+        self.calls.append(name)
+        if name == 'deletedName':
+            raise_api_error(MockStatusCode(404))
+        return {'puuid': 'puuid3'}
+
+    @pytest.fixture()
+    def mock_summoner(self, monkeypatch):
+        self.calls.clear()
+        monkeypatch.setattr(SummonerApiV4, "by_id", lambda *args: self.by_id(*args))
+        monkeypatch.setattr(SummonerApiV4, "by_name", lambda *args: self.by_name(*args))
+
+    def test_resolution(self, crawler, mock_summoner):
+        puuids = crawler.puuids_by_entries('euw1', self.entries)
+        assert puuids == ['puuid1', 'puuid2', 'puuid3', None]
+        # the puuid in the entry is used, 404 is not retried
+        assert sorted(self.calls) == ['deletedName', 'id1', 'mockName3']
+
+    def test_no_repeated_lookups(self, crawler, mock_summoner):
+        crawler.puuids_by_entries('euw1', self.entries)
+        self.calls.clear()
+        assert crawler.puuids_by_entries('euw1', self.entries) == ['puuid1', 'puuid2', 'puuid3', None]
+        assert self.calls == []
+
+    def test_persistent_cache(self, crawler, mock_summoner):
+        crawler.puuids_by_entries('euw1', self.entries)
+        self.calls.clear()
+        crawler.db.puuid_cache.items.clear()
+        assert crawler.puuids_by_name('euw1', ['MOCK NAME3', 'deletedName']) == ['puuid3', None]
+        assert self.calls == []
+        # cache is per region
+        self.calls.clear()
+        crawler.puuids_by_name('kr', ['mockName3'])
+        assert self.calls == ['mockName3']
+
+
 class TestClashMatches:
     # check on successful call
     puuid_list = ['aaaaaaaaaaaaaaaa32aaaaaaaaaaaaaaaa',
@@ -171,7 +219,7 @@ class TestClashMatches:
     def get_puuids(self, *_):
         return self.puuid_list
 
-    def get_matches(self, *_):
+    def get_matches(self, *_, **__):
         random.shuffle(self.match_list)
         return self.match_list
 
@@ -188,7 +236,7 @@ class TestClashMatches:
 
     @pytest.fixture()
     def mock_matchlist_unsucc(self, monkeypatch):
-        monkeypatch.setattr(MatchApiV5, "matchlist_by_puuid", lambda *_: [])
+        monkeypatch.setattr(MatchApiV5, "matchlist_by_puuid", lambda *_, **__: [])
 
     @pytest.fixture()
     def mock_filter_succ(self, monkeypatch):
@@ -224,6 +272,39 @@ class TestClashMatches:
         assert sleep_called_counter - old_counter > 0
 
 
+class TestMatchlistWatermark:
+    history = [f'EUW1_{i}' for i in range(250, 0, -1)]  # newest first
+    calls = []
+
+    def matchlist(self, _, region, puuid, queue=None, start=0, count=20, start_time=None, **__):
+        assert queue == 700
+        self.calls.append(start_time)
+        return self.history[start: start + count]
+
+    @pytest.fixture()
+    def mock_matchlist(self, monkeypatch):
+        self.calls.clear()
+        monkeypatch.setattr(MatchApiV5, "matchlist_by_puuid", lambda *args, **kwargs: self.matchlist(*args, **kwargs))
+
+    def test_full_history(self, crawler, mock_matchlist):
+        matches = crawler.clash_matches_by_puuid('euw1', ['puuid'])
+        assert matches == self.history
+        assert self.calls == [None, None, None]
+        watermark = crawler.db.get_watermarks(['puuid'])['puuid']
+        assert watermark['match'] == self.history[0]
+        assert watermark['time'] is not None
+
+    def test_only_new_matches(self, crawler, mock_matchlist):
+        crawler.clash_matches_by_puuid('euw1', ['puuid'])
+        self.calls.clear()
+        self.history.insert(0, 'EUW1_251')
+        matches = crawler.clash_matches_by_puuid('euw1', ['puuid'])
+        assert matches == ['EUW1_251']
+        assert len(self.calls) == 1 and self.calls[0] is not None
+        assert crawler.db.get_watermarks(['puuid'])['puuid']['match'] == 'EUW1_251'
+        self.history.pop(0)
+
+
 class TestMatchDetails:
     matches_succ = [{'info': {'gameDuration': 1234567,
                               'gameVersion': '1.2.3.4',
@@ -318,19 +399,91 @@ class TestMatchDetails:
         assert docs[0]['_id'] == 3
 
 
+class TestParticipantRoles:
+    positions = ['TOP', 'JUNGLE', 'MIDDLE', 'BOTTOM', 'UTILITY']
+    farm = [150, 20, 180, 200, 30]
+
+    def match(self, positions=None, duration=1800, surrender=False):
+        positions = positions or self.positions
+        participants = [{'participantId': i + 1 + 5 * team, 'puuid': f'p{i + 5 * team}', 'teamId': 100 * (team + 1),
+                         'summoner1Id': 11 if positions[i] == 'JUNGLE' else 4, 'summoner2Id': 4,
+                         'championId': i + 1 + 5 * team, 'teamPosition': positions[i], 'individualPosition': 'Invalid',
+                         'totalMinionsKilled': self.farm[i], 'gameEndedInEarlySurrender': surrender}
+                        for team in range(2) for i in range(5)]
+        return {'info': {'gameDuration': duration, 'gameEndTimestamp': 1, 'gameVersion': '11.14.1',
+                         'participants': participants,
+                         'teams': [{'teamId': 100, 'win': False, 'bans': [{'championId': c} for c in range(1, 6)]},
+                                   {'teamId': 200, 'win': True, 'bans': [{'championId': c} for c in range(6, 11)]}]}}
+
+    @pytest.fixture()
+    def timeline_calls(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(MatchApiV5, "timeline_by_match",
+                            lambda _, region, id: calls.append(id) or TestMatchDetails.timelines_succ[0])
+        return calls
+
+    def mock_match(self, monkeypatch, match):
+        monkeypatch.setattr(MatchApiV5, "by_id", lambda *_: match)
+
+    def test_no_timeline_needed(self, crawler, monkeypatch, timeline_calls):
+        self.mock_match(monkeypatch, self.match())
+        doc = crawler.match_doc('EUW1_1', 'euw1')
+        assert timeline_calls == []
+        assert crawler.role_sources['participants'] == 1
+        assert doc['team1']['ADC'] == {'summonerId': 'p3', 'champion': 4}
+        assert doc['team1']['SUPPORT'] == {'summonerId': 'p4', 'champion': 5}
+        assert doc['team2']['MID'] == {'summonerId': 'p7', 'champion': 8}
+        assert doc['team1']['bans'] == [1, 2, 3, 4, 5]
+        assert doc['team2']['bans'] == [6, 7, 8, 9, 10]
+        assert doc['winner'] == 200
+        assert doc['patch'] == '11.14'
+
+    @pytest.mark.parametrize('match_args', [{'duration': 200}, {'surrender': True}])
+    def test_remake_rejected(self, crawler, monkeypatch, timeline_calls, match_args):
+        self.mock_match(monkeypatch, self.match(**match_args))
+        assert crawler.match_doc('EUW1_1', 'euw1') is None
+        assert timeline_calls == []
+        assert crawler.role_sources['rejected'] == 1
+
+    @pytest.mark.parametrize('positions', [['TOP', 'JUNGLE', 'MIDDLE', 'BOTTOM', ''],
+                                           ['TOP', 'TOP', 'MIDDLE', 'BOTTOM', 'UTILITY']])
+    def test_timeline_fallback(self, crawler, monkeypatch, timeline_calls, positions):
+        self.mock_match(monkeypatch, self.match(positions))
+        crawler.match_doc('EUW1_1', 'euw1')
+        assert timeline_calls == ['EUW1_1']
+        assert crawler.role_sources['timeline'] == 1
+
+    def test_jungler_without_smite(self):
+        participants = self.match()['info']['participants']
+        participants[1]['summoner1Id'] = 4
+        assert Crawler.roles_from_participants(participants) is None
+
+    @pytest.mark.parametrize('code, doc', [(500, FETCH_FAILED), (404, None)])
+    def test_failed_calls(self, crawler, monkeypatch, code, doc):
+        monkeypatch.setattr(BaseApi, "raw_request", lambda *_: raise_api_error(MockStatusCode(code)))
+        # a match that doesn't exist is not retried
+        assert crawler.match_doc('EUW1_1', 'euw1') == doc
+
+    def test_forced_timeline(self, monkeypatch, timeline_calls):
+        crawler = Crawler("RGAPI-notanapi", increase_key_counter, None, timeline_roles=True)
+        self.mock_match(monkeypatch, self.match())
+        crawler.match_doc('EUW1_1', 'euw1')
+        assert timeline_calls == ['EUW1_1']
+
+
 class TestCrawling:
     marked_crawled = False
 
-    def mark_crawled(self, id):
+    def mark_crawled(self, id, next_visit=None):
         self.marked_crawled = True
 
     @pytest.fixture()
     def mock_summoner_names_succ(self, monkeypatch):
-        monkeypatch.setattr(Crawler, "summoner_names", lambda *_: [])
+        monkeypatch.setattr(Crawler, "summoner_entries", lambda *_: [])
 
     @pytest.fixture()
     def mock_summoner_names_unsucc(self, monkeypatch):
-        monkeypatch.setattr(Crawler, "summoner_names", lambda *_: None)
+        monkeypatch.setattr(Crawler, "summoner_entries", lambda *_: None)
 
     @pytest.fixture()
     def mock_mark_crawled(self, monkeypatch):
@@ -344,3 +497,208 @@ class TestCrawling:
         crawler.start_crawling()
         assert self.marked_crawled
 
+
+
+class TestConcurrentCrawling:
+
+    @pytest.fixture()
+    def concurrent_crawler(self):
+        return Crawler("RGAPI-notanapi", increase_key_counter, None, concurrent=True, max_in_flight=3)
+
+    @pytest.fixture()
+    def mock_match_succ(self, monkeypatch):
+        monkeypatch.setattr(MatchApiV5, "by_id",
+                            lambda _, region, id: TestMatchDetails.matches_succ[id - 1])
+        monkeypatch.setattr(MatchApiV5, "timeline_by_match",
+                            lambda _, region, id: TestMatchDetails.timelines_succ[id - 1])
+
+    def test_api_map_keeps_order(self, concurrent_crawler):
+        results = concurrent_crawler.api_map('euw1', lambda x: x * 2, range(20))
+        assert results == [x * 2 for x in range(20)]
+        assert 'euw1' in concurrent_crawler.pools
+
+    def test_pools_per_route(self, concurrent_crawler):
+        assert concurrent_crawler.pool('europe') is concurrent_crawler.pool('europe')
+        assert concurrent_crawler.pool('europe') is not concurrent_crawler.pool('asia')
+
+    def test_nested_api_map(self, concurrent_crawler):
+        # a stage running on the pool of a route maps its calls on the same pool
+        concurrent_crawler.max_in_flight = 1
+        nested = concurrent_crawler.pool('euw1').submit(concurrent_crawler.api_map, 'euw1', abs, [-1, -2])
+        assert nested.result(timeout=5) == [1, 2]
+
+    def test_match_details_concurrent(self, concurrent_crawler, mock_match_succ):
+        docs = concurrent_crawler.match_details([1, 2, 3], "euw1")
+        assert [doc['_id'] for doc in docs] == [1, 2, 3]
+        assert 'europe' in concurrent_crawler.pools
+
+    def test_key_renewed_once(self, concurrent_crawler):
+        old_counter = key_request_counter
+        stale_watcher = concurrent_crawler.keys.watcher('euw1', "LeagueApiV4", "entries")
+        concurrent_crawler.api_map('euw1', lambda _: concurrent_crawler.renew_key(stale_watcher), range(5))
+        assert key_request_counter - old_counter == 1
+        assert len(concurrent_crawler.keys) == 1
+        assert concurrent_crawler.keys.watcher('euw1', "LeagueApiV4", "entries") is not stale_watcher
+
+    def test_crawling_concurrent(self, concurrent_crawler, monkeypatch):
+        marked = []
+        monkeypatch.setattr(Crawler, "summoner_entries", lambda *_: [])
+        monkeypatch.setattr(Database, "mark_as_crawled", lambda _, id, next_visit: marked.append(id))
+        concurrent_crawler.start_crawling()
+        assert marked == [101010]
+
+
+class TestStreamingCrawl:
+    pages = {1: [{'puuid': 'a'}, {'puuid': 'b'}], 2: [{'puuid': 'c'}], 3: []}
+    matches = {'a': ['EUW1_1', 'EUW1_2'], 'b': ['EUW1_2', 'EUW1_3'], 'c': ['EUW1_4']}
+
+    @pytest.fixture()
+    def mock_crawl(self, monkeypatch):
+        monkeypatch.setattr(Crawler, "summoner_entries", lambda _, region, tier, division, page: self.pages[page])
+        monkeypatch.setattr(Crawler, "clash_matches_by_puuid",
+                            lambda _, region, puuids, journal=None: self.matches[puuids[0]])
+        monkeypatch.setattr(Crawler, "match_doc", lambda _, g_id, region: {'_id': g_id, 'region': region})
+
+    def test_crawl_rank(self, crawler, mock_crawl, monkeypatch):
+        written = []
+        checkpoints = []
+        write_batch = Database.write_batch
+
+        def record_batch(db, docs, pages, done=(), fingerprints=None, failed=()):
+            written.extend(doc['_id'] for doc in docs)
+            checkpoints.extend((page, sorted(written)) for page in pages.values())
+            return write_batch(db, docs, pages, done, fingerprints, failed)
+
+        monkeypatch.setattr(Database, "write_batch", record_batch)
+        assert crawler.crawl_rank(101010, 'euw1', 'GOLD', 'I', 1)
+        # a page is never checkpointed before its docs
+        assert checkpoints[-1] == (3, ['EUW1_1', 'EUW1_2', 'EUW1_3', 'EUW1_4'])
+        assert all(set(ids) >= {'EUW1_1', 'EUW1_2', 'EUW1_3'} for page, ids in checkpoints)
+        assert crawler.db.count_matches() == 4
+
+    def test_crawl_rank_unsuccessful(self, crawler, mock_crawl, monkeypatch):
+        monkeypatch.setattr(Crawler, "summoner_entries",
+                            lambda _, region, tier, division, page: self.pages[page] if page == 1 else None)
+        assert not crawler.crawl_rank(101010, 'euw1', 'GOLD', 'I', 1)
+        assert crawler.db.count_matches() == 3
+
+
+class TestCrawlJournal:
+    pages = {1: [{'puuid': 'a'}, {'puuid': 'b'}], 2: []}
+
+    @pytest.fixture()
+    def mock_calls(self, monkeypatch):
+        calls = {'matchlists': [], 'matches': []}
+        monkeypatch.setattr(Crawler, "summoner_entries", lambda _, region, tier, division, page: self.pages[page])
+        monkeypatch.setattr(MatchApiV5, "matchlist_by_puuid",
+                            lambda _, region, puuid, **__: calls['matchlists'].append(puuid) or [f'EUW1_{puuid}'])
+        monkeypatch.setattr(Crawler, "match_doc",
+                            lambda _, g_id, region: calls['matches'].append(g_id) or {'_id': g_id})
+        return calls
+
+    def test_journal_cleared(self, crawler, mock_calls):
+        assert crawler.crawl_rank('rank', 'euw1', 'GOLD', 'I', 1)
+        assert crawler.db.get_journal('rank') == {}
+        assert crawler.db.count_matches() == 2
+
+    def test_resume(self, crawler, mock_calls):
+        # a previous run listed the matches of a and stored EUW1_1 before stopping
+        crawler.db.journal_listed('rank', 1, ['a'], ['EUW1_1', 'EUW1_a'])
+        crawler.db.write_batch([{'_id': 'EUW1_1'}], {}, [('rank', 1, 'EUW1_1')])
+        assert crawler.crawl_rank('rank', 'euw1', 'GOLD', 'I', 1)
+        assert mock_calls['matchlists'] == ['b']
+        assert sorted(mock_calls['matches']) == ['EUW1_a', 'EUW1_b']
+        assert crawler.db.get_journal('rank') == {}
+
+    def test_failed_match_retried(self, crawler, mock_calls, monkeypatch):
+        monkeypatch.setattr(Crawler, "match_doc", lambda _, g_id, region: mock_calls['matches'].append(g_id)
+                            or (FETCH_FAILED if g_id == 'EUW1_a' else {'_id': g_id}))
+        assert crawler.crawl_rank('rank', 'euw1', 'GOLD', 'I', 1)
+        assert crawler.db.count_matches() == 1
+        assert crawler.db.get_retries('rank') == ['EUW1_a']
+        # the watermark of a is past the match, it comes back from the retries
+        monkeypatch.setattr(Crawler, "match_doc",
+                            lambda _, g_id, region: mock_calls['matches'].append(g_id) or {'_id': g_id})
+        mock_calls['matches'].clear()
+        assert crawler.crawl_rank('rank', 'euw1', 'GOLD', 'I', 1)
+        assert 'EUW1_a' in mock_calls['matches']
+        assert crawler.db.count_matches() == 2
+        assert crawler.db.get_retries('rank') == []
+
+    def test_failed_match_given_up(self, crawler):
+        for _ in range(3):
+            crawler.db.write_batch([], {}, failed=[('rank', 'EUW1_a')])
+        assert crawler.db.get_retries('rank') == []
+
+
+class TestRevisits:
+
+    @pytest.fixture()
+    def mock_calls(self, monkeypatch):
+        calls = {'pages': {1: [{'summonerId': 'a', 'puuid': 'a', 'wins': 1, 'losses': 0}], 2: []},
+                 'matchlists': []}
+        monkeypatch.setattr(Crawler, "summoner_entries",
+                            lambda _, region, tier, division, page: calls['pages'][page])
+        monkeypatch.setattr(Crawler, "clash_matches_by_puuid",
+                            lambda _, region, puuids, journal=None: calls['matchlists'].extend(puuids) or [])
+        return calls
+
+    def test_unchanged_page_skipped(self, crawler, mock_calls):
+        assert crawler.crawl_rank(101010, 'euw1', 'GOLD', 'I', 1)
+        assert crawler.crawl_rank(101010, 'euw1', 'GOLD', 'I', 1)
+        assert mock_calls['matchlists'] == ['a']
+        # a played again
+        mock_calls['pages'][1][0]['wins'] = 2
+        assert crawler.crawl_rank(101010, 'euw1', 'GOLD', 'I', 1)
+        assert mock_calls['matchlists'] == ['a', 'a']
+
+    def test_daemon_revisits(self, mock_calls, monkeypatch):
+        crawler = Crawler("RGAPI-notanapi", increase_key_counter, None, revisit_every=timedelta(0))
+        marked = []
+        mark_as_crawled = Database.mark_as_crawled
+
+        def mark_and_stop(db, id, next_visit=None):
+            marked.append(id)
+            mark_as_crawled(db, id, next_visit)
+            if len(marked) == 3:
+                crawler.stop()
+
+        monkeypatch.setattr(Database, "mark_as_crawled", mark_and_stop)
+        crawler.run_daemon()
+        # crawled again and again without resetting ReDiTi
+        assert marked == [101010] * 3
+        assert crawler.db.db_rediti.count_documents({}) == 1
+        assert mock_calls['matchlists'] == ['a']
+
+    def test_daemon_survives_errors(self, mock_calls, monkeypatch):
+        crawler = Crawler("RGAPI-notanapi", increase_key_counter, None)
+        monkeypatch.setattr(data_crawler, "DAEMON_ERROR_BACKOFF", 0.01)
+        crawl = Crawler.crawl
+        passes = []
+
+        def crawl_failing_once(self):
+            passes.append(len(passes))
+            if len(passes) == 1:
+                raise ConnectionError("mongo hiccup")
+            crawled = crawl(self)
+            self.stop()
+            return crawled
+
+        monkeypatch.setattr(Crawler, "crawl", crawl_failing_once)
+        crawler.run_daemon()
+        assert passes == [0, 1]
+        assert mock_calls['matchlists'] == ['a']
+
+    def test_failed_rank_released(self, crawler, mock_calls, monkeypatch):
+        def crawl_rank_failing(*_):
+            raise ConnectionError("mongo hiccup")
+
+        monkeypatch.setattr(crawler, "crawl_rank", crawl_rank_failing)
+        assert crawler.crawl() == 0
+        assert crawler.db.leases == set()
+        rank = crawler.db.db_rediti.find_one({'_id': 101010})
+        assert rank['owner'] is None and not rank['crawled']
+        # another worker takes it over
+        other = Database(None)
+        other.db_rediti = crawler.db.db_rediti
+        assert [rank[0] for rank in other.ranks2crawl()] == [101010]
@@ -0,0 +1,125 @@
+import json
+import os
+from datetime import datetime, timedelta
+from mooncaker.external_tools.dataset_export import (MANIFEST, NPY_HEADER_SIZE, NO_VALUE, PLAYERS, export_dataset,
+                                                     load_players, open_column, read_manifest)
+from mooncaker.external_tools.db_interactor import Database
+from tests.test_csv_export import match
+
+
+NOW = datetime(2021, 7, 1)
+
+
+def store(db, docs, when):
+    db.db_matches.insert_many([dict(doc, stored=when) for doc in docs])
+
+
+def column(root, partition, name):
+    return list(open_column(os.path.join(root, partition['path'], f"{name}.npy")))
+
+
+class TestExport:
+
+    def test_partitions(self, tmp_path):
+        db = Database(None)
+        store(db, [match("EUW1_2", "euw1", "11.10"), match("EUW1_1", "euw1", "11.10"),
+                   match("KR_1", "kr", "11.10")], NOW - timedelta(hours=1))
+        assert export_dataset(db, str(tmp_path), now=NOW) == {"matches": 3, "parts": 2}
+        partitions = read_manifest(str(tmp_path))['partitions']
+        assert [(p['patch'], p['region'], p['rows']) for p in partitions] == [("11.10", "euw1", 2), ("11.10", "kr", 1)]
+        assert column(tmp_path, partitions[0], "game_id") == [1, 2]
+        assert column(tmp_path, partitions[0], "team2_id") == [200, 200]
+        assert column(tmp_path, partitions[0], "team1_ban4") == [5, 5]
+        players = load_players(str(tmp_path))
+        assert [players[code] for code in column(tmp_path, partitions[1], "team1_mid_player")] == ["KR_1-MID"]
+        with open(os.path.join(tmp_path, partitions[0]['path'], "duration.npy"), "rb") as npy_file:
+            header = npy_file.read(NPY_HEADER_SIZE)
+        assert header.startswith(b"\x93NUMPY\x01\x00") and header.endswith(b" \n")
+        assert b"'descr': '<i4', 'fortran_order': False, 'shape': (2,)" in header
+
+    def test_missing_values(self, tmp_path):
+        db = Database(None)
+        doc = match("EUW1_1", "euw1", "11.10")
+        doc["team1"]["bans"] = []
+        del doc["team2"]["TOP"]
+        store(db, [doc], NOW - timedelta(hours=1))
+        export_dataset(db, str(tmp_path), now=NOW)
+        partition = read_manifest(str(tmp_path))['partitions'][0]
+        assert column(tmp_path, partition, "team1_ban0") == [NO_VALUE]
+        assert column(tmp_path, partition, "team2_top_player") == [NO_VALUE]
+
+    def test_incremental(self, tmp_path):
+        db = Database(None)
+        store(db, [match("EUW1_1", "euw1", "11.10")], NOW - timedelta(hours=1))
+        # not settled yet, left to the next export
+        store(db, [match("EUW1_2", "euw1", "11.10")], NOW)
+        assert export_dataset(db, str(tmp_path), now=NOW)["matches"] == 1
+        store(db, [match("KR_1", "kr", "11.11")], NOW + timedelta(hours=1))
+        assert export_dataset(db, str(tmp_path), now=NOW + timedelta(hours=2)) == {"matches": 2, "parts": 2}
+        partitions = read_manifest(str(tmp_path))['partitions']
+        assert [p['path'].split(os.sep)[-1] for p in partitions] == ["part-00000", "part-00001", "part-00000"]
+        assert column(tmp_path, partitions[1], "game_id") == [2]
+        # the players of the first export keep their codes
+        assert load_players(str(tmp_path))[column(tmp_path, partitions[0], "team1_top_player")[0]] == "EUW1_1-TOP"
+        assert len(load_players(str(tmp_path))) == 15
+
+    def test_interrupted_export(self, tmp_path):
+        db = Database(None)
+        store(db, [match("EUW1_1", "euw1", "11.10")], NOW - timedelta(hours=1))
+        export_dataset(db, str(tmp_path), now=NOW)
+        with open(os.path.join(tmp_path, MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+        store(db, [match("EUW1_2", "euw1", "11.10")], NOW + timedelta(hours=1))
+        export_dataset(db, str(tmp_path), now=NOW + timedelta(hours=2))
+        # as if the second export stopped before writing its manifest
+        with open(os.path.join(tmp_path, MANIFEST), "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        assert export_dataset(db, str(tmp_path), now=NOW + timedelta(hours=2)) == {"matches": 1, "parts": 1}
+        assert len(load_players(str(tmp_path))) == 10
+        assert os.path.getsize(os.path.join(tmp_path, PLAYERS)) == NPY_HEADER_SIZE + 10 * 78
+
+    def test_rebuild(self, tmp_path):
+        db = Database(None)
+        store(db, [match("EUW1_1", "euw1", "11.10")], NOW - timedelta(hours=1))
+        export_dataset(db, str(tmp_path), now=NOW)
+        export_dataset(db, str(tmp_path), now=NOW)
+        assert export_dataset(db, str(tmp_path), rebuild=True, now=NOW) == {"matches": 1, "parts": 1}
+        assert len(read_manifest(str(tmp_path))['partitions']) == 1
+
+    def test_reprocessed_partition(self, tmp_path):
+        db = Database(None)
+        store(db, [match("EUW1_1", "euw1", "11.10"), match("KR_1", "kr", "11.10")], NOW - timedelta(hours=1))
+        export_dataset(db, str(tmp_path), now=NOW)
+        store(db, [match("EUW1_2", "euw1", "11.10")], NOW + timedelta(hours=1))
+        export_dataset(db, str(tmp_path), now=NOW + timedelta(hours=2))
+        rebuilt = match("EUW1_1", "euw1", "11.10")
+        rebuilt["duration"] = 1234
+        db.replace_matches([rebuilt])
+        assert export_dataset(db, str(tmp_path), now=NOW + timedelta(hours=2)) == {"matches": 2, "parts": 1}
+        partitions = read_manifest(str(tmp_path))['partitions']
+        assert [(p['region'], p['path'].split(os.sep)[-1], p['rows']) for p in partitions] == [
+            ("kr", "part-00000", 1), ("euw1", "part-00002", 2)]
+        assert column(tmp_path, partitions[1], "duration") == [1234, match("EUW1_2", "euw1", "11.10")["duration"]]
+        assert sorted(os.listdir(os.path.join(tmp_path, "patch=11.10", "region=euw1"))) == ["part-00002"]
+        # nothing changed since
+        assert export_dataset(db, str(tmp_path), now=NOW + timedelta(hours=2)) == {"matches": 0, "parts": 0}
+
+    def test_late_and_deleted_matches(self, tmp_path):
+        db = Database(None)
+        store(db, [match("EUW1_1", "euw1", "11.10"), match("KR_1", "kr", "11.10")], NOW - timedelta(hours=1))
+        export_dataset(db, str(tmp_path), now=NOW)
+        # committed after the export, with an earlier stored time
+        store(db, [match("EUW1_2", "euw1", "11.10")], NOW - timedelta(hours=2))
+        assert export_dataset(db, str(tmp_path), now=NOW) == {"matches": 2, "parts": 1}
+        db.db_matches.delete_one({'_id': "KR_1"})
+        assert export_dataset(db, str(tmp_path), now=NOW) == {"matches": 0, "parts": 0}
+        partitions = read_manifest(str(tmp_path))['partitions']
+        assert [(p['region'], p['path'].split(os.sep)[-1], p['rows']) for p in partitions] == [
+            ("euw1", "part-00001", 2)]
+        assert not os.path.exists(os.path.join(tmp_path, "patch=11.10", "region=kr", "part-00000"))
+
+
+def test_matches_stored_with_time():
+    db = Database(None)
+    db.insert_matches([match("EUW1_1", "euw1", "11.10")])
+    assert isinstance(db.db_matches.find_one({'_id': "EUW1_1"})['stored'], datetime)
@@ -0,0 +1,251 @@
+import time
+from datetime import datetime, timedelta
+import pytest
+from threading import Thread
+from pymongo.errors import AutoReconnect
+from mooncaker.external_tools import db_interactor
+from mooncaker.external_tools.db_interactor import Database, KnownMatchIndex, BulkWriter, LRUCache, NOT_CACHED
+
+
+@pytest.fixture()
+def db():
+    return Database(None)
+
+
+class TestLRUCache:
+
+    def test_expiry(self):
+        cache = LRUCache(10)
+        now = datetime(2021, 7, 1)
+        cache.put("not found", None, now + timedelta(days=1))
+        assert cache.get("not found", NOT_CACHED, now) is None
+        assert cache.get("not found", NOT_CACHED, now + timedelta(days=1)) is NOT_CACHED
+        assert "not found" not in cache.items
+
+    def test_eviction_while_reading(self):
+        # a key evicted by another thread between the lookup and the read is just missing
+        cache = LRUCache(2)
+
+        def put():
+            for i in range(2000):
+                cache.put(i % 5, i)
+
+        writer = Thread(target=put)
+        writer.start()
+        for i in range(2000):
+            cache.get(i % 5)
+        writer.join()
+        assert len(cache.items) == 2
+
+
+class TestKnownMatchIndex:
+
+    def test_pack(self):
+        assert KnownMatchIndex.pack('EUW1_5312345678') != KnownMatchIndex.pack('EUN1_5312345678')
+        assert KnownMatchIndex.pack('OC1_123') is None
+        assert KnownMatchIndex.pack(123) is None
+
+    def test_membership(self):
+        index = KnownMatchIndex()
+        index.add(['EUW1_1', 'KR_2', 'weird_id', 3])
+        for match_id in ['EUW1_1', 'KR_2', 'weird_id', 3]:
+            assert match_id in index
+        assert 'EUW1_2' not in index
+        assert len(index) == 4
+        assert index.memory_usage() > 0
+
+    def test_rebuild(self, db):
+        db.db_matches.insert_many([{'_id': f'EUW1_{i}'} for i in range(25)])
+        index = KnownMatchIndex()
+        index.rebuild(db.db_matches)
+        assert len(index) == 25
+        assert 'EUW1_24' in index
+
+
+class TestFilterDuplicates:
+
+    def test_filter(self, db):
+        db.db_matches.insert_many([{'_id': 'EUW1_1'}, {'_id': 'EUW1_2'}])
+        db.known_matches.add(['EUW1_3'])
+        filtered = db.filter_match_duplicates(['EUW1_4', 'EUW1_1', 'EUW1_3', 'EUW1_4', 'EUW1_5', 'EUW1_2'])
+        assert filtered == ['EUW1_4', 'EUW1_5']
+        # duplicates found in the database are remembered
+        assert 'EUW1_1' in db.known_matches
+
+    def test_insert_updates_index(self, db):
+        db.insert_match_page(101010, [{'_id': 'KR_7'}], 2)
+        assert 'KR_7' in db.known_matches
+        assert db.filter_match_duplicates(['KR_7']) == []
+
+
+class TestBulkWriter:
+
+    def test_flush_on_size(self, db):
+        writer = BulkWriter(db, max_docs=3, max_delay=60)
+        writer.add([{'_id': 'EUW1_1'}, {'_id': 'EUW1_2'}])
+        assert db.count_matches() == 0
+        writer.add([{'_id': 'EUW1_3'}])
+        assert db.count_matches() == 3
+        assert writer.stats()['flushes'] == 1
+        assert writer.stats()['avg_batch'] == 3
+
+    def test_flush_on_time(self, db):
+        writer = BulkWriter(db, max_docs=100, max_delay=0.05)
+        writer.add([{'_id': 'EUW1_1'}])
+        time.sleep(0.3)
+        assert db.count_matches() == 1
+        writer.close()
+
+    def test_duplicates_tolerated(self, db):
+        db.insert_matches([{'_id': 'EUW1_1', 'patch': '11.1'}])
+        writer = BulkWriter(db)
+        writer.add([{'_id': 'EUW1_1', 'patch': '11.2'}, {'_id': 'EUW1_2', 'patch': '11.2'}])
+        writer.flush()
+        assert db.count_matches() == 2
+        assert db.db_matches.find_one({'_id': 'EUW1_1'})['patch'] == '11.1'
+        assert writer.stats()['duplicates'] == 1
+        assert writer.stats()['written'] == 1
+
+    def test_checkpoint_with_docs(self, db):
+        db.db_rediti.insert_one({'_id': 'rank', 'page': 1})
+        writer = BulkWriter(db)
+        writer.add([{'_id': 'EUW1_1'}])
+        writer.checkpoint('rank', 2, "fingerprint")
+        writer.flush()
+        assert db.db_rediti.find_one({'_id': 'rank'})['page'] == 2
+        assert db.page_fingerprints('rank') == {'1': "fingerprint"}
+        assert writer.stats()['flushes'] == 1
+
+
+    def test_failed_periodic_flush(self, db, monkeypatch):
+        db.db_rediti.insert_one({'_id': 'rank', 'page': 1})
+        write_batch = Database.write_batch
+        failures = []
+
+        def failing_once(*args):
+            if not failures:
+                failures.append(args)
+                raise ConnectionError("mongo hiccup")
+            return write_batch(*args)
+
+        monkeypatch.setattr(Database, "write_batch", failing_once)
+        writer = BulkWriter(db, max_docs=100, max_delay=0.05)
+        writer.add([{'_id': 'EUW1_1'}])
+        writer.checkpoint('rank', 2)
+        time.sleep(0.3)
+        # the timer survived and wrote the batch it had taken on the next round
+        assert failures and writer.timer.is_alive()
+        assert db.count_matches() == 1
+        assert db.db_rediti.find_one({'_id': 'rank'})['page'] == 2
+        writer.close()
+
+class TestFrontier:
+
+    @pytest.fixture()
+    def workers(self, db):
+        other = Database(None)
+        other.db_rediti = db.db_rediti
+        other.db_journal = db.db_journal
+        db.db_rediti.delete_many({})  # the rank of the mock has a random region
+        db.db_rediti.insert_many([{'_id': i, 'region': 'euw1' if i % 2 else 'kr', 'tier': 'GOLD',
+                                   'division': 'I', 'page': 1, 'crawled': False} for i in range(4)])
+        return db, other
+
+    def test_claims_are_exclusive(self, workers):
+        first, second = workers
+        claimed = [rank[0] for rank in first.ranks2crawl()]
+        assert sorted(claimed) == [0, 1, 2, 3]
+        assert list(second.ranks2crawl()) == []
+
+    def test_workers_split_ranks(self, workers):
+        first, second = workers
+        ranks = [first.ranks2crawl(), second.ranks2crawl()]
+        claimed = [next(ranks[index % 2])[0] for index in range(4)]
+        assert len(set(claimed)) == 4
+
+    def test_region_filter(self, workers):
+        first, _ = workers
+        assert sorted(rank[0] for rank in first.ranks2crawl('kr')) == [0, 2]
+
+    def test_release_and_crawled(self, workers):
+        first, second = workers
+        rank = first.claim_rank()
+        first.release_rank(rank['_id'])
+        assert second.claim_rank(exclude=[r for r in range(4) if r != rank['_id']])['_id'] == rank['_id']
+        second.mark_as_crawled(rank['_id'])
+        assert rank['_id'] not in [r[0] for r in first.ranks2crawl()]
+
+    def test_expired_lease_reclaimed(self, workers):
+        first, second = workers
+        for _ in first.ranks2crawl():
+            pass
+        # first crashed and stopped renewing its leases
+        first.db_rediti.update_many({}, {'$set': {'lease_expires': datetime.utcnow() - timedelta(seconds=1)}})
+        assert len(list(second.ranks2crawl())) == 4
+
+    def test_heartbeat_survives_errors(self, workers, monkeypatch):
+        first, _ = workers
+        monkeypatch.setattr(db_interactor, "LEASE_RENEW_EVERY", 0.02)
+        monkeypatch.setattr(db_interactor, "LEASE_RETRY_EVERY", 0.01)
+        update_many = first.db_rediti.update_many
+        renewals = []
+
+        def flaky_update(*args, **kwargs):
+            renewals.append(len(renewals))
+            if len(renewals) == 1:
+                raise AutoReconnect("primary stepped down")
+            return update_many(*args, **kwargs)
+
+        monkeypatch.setattr(first.db_rediti, "update_many", flaky_update)
+        rank = first.claim_rank()
+        time.sleep(0.2)
+        heartbeat = first.heartbeat
+        assert len(renewals) > 2 and heartbeat.is_alive()
+        first.stop_heartbeat()
+        assert not heartbeat.is_alive() and first.heartbeat is None
+        assert first.db_rediti.find_one({'_id': rank['_id']})['lease_expires'] > datetime.utcnow()
+
+    def test_heartbeat_ends_without_leases(self, workers, monkeypatch):
+        first, _ = workers
+        monkeypatch.setattr(db_interactor, "LEASE_RENEW_EVERY", 0.01)
+        rank = first.claim_rank()
+        heartbeat = first.heartbeat
+        first.release_rank(rank['_id'])
+        heartbeat.join(1)
+        assert not heartbeat.is_alive() and first.heartbeat is None
+        first.claim_rank()
+        assert first.heartbeat.is_alive()
+        first.stop_heartbeat()
+
+
+class TestRevisits:
+
+    @pytest.fixture()
+    def ranks(self, db):
+        db.db_rediti.delete_many({})
+        now = datetime.utcnow()
+        db.db_rediti.insert_many([{'_id': i, 'region': 'euw1', 'tier': 'GOLD', 'division': division, 'page': 5,
+                                   'crawled': True, 'next_visit': now + timedelta(hours=hours),
+                                   'fingerprints': {'1': "fingerprint"}}
+                                  for i, (division, hours) in enumerate([('I', -1), ('II', 1), ('III', -2)])])
+        return db
+
+    def test_reopen_due(self, ranks):
+        assert ranks.reopen_due_ranks(timedelta(days=1)) == 2
+        reopened = {rank['_id']: rank for rank in ranks.db_rediti.find({'crawled': False})}
+        assert sorted(reopened) == [0, 2]
+        assert all(rank['page'] == 1 and rank['fingerprints'] == {'1': "fingerprint"} for rank in reopened.values())
+        assert ranks.reopen_due_ranks(timedelta(days=1)) == 0
+
+    def test_postpone_low_yield(self, ranks):
+        ranks.db_rank_stats.insert_many([{'_id': "euw1:GOLD:I", 'calls': 1000, 'docs': 1},
+                                         {'_id': "euw1:GOLD:II", 'calls': 1000, 'docs': 500}])
+        assert ranks.reopen_due_ranks(timedelta(days=1)) == 1
+        postponed = ranks.db_rediti.find_one({'_id': 0})
+        assert postponed['crawled'] and postponed['next_visit'] > datetime.utcnow() + timedelta(hours=23)
+        assert ranks.db_rank_stats.find_one({'_id': "euw1:GOLD:I"})['skipped'] == 1
+
+    def test_next_visit(self, ranks):
+        assert ranks.next_visit() < datetime.utcnow() - timedelta(hours=1)
+        ranks.db_rediti.delete_many({})
+        assert ranks.next_visit() is None
@@ -0,0 +1,120 @@
+import csv
+import fcntl
+import gzip
+import io
+import os
+from datetime import datetime, timedelta
+from threading import Thread
+import pytest
+from mooncaker.external_tools.db_interactor import Database
+from mooncaker.external_tools.export_cache import ExportCache
+from tests.test_csv_export import match
+
+
+NOW = datetime(2021, 7, 1)
+
+
+def store(db, match_id, when):
+    db.db_matches.insert_one(dict(match(match_id, "euw1", "11.10"), stored=when))
+
+
+def ids(export):
+    with gzip.open(export['path'], "rt") as csv_file:
+        rows = list(csv.reader(io.StringIO(csv_file.read())))
+    assert rows[0][0] == "_id"
+    return [row[0] for row in rows[1:]]
+
+
+@pytest.fixture
+def db():
+    db = Database(None)
+    store(db, "EUW1_2", NOW)
+    store(db, "EUW1_1", NOW)
+    return db
+
+
+class TestExportCache:
+
+    def test_cached(self, db, tmp_path):
+        cache = ExportCache(db, str(tmp_path))
+        export = cache.current()
+        assert ids(export) == ["EUW1_1", "EUW1_2"]
+        assert export['rows'] == 2 and export['size'] == os.path.getsize(export['path'])
+        assert cache.current() == export
+
+    def test_append(self, db, tmp_path):
+        cache = ExportCache(db, str(tmp_path))
+        first = cache.current()
+        store(db, "EUW1_0", NOW + timedelta(minutes=1))
+        export = cache.current()
+        assert export['etag'] != first['etag']
+        # appended after the ones already exported, without a second header
+        assert ids(export) == ["EUW1_1", "EUW1_2", "EUW1_0"]
+        # the previous version is removed by the next update only
+        assert os.path.exists(first['path'])
+        store(db, "EUW1_3", NOW + timedelta(minutes=2))
+        cache.current()
+        assert not os.path.exists(first['path']) and os.path.exists(export['path'])
+
+    def test_locked_by_other_processes(self, db, tmp_path):
+        cache = ExportCache(db, str(tmp_path))
+        cache.current()
+        # left behind by a process stopped while writing
+        orphan = tmp_path / "matches-0123.csv.gz"
+        orphan.write_bytes(b"")
+        with open(tmp_path / "matches.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            store(db, "EUW1_0", NOW + timedelta(minutes=1))
+            updating = Thread(target=cache.current)
+            updating.start()
+            updating.join(0.2)
+            assert updating.is_alive()
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        updating.join()
+        assert cache.read_meta()['rows'] == 3
+        assert not orphan.exists()
+
+    def test_rebuild_when_missing_matches(self, db, tmp_path):
+        cache = ExportCache(db, str(tmp_path))
+        cache.current()
+        db.db_matches.delete_one({'_id': "EUW1_1"})
+        assert ids(cache.current()) == ["EUW1_2"]
+        # a match committed late, stored before the last one exported
+        store(db, "EUW1_3", NOW - timedelta(minutes=1))
+        assert ids(cache.current()) == ["EUW1_2", "EUW1_3"]
+
+    def test_rebuilt_matches(self, db, tmp_path):
+        cache = ExportCache(db, str(tmp_path))
+        first = cache.current()
+        # reprocess rebuilds one match, the number of rows doesn't change
+        db.replace_matches([dict(match("EUW1_1", "euw1", "11.10"), duration=1200)])
+        assert db.db_matches.find_one({'_id': "EUW1_1"})['stored'] == NOW
+        export = cache.current()
+        assert export['etag'] != first['etag'] and export['rows'] == 2
+        with gzip.open(export['path'], "rt") as csv_file:
+            assert "1200" in csv_file.read()
+        assert cache.current() == export
+
+    def test_no_stored_time(self, db, tmp_path):
+        cache = ExportCache(db, str(tmp_path))
+        cache.current()
+        db.db_matches.update_many({}, {'$unset': {'stored': 1}})
+        assert ids(cache.current()) == ["EUW1_1", "EUW1_2"]
+        assert cache.update(cache.read_meta(), None)['rows'] == 2
+
+    def test_legacy_matches(self, tmp_path):
+        db = Database(None)
+        db.db_matches.insert_one(match("EUW1_1", "euw1", "11.10"))
+        cache = ExportCache(db, str(tmp_path))
+        assert ids(cache.current()) == ["EUW1_1"]
+        store(db, "EUW1_2", NOW)
+        assert ids(cache.current()) == ["EUW1_1", "EUW1_2"]
+
+    def test_file_id(self, db, tmp_path):
+        cache = ExportCache(db, str(tmp_path))
+        export = cache.current()
+        cache.set_file_id(export['etag'], "telegram-file")
+        assert cache.current()['file_id'] == "telegram-file"
+        store(db, "EUW1_0", NOW + timedelta(minutes=1))
+        cache.set_file_id(export['etag'], "stale-file")
+        assert cache.current()['file_id'] is None
@@ -0,0 +1,49 @@
+from threading import Thread
+import pytest
+from benchmarks.fake_riot_api import FakeRiotApi
+from benchmarks.crawl_throughput import set_ranks
+from mooncaker.external_tools.data_crawler import Crawler
+from tests.test_data_crawler import increase_key_counter
+
+
+class TestFakeRiotApi:
+
+    def test_rate_limits(self):
+        api = FakeRiotApi(app_limits="2:10", method_limits="5:10")
+        for _ in range(2):
+            status, headers, _ = api.respond("/europe/lol/match/v5/matches/EUW1_1", {})
+            assert status == 200
+        assert headers["X-App-Rate-Limit-Count"] == "2:10"
+        status, headers, _ = api.respond("/europe/lol/match/v5/matches/EUW1_1", {})
+        assert status == 429
+        assert headers["X-Rate-Limit-Type"] == "application"
+        assert int(headers["Retry-After"]) > 0
+        # every routing value has its own limits
+        assert api.respond("/asia/lol/match/v5/matches/KR_1", {})[0] == 200
+
+    def test_matchlists_overlap(self):
+        api = FakeRiotApi(matches_per_player=10, match_pool=15)
+        first = api.matchlist("puuid.euw1.GOLD.I.1.0", {"count": ["100"]})
+        second = api.matchlist("puuid.euw1.GOLD.I.1.1", {"count": ["100"]})
+        assert len(first) == 10 and set(first) & set(second)
+        assert api.matchlist("puuid.euw1.GOLD.I.1.0", {"start": ["5"], "count": ["100"]}) == first[5:]
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_crawl(concurrent):
+    api = FakeRiotApi(pages=1, entries_per_page=4, matches_per_player=3, match_pool=8, timeline_rate=0.5,
+                      events_per_frame=2)
+    server = api.server()
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        crawler = Crawler("RGAPI-notanapi", increase_key_counter, None, concurrent=concurrent, max_in_flight=2,
+                          api_url=f"http://127.0.0.1:{server.server_address[1]}/{{platform}}")
+        set_ranks(crawler.db, 2)
+        crawler.start_crawling()
+    finally:
+        server.shutdown()
+        server.server_close()
+    stats = api.stats()
+    assert crawler.db.count_matches() == stats["requests"]["match.by_id"] > 0
+    assert stats["requests"]["match.timeline_by_match"] > 0
+    assert crawler.role_sources['timeline'] == stats["requests"]["match.timeline_by_match"]
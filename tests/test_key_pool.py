@@ -0,0 +1,79 @@
+from threading import Thread
+import pytest
+from benchmarks.fake_riot_api import FakeRiotApi
+from benchmarks.crawl_throughput import set_ranks
+from mooncaker.external_tools.data_crawler import Crawler
+from mooncaker.external_tools.key_pool import KeyPool
+from mooncaker.external_tools.rate_limiter import HeaderRateLimiter
+
+
+class FakeWatcher:
+    def __init__(self, key):
+        self.key = key
+
+
+def make_watcher(key):
+    return FakeWatcher(key), HeaderRateLimiter(app_limits="2:10")
+
+
+def no_new_key():
+    pytest.fail("The pool should not wait for a key")
+
+
+class TestKeyPool:
+
+    def test_spreads_calls(self):
+        pool = KeyPool(make_watcher, no_new_key)
+        pool.add("a")
+        pool.add("b")
+        keys = [pool.watcher("euw1", "LeagueApiV4", "entries").key for _ in range(4)]
+        assert sorted(keys) == ["a", "a", "b", "b"]
+
+    def test_prefers_free_budget(self):
+        pool = KeyPool(make_watcher, no_new_key)
+        pool.add("a")
+        pool.add("b")
+        limiter = pool.keys["a"][1]
+        for _ in range(2):
+            limiter.wait_until("euw1", "LeagueApiV4", "entries")
+        assert all(pool.watcher("euw1", "LeagueApiV4", "entries").key == "b" for _ in range(3))
+        # the budget of a key is spent only on its own routing value
+        assert pool.watcher("kr", "LeagueApiV4", "entries") is not None
+
+    def test_retire(self):
+        pool = KeyPool(make_watcher, no_new_key)
+        pool.add("a")
+        pool.add("b")
+        stale = pool.keys["a"][0]
+        assert pool.retire(stale)
+        assert not pool.retire(stale)
+        assert len(pool) == 1
+        assert pool.watcher("euw1", "LeagueApiV4", "entries").key == "b"
+
+    def test_waits_only_when_empty(self):
+        pool = KeyPool(make_watcher, lambda: "c")
+        assert pool.watcher("euw1", "LeagueApiV4", "entries").key == "c"
+
+    def test_polls_new_keys(self):
+        new_keys = [["b"], []]
+        pool = KeyPool(make_watcher, no_new_key, lambda: new_keys.pop(0))
+        pool.add("a")
+        pool.poll()
+        assert sorted(pool.keys) == ["a", "b"]
+
+
+def test_crawl_with_revoked_key():
+    api = FakeRiotApi(pages=1, entries_per_page=2, matches_per_player=2, match_pool=4, timeline_rate=0.0,
+                      revoked_keys=["RGAPI-expired"])
+    server = api.server()
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        crawler = Crawler(["RGAPI-expired", "RGAPI-valid"], no_new_key, None,
+                          api_url=f"http://127.0.0.1:{server.server_address[1]}/{{platform}}")
+        set_ranks(crawler.db, 1)
+        crawler.start_crawling()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert list(crawler.keys.keys) == ["RGAPI-valid"]
+    assert crawler.db.count_matches() == api.stats()["requests"]["match.by_id"] > 0
@@ -0,0 +1,93 @@
+import logging
+import os
+import pytest
+from mooncaker.external_tools import logger
+from mooncaker.external_tools.logger import SharedRotatingFileHandler, log, set_levels
+
+
+class Formatted:
+    def __init__(self):
+        self.times = 0
+
+    def __str__(self):
+        self.times += 1
+        return "formatted"
+
+
+@pytest.fixture
+def domain():
+    yield "testdomain"
+    logger.domain_logger("testdomain").setLevel(logging.NOTSET)
+
+
+class TestLog:
+
+    def test_lazy_formatting(self, domain, caplog):
+        argument = Formatted()
+        set_levels(f"{domain}=warning")
+        log(domain, logging.INFO, "not %s", argument)
+        assert argument.times == 0
+        with caplog.at_level(logging.DEBUG):
+            log(domain, logging.WARNING, "now %s", argument)
+        assert caplog.records[-1].getMessage() == "now formatted"
+
+    def test_sampling(self, domain, caplog):
+        with caplog.at_level(logging.DEBUG):
+            for call in range(7):
+                log(domain, logging.INFO, "call %d", call, every=3)
+        assert [record.getMessage() for record in caplog.records] == ["call 0", "call 3", "call 6"]
+
+    def test_written_by_the_listener(self, domain):
+        log(domain, logging.WARNING, "written %s", "later")
+        logger.stop_listener()
+        with open(logger.log_path()) as logfile:
+            assert logfile.readlines()[-1].endswith(f"WARNING  {domain}: written later\n")
+
+
+def test_rotation_shared_by_processes(tmp_path):
+    path = str(tmp_path / "shared.log")
+    first, second = (SharedRotatingFileHandler(path, maxBytes=100, backupCount=2) for _ in range(2))
+    record = logging.LogRecord("mooncaker.logger.test", logging.INFO, "", 0, "x" * 60, None, None)
+    first.emit(record)
+    first.emit(record)
+    # the second handler writes to the file the first one opened after rotating, not to the backup
+    second.emit(logging.LogRecord("mooncaker.logger.test", logging.INFO, "", 0, "y" * 30, None, None))
+    for handler in (first, second):
+        handler.close()
+    assert os.path.getsize(path) == 61 + 31
+    assert os.path.getsize(path + ".1") == 61
+
+
+class TestRead:
+
+    def test_tail(self, tmp_path, monkeypatch):
+        path = str(tmp_path / "test.log")
+        with open(path, "w") as logfile:
+            logfile.writelines(f"line {number}\n" for number in range(1000))
+        # the lines span several blocks
+        monkeypatch.setattr(logger, "TAIL_BLOCK_SIZE", 16)
+        assert logger.tail_log(3, path) == ["line 997\n", "line 998\n", "line 999\n"]
+        assert len(logger.tail_log(2000, path)) == 1000
+        assert logger.tail_log(0, path) == []
+        assert logger.tail_log(3, str(tmp_path / "missing.log")) == []
+
+    def test_follow(self, tmp_path):
+        path = str(tmp_path / "test.log")
+        with open(path, "w") as logfile:
+            logfile.write("old\n")
+        offset, inode = logger.log_position(path)
+        with open(path, "a") as logfile:
+            logfile.write("new\nhalf")
+        lines, offset, inode = logger.read_log(offset, inode, path)
+        assert lines == ["new\n"]
+        with open(path, "a") as logfile:
+            logfile.write(" line\n")
+        lines, offset, inode = logger.read_log(offset, inode, path)
+        assert lines == ["half line\n"]
+        assert logger.read_log(offset, inode, path)[0] == []
+        # rotated: the new log is read from its start
+        os.rename(path, path + ".1")
+        line = "first line of the new log, longer than what was read of the old one\n"
+        with open(path, "w") as logfile:
+            logfile.write(line)
+        assert logger.read_log(offset, inode, path)[0] == [line]
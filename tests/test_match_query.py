@@ -0,0 +1,78 @@
+import pytest
+from mooncaker.external_tools.db_interactor import Database
+from mooncaker.external_tools.match_query import MATCH_INDEXES, match_query, parse_arguments, query_projection
+from tests.test_csv_export import match
+
+
+def played(match_id, patch, champion, role, team="team2", winner=100, duration=1800):
+    doc = dict(match(match_id, "euw1", patch), winner=winner, duration=duration)
+    doc[team] = dict(doc[team], **{role: {"summonerId": f"{match_id}-{role}", "champion": champion}})
+    return doc
+
+
+@pytest.fixture
+def db():
+    db = Database(None)
+    db.db_matches.insert_many([played("EUW1_1", "11.14", 64, "JUNGLE"), played("EUW1_2", "11.14", 64, "TOP"),
+                               played("EUW1_3", "11.9", 64, "JUNGLE", "team1", winner=200),
+                               played("EUW1_4", "11.14", 64, "JUNGLE", duration=1200),
+                               match("KR_1", "kr", "11.14")])
+    return db
+
+
+def ids(matches):
+    return [doc['_id'] for doc in matches]
+
+
+class TestQuery:
+
+    def test_champion_by_role(self, db):
+        matches, after = db.query_matches(patch="11.14", region="EUW1", champion=64, role="jungle")
+        assert ids(matches) == ["EUW1_1", "EUW1_4"] and after is None
+        assert ids(db.query_matches(champion=64)[0]) == ["EUW1_1", "EUW1_2", "EUW1_3", "EUW1_4"]
+
+    def test_filters(self, db):
+        assert ids(db.query_matches(min_patch="11.10", champion=64, winner=100)[0]) == ["EUW1_1", "EUW1_2", "EUW1_4"]
+        assert ids(db.query_matches(max_patch="11.10")[0]) == ["EUW1_3"]
+        assert ids(db.query_matches(min_duration=1000, max_duration=1500)[0]) == ["EUW1_4"]
+
+    def test_pages(self, db):
+        pages = []
+        after = None
+        while True:
+            matches, after = db.query_matches(limit=2, after=after)
+            pages.append(ids(matches))
+            if after is None:
+                break
+        assert pages == [["EUW1_1", "EUW1_2"], ["EUW1_3", "EUW1_4"], ["KR_1"]]
+
+    def test_fields(self, db):
+        doc = db.query_matches(fields=["patch", "team2.JUNGLE.champion"], limit=1)[0][0]
+        assert doc == {"_id": "EUW1_1", "patch": "11.14", "team2": {"JUNGLE": {"champion": 64}}}
+        assert "stored" not in query_projection() and "team1.bans" in query_projection()
+        assert query_projection(["team1", "team1.TOP"]) == {"team1": 1}
+
+    @pytest.mark.parametrize("filters", [{"role": "JUNGLE"}, {"champion": 64, "role": "MIDDLE"},
+                                         {"patch": "latest"}, {"limit": 0}, {"fields": ["stored"]}])
+    def test_invalid(self, db, filters):
+        with pytest.raises(ValueError):
+            db.query_matches(**filters)
+
+    def test_patch_range_resolved_only_when_asked(self):
+        def patches():
+            raise AssertionError("distinct patches asked for")
+
+        assert match_query(patches, patch="11.14", after="EUW1_1") == {'patch': "11.14", '_id': {'$gt': "EUW1_1"}}
+
+    def test_arguments(self):
+        assert parse_arguments({"champion": "64", "fields": "patch,winner", "region": "", "other": "x"}) == \
+            {"champion": 64, "fields": ["patch", "winner"]}
+        with pytest.raises(ValueError):
+            parse_arguments({"limit": "all"})
+
+
+def test_indexes():
+    db = Database(None)
+    db.prepare_crawl()
+    indexed = [index['key'] for index in db.db_matches.index_information().values()]
+    assert all(keys in indexed for keys in MATCH_INDEXES)
@@ -0,0 +1,109 @@
+from datetime import datetime, timedelta
+import pytest
+from riotwatcher._apis import BaseApi
+from riotwatcher._apis.league_of_legends import LeagueApiV4
+from mooncaker.external_tools import metrics as metrics_module
+from mooncaker.external_tools.metrics import Metrics, LATENCY_BUCKETS, STALE_AFTER, render, publish
+from mooncaker.external_tools.data_crawler import Crawler
+from mooncaker.external_tools.db_interactor import Database
+from tests import test_data_crawler
+
+
+@pytest.fixture()
+def registry(monkeypatch):
+    registry = Metrics()
+    monkeypatch.setattr(metrics_module, "metrics", registry)
+    monkeypatch.setattr("mooncaker.external_tools.data_crawler.metrics", registry)
+    monkeypatch.setattr("mooncaker.external_tools.db_interactor.metrics", registry)
+    return registry
+
+
+@pytest.fixture()
+def crawler():
+    return Crawler("RGAPI-notanapi", test_data_crawler.increase_key_counter, None)
+
+
+@pytest.fixture()
+def mock_429(crawler, monkeypatch):
+    monkeypatch.setattr(BaseApi, "raw_request",
+                        lambda *_: test_data_crawler.raise_api_error(
+                            test_data_crawler.MockStatusCode(429, headers={"Retry-After": "10"})))
+    monkeypatch.setattr(crawler, "sleep", lambda *_: None)
+
+
+def values(snapshot, name):
+    return {tuple(sorted(metric['labels'].items())): metric.get('value', metric.get('count'))
+            for metric in snapshot if metric['name'] == name}
+
+
+class TestRegistry:
+
+    def test_counters_by_labels(self, registry):
+        registry.inc("calls", endpoint="a")
+        registry.inc("calls", 2, endpoint="a")
+        registry.inc("calls", endpoint="b")
+        assert values(registry.snapshot(), "calls") == {(('endpoint', 'a'),): 3, (('endpoint', 'b'),): 1}
+
+    def test_histogram_buckets(self, registry):
+        for value in (0.001, 0.005, 0.3, 60):
+            registry.observe("latency", value)
+        histogram = registry.snapshot()[0]
+        assert histogram['count'] == 4
+        assert histogram['buckets'][0] == 2  # the bounds are inclusive
+        assert histogram['buckets'][LATENCY_BUCKETS.index(0.5)] == 1
+        assert histogram['buckets'][-1] == 1
+
+
+class TestRender:
+
+    @staticmethod
+    def doc(worker, updated, value):
+        return {'_id': worker, 'updated': updated,
+                'metrics': [{'type': 'counter', 'name': "mooncaker_matches_stored_total", 'labels': {}, 'value': value},
+                            {'type': 'gauge', 'name': "mooncaker_pipeline_queue_depth",
+                             'labels': {'stage': "matches"}, 'value': value},
+                            {'type': 'histogram', 'name': "mooncaker_db_operation_seconds",
+                             'labels': {'operation': "write_batch"},
+                             'buckets': [1] + [0] * len(LATENCY_BUCKETS), 'sum': 0.001, 'count': 1}]}
+
+    def test_merge_workers(self):
+        now = datetime.utcnow()
+        text = render([self.doc("a", now, 2), self.doc("b", now, 3)])
+        assert "mooncaker_matches_stored_total 5\n" in text
+        assert 'mooncaker_pipeline_queue_depth{stage="matches",worker="a"} 2\n' in text
+        assert 'mooncaker_pipeline_queue_depth{stage="matches",worker="b"} 3\n' in text
+        assert 'mooncaker_db_operation_seconds_bucket{le="+Inf",operation="write_batch"} 2\n' in text
+        assert 'mooncaker_db_operation_seconds_count{operation="write_batch"} 2\n' in text
+        assert text.count("# TYPE mooncaker_matches_stored_total counter") == 1
+
+    def test_stale_gauges(self):
+        stale = datetime.utcnow() - timedelta(seconds=STALE_AFTER + 1)
+        text = render([self.doc("a", datetime.utcnow(), 2), self.doc("b", stale, 3)])
+        assert "mooncaker_matches_stored_total 5\n" in text
+        assert 'worker="b"' not in text
+
+    def test_publish(self, registry):
+        registry.inc("mooncaker_matches_stored_total", 4)
+        db = Database(None)
+        publish(db.db_metrics, "worker-1")
+        publish(db.db_metrics, "worker-1")
+        assert "mooncaker_matches_stored_total 4\n" in render(db.db_metrics.find())
+
+
+class TestApiCalls:
+
+    def test_success(self, registry, crawler, monkeypatch):
+        monkeypatch.setattr(LeagueApiV4, "entries", lambda *_: [])
+        crawler.summoner_entries("euw1", "GOLD", "I", 1)
+        snapshot = registry.snapshot()
+        labels = (('endpoint', 'league.entries'), ('region', 'euw1'))
+        assert values(snapshot, "mooncaker_api_requests_total") == {labels + (('status', '200'),): 1}
+        assert values(snapshot, "mooncaker_api_request_seconds") == {labels: 1}
+
+    def test_retries(self, registry, crawler, mock_429):
+        crawler.summoner_entries("euw1", "GOLD", "I", 1)
+        snapshot = registry.snapshot()
+        labels = (('endpoint', 'league.entries'), ('region', 'euw1'))
+        assert values(snapshot, "mooncaker_api_requests_total") == {labels + (('status', '429'),): 3}
+        assert values(snapshot, "mooncaker_api_retries_total") == {labels: 3}
+        assert values(snapshot, "mooncaker_api_429_sleep_seconds_total") == {labels: 30}
@@ -0,0 +1,53 @@
+import pytest
+from mooncaker.external_tools import mongo_client
+from mooncaker.external_tools.mongo_client import get_client, CLIENT_OPTIONS
+from mooncaker.external_tools.db_interactor import Database
+
+
+# nothing listens there, nothing should try to connect
+URL = "mongodb://127.0.0.1:1"
+
+
+@pytest.fixture(autouse=True)
+def clients(monkeypatch):
+    clients = {}
+    monkeypatch.setattr(mongo_client, "clients", clients)
+    return clients
+
+
+class TestClient:
+
+    def test_shared(self):
+        assert get_client(URL) is get_client(URL)
+        assert get_client(URL) is not get_client(URL + "/?appname=other")
+
+    def test_pool_options(self):
+        assert get_client(URL).max_pool_size == CLIENT_OPTIONS["maxPoolSize"]
+        assert get_client(URL + "/?maxPoolSize=7").max_pool_size == 7
+
+    def test_new_process(self, monkeypatch):
+        parent = get_client(URL)
+        monkeypatch.setattr(mongo_client.os, "getpid", lambda: -1)
+        assert get_client(URL) is not parent
+
+    def test_forget_after_fork(self, clients):
+        get_client(URL)
+        mongo_client.forget_clients()
+        assert clients == {}
+
+
+class TestLazyDatabase:
+
+    def test_no_queries_on_init(self, clients):
+        first, second = Database(URL), Database(URL)
+        assert not first.prepared
+        assert first.db_matches.database.client is second.db_rediti.database.client
+        assert len(clients) == 1
+
+    def test_prepare_once(self, monkeypatch):
+        db = Database(None)
+        calls = []
+        monkeypatch.setattr(Database, "set_rediti", lambda self: calls.append(self))
+        db.prepare_crawl()
+        db.prepare_crawl()
+        assert calls == [db]
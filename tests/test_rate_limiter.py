@@ -0,0 +1,77 @@
+import datetime
+import pytest
+from mooncaker.external_tools import rate_limiter
+from mooncaker.external_tools.rate_limiter import HeaderRateLimiter, TokenBucket, parse_limits
+
+
+class FakeClock:
+    now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(rate_limiter.time, "time", fake.time)
+    return fake
+
+
+def test_parse_limits():
+    assert parse_limits("20:1,100:120") == {1: 20, 120: 100}
+
+
+class TestTokenBucket:
+
+    def test_schedules_after_window(self):
+        bucket = TokenBucket(2, 10)
+        for _ in range(2):
+            assert bucket.next_free(0) == 0
+            bucket.spend(0)
+        assert bucket.next_free(0) == 10
+        assert bucket.next_free(10) == 10
+
+    def test_sync_adds_foreign_requests(self):
+        bucket = TokenBucket(3, 10)
+        bucket.spend(0)
+        bucket.sync(3, 1)
+        assert bucket.next_free(1) == 10
+
+
+class TestHeaderRateLimiter:
+    headers = {"X-App-Rate-Limit": "10:10",
+               "X-App-Rate-Limit-Count": "1:10",
+               "X-Method-Rate-Limit": "2:10",
+               "X-Method-Rate-Limit-Count": "1:10"}
+
+    def test_default_limits_allow_calls(self, clock):
+        limiter = HeaderRateLimiter()
+        assert limiter.wait_until("euw1", "SummonerApiV4", "by_name") is None
+
+    def test_method_limit_from_headers(self, clock):
+        limiter = HeaderRateLimiter()
+        assert limiter.wait_until("europe", "MatchApiV5", "by_id") is None
+        limiter.record_response("europe", "MatchApiV5", "by_id", 200, self.headers)
+        assert limiter.wait_until("europe", "MatchApiV5", "by_id") is None
+        wait = limiter.wait_until("europe", "MatchApiV5", "by_id")
+        assert wait == datetime.datetime.fromtimestamp(clock.now + 10)
+        # other methods and routing values have their own buckets
+        assert limiter.wait_until("europe", "MatchApiV5", "timeline_by_match") is None
+        assert limiter.wait_until("asia", "MatchApiV5", "by_id") is None
+
+    def test_reserved_budget(self, clock):
+        limiter = HeaderRateLimiter(reserved=0.5)
+        limiter.record_response("kr", "LeagueApiV4", "entries", 200,
+                                {"X-App-Rate-Limit": "4:10", "X-App-Rate-Limit-Count": "1:10"})
+        assert limiter.wait_until("kr", "LeagueApiV4", "entries") is None
+        assert limiter.wait_until("kr", "LeagueApiV4", "entries") is not None
+
+    def test_retry_after_blocks_method(self, clock):
+        limiter = HeaderRateLimiter()
+        limiter.record_response("europe", "MatchApiV5", "by_id", 200, self.headers)
+        limiter.record_response("europe", "MatchApiV5", "by_id", 429,
+                                {"Retry-After": "5", "X-Rate-Limit-Type": "method"})
+        assert limiter.wait_until("europe", "MatchApiV5", "by_id") == \
+            datetime.datetime.fromtimestamp(clock.now + 5)
+        assert limiter.wait_until("europe", "MatchApiV5", "timeline_by_match") is None
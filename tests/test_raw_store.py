@@ -0,0 +1,98 @@
+import mongomock
+import mongomock.gridfs
+import pytest
+from mooncaker.external_tools import raw_store
+from mooncaker.external_tools.raw_store import DiskRawStore, GridFSRawStore, compress, decompress
+from mooncaker.external_tools.reprocess import SKIPPED, rebuild_doc, reprocess
+from mooncaker.external_tools.db_interactor import Database
+from mooncaker.external_tools.data_crawler import Crawler
+from riotwatcher._apis.league_of_legends import MatchApiV5
+from tests import test_data_crawler
+
+
+payload = {'metadata': {'matchId': 'EUW1_1'}, 'info': {'gameVersion': '11.14.1', 'frames': [1, 2, 3]}}
+
+
+@pytest.mark.parametrize('zstd', [True, False])
+def test_compress_roundtrip(monkeypatch, zstd):
+    if not zstd:
+        monkeypatch.setattr(raw_store, 'zstandard', None)
+    elif raw_store.zstandard is None:
+        pytest.skip('zstandard is not installed')
+    blob = compress(payload)
+    assert decompress(blob) == payload
+
+
+class TestDiskRawStore:
+
+    def test_put_get(self, tmp_path):
+        store = DiskRawStore(str(tmp_path))
+        store.put('EUW1_1', 'match', payload)
+        store.put('EUW1_1', 'timeline', {'frames': []})
+        assert store.get('EUW1_1', 'match') == payload
+        assert store.get('EUW1_2', 'match') is None
+        assert list(store.match_ids()) == ['EUW1_1']
+
+    def test_never_rewritten(self, tmp_path):
+        store = DiskRawStore(str(tmp_path))
+        store.put('KR_1', 'match', payload)
+        store.put('KR_1', 'match', {})
+        assert store.get('KR_1', 'match') == payload
+
+
+class TestGridFSRawStore:
+
+    def test_put_get(self):
+        mongomock.gridfs.enable_gridfs_integration()
+        store = GridFSRawStore(mongomock.MongoClient().db)
+        try:
+            store.fs
+        except TypeError:
+            pytest.skip('the gridfs integration of mongomock does not work on this python')
+        store.put('EUW1_1', 'match', payload)
+        store.put('EUW1_1', 'match', {})
+        assert store.get('EUW1_1', 'match') == payload
+        assert store.get('EUW1_1', 'timeline') is None
+        assert list(store.match_ids()) == ['EUW1_1']
+
+
+class TestReprocess:
+
+    @pytest.fixture()
+    def store(self, tmp_path):
+        store = DiskRawStore(str(tmp_path))
+        for number in range(3):
+            match = test_data_crawler.TestParticipantRoles().match()
+            match['info']['platformId'] = 'EUW1'
+            store.put(f'EUW1_{number}', 'match', match)
+        store.put('EUW1_3', 'match', test_data_crawler.TestParticipantRoles().match(duration=200))
+        return store
+
+    def test_crawler_keeps_raw(self, tmp_path, monkeypatch):
+        crawler = Crawler("RGAPI-notanapi", test_data_crawler.increase_key_counter, None, raw_store=str(tmp_path))
+        match = test_data_crawler.TestParticipantRoles().match()
+        monkeypatch.setattr(MatchApiV5, "by_id", lambda *_: match)
+        doc = crawler.match_doc('EUW1_1', 'euw1')
+        assert crawler.raw_store.get('EUW1_1', 'match') == match
+        assert rebuild_doc('EUW1_1', store=crawler.raw_store) == ('EUW1_1', doc)
+
+    def test_missing_timeline(self, store):
+        # the roles were taken from the participants, no timeline was kept
+        assert rebuild_doc('EUW1_0', timeline_roles=True, store=store) == ('EUW1_0', SKIPPED)
+        assert rebuild_doc('EUW1_9', store=store) == ('EUW1_9', SKIPPED)
+
+    def test_missing_payloads_kept(self, store):
+        db = Database(None)
+        db.insert_matches([{'_id': f'EUW1_{number}', 'patch': 'old'} for number in range(4)])
+        assert reprocess(store.root, db, processes=2, timeline_roles=True) == {'rebuilt': 0, 'removed': 1,
+                                                                               'skipped': 3}
+        assert db.count_matches() == 3
+        assert db.db_matches.find_one({'_id': 'EUW1_0'})['patch'] == 'old'
+
+    def test_rebuild_collection(self, store):
+        db = Database(None)
+        db.insert_matches([{'_id': 'EUW1_0', 'patch': 'old'}, {'_id': 'EUW1_3', 'patch': 'old'}])
+        assert reprocess(store.root, db, processes=2) == {'rebuilt': 3, 'removed': 1, 'skipped': 0}
+        assert db.count_matches() == 3
+        assert db.db_matches.find_one({'_id': 'EUW1_0'})['patch'] == '11.14'
+        assert db.db_matches.find_one({'_id': 'EUW1_3'}) is None
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+from threading import Thread
+from benchmarks.fake_riot_api import FakeRiotApi
+from benchmarks.crawl_throughput import set_ranks
+from mooncaker.external_tools.data_crawler import Crawler
+from mooncaker.external_tools.db_interactor import Database
+from mooncaker.external_tools.scheduler import (MAX_SKIPPED, PRIOR_YIELD, REFRESH_AFTER, expected_yield,
+                                                merge, plan, priority, rank_key)
+from tests.test_data_crawler import increase_key_counter
+
+
+NOW = datetime(2021, 7, 1)
+RANKS = [("euw1", "GOLD", "I"), ("kr", "GOLD", "I"), ("na1", "GOLD", "I")]
+
+
+def crawled(docs, calls, days_ago=2, skipped=0):
+    return dict(merge({}, {'calls': calls, 'listed': 2 * docs, 'new': docs, 'docs': docs},
+                      NOW - timedelta(days=days_ago)), skipped=skipped)
+
+
+class TestPriority:
+
+    def test_prior(self):
+        assert expected_yield({}) == PRIOR_YIELD
+        assert priority({}, NOW) == PRIOR_YIELD
+
+    def test_yield_smoothed(self):
+        stats = crawled(docs=100, calls=200)
+        assert 0.2 < expected_yield(stats) < 0.5
+        assert stats['duplicate_ratio'] == 0.5
+
+    def test_freshness(self):
+        stats = crawled(docs=100, calls=200, days_ago=0)
+        assert priority(stats, NOW) == 0
+        assert priority(stats, NOW + REFRESH_AFTER / 2) == expected_yield(stats) / 2
+        assert priority(stats, NOW + 2 * REFRESH_AFTER) == expected_yield(stats)
+
+    def test_decay(self):
+        stats = merge(crawled(docs=100, calls=100), {'calls': 100, 'docs': 0}, NOW)
+        assert stats['calls'] == 150 and stats['docs'] == 50
+        assert stats['crawls'] == 2
+
+
+class TestPlan:
+
+    def test_order_by_yield(self):
+        stats = {rank_key(*RANKS[0]): crawled(docs=10, calls=500), rank_key(*RANKS[1]): crawled(docs=400, calls=500)}
+        planned = plan(RANKS, stats, NOW)
+        # never crawled ranks come with the prior yield
+        assert [rank for rank, _, _ in planned] == [RANKS[1], RANKS[2], RANKS[0]]
+        assert [skipped for _, _, skipped in planned] == [False, False, True]
+        assert plan(RANKS, stats, NOW) == planned
+
+    def test_floor(self):
+        stats = {rank_key(*RANKS[0]): crawled(docs=10, calls=500, skipped=MAX_SKIPPED)}
+        assert not any(skipped for _, _, skipped in plan(RANKS, stats, NOW))
+
+    def test_ties_keep_order(self):
+        assert [rank for rank, _, _ in plan(RANKS, {}, NOW)] == RANKS
+
+
+class TestDatabase:
+
+    def test_claim_by_priority(self):
+        db = Database(None)
+        db.db_rediti.delete_many({})
+        db.db_rediti.insert_many([{'_id': i, 'region': 'euw1', 'tier': 'GOLD', 'division': 'I', 'page': 1,
+                                   'crawled': False, 'priority': priority} for i, priority in enumerate([0.1, 0.3, 0.2])])
+        assert [rank[0] for rank in db.ranks2crawl()] == [1, 2, 0]
+
+    def test_reset_skips_low_yield(self):
+        db = Database(None)
+        db.db_rank_stats.insert_one(dict(crawled(docs=1, calls=1000), _id=rank_key("euw1", "GOLD", "I")))
+        db.reset_rediti()
+        rank = db.db_rediti.find_one({'region': "euw1", 'tier': "GOLD", 'division': "I"})
+        assert rank['crawled']
+        assert db.db_rank_stats.find_one({'_id': rank_key("euw1", "GOLD", "I")})['skipped'] == 1
+        assert db.db_rediti.count_documents({'crawled': False}) == db.db_rediti.count_documents({}) - 1
+
+    def test_record_yield(self):
+        db = Database(None)
+        stats = db.record_yield(101010, "euw1", "GOLD", "I", {'calls': 10, 'listed': 4, 'new': 3, 'docs': 3})
+        assert db.db_rank_stats.find_one({'_id': rank_key("euw1", "GOLD", "I")})['docs'] == stats['docs'] == 3
+        # just crawled, it waits for its players to play again
+        assert db.db_rediti.find_one({'_id': 101010})['priority'] == 0
+
+
+def test_crawl_tally():
+    api = FakeRiotApi(pages=1, entries_per_page=4, matches_per_player=3, match_pool=8, timeline_rate=0.5,
+                      events_per_frame=2)
+    server = api.server()
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        crawler = Crawler("RGAPI-notanapi", increase_key_counter, None, concurrent=True, max_in_flight=2,
+                          api_url=f"http://127.0.0.1:{server.server_address[1]}/{{platform}}")
+        set_ranks(crawler.db, 2)
+        crawler.start_crawling()
+    finally:
+        server.shutdown()
+        server.server_close()
+    stats = list(crawler.db.db_rank_stats.find())
+    assert len(stats) == 2
+    assert sum(rank['calls'] for rank in stats) == sum(api.stats()["requests"].values())
+    assert sum(rank['docs'] for rank in stats) == crawler.db.count_matches()
@@ -85,3 +85,17 @@ class TestApiKeySet:
         bot.set_new_api(self.update, None)
         len_after = self.api_queue.qsize()
         assert (len_after == len_before + 1)
+
+
+class TestSendLog:
+    message = Message(0, datetime.datetime.now(), Chat(0, 'private'))
+    update = Update(0, message)
+
+    @pytest.mark.parametrize('text', ['0', '10'])
+    def test_no_log_yet(self, bot, monkeypatch, tmp_path, text):
+        replies = []
+        monkeypatch.setattr(Message, "reply_text", lambda _, reply: replies.append(reply))
+        monkeypatch.setenv("mooncaker-log", str(tmp_path / "missing.log"))
+        self.update.message.__setattr__('text', text)
+        bot.send_log(self.update, None)
+        assert replies == ["no log yet"]
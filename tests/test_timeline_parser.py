@@ -0,0 +1,39 @@
+import json
+import pytest
+from mooncaker.external_tools.data_crawler import Crawler
+from mooncaker.external_tools.timeline_parser import RawTimeline, TimelineDeserializer, role_frames
+from benchmarks.timeline_extraction import synthetic_timeline
+from tests import test_data_crawler
+
+
+class TestRoleFrames:
+
+    @pytest.mark.parametrize('indent', [None, 2])
+    def test_same_as_decoded(self, indent):
+        timeline = json.loads(synthetic_timeline(minutes=6, events_per_frame=3))
+        frames = role_frames(RawTimeline(json.dumps(timeline, indent=indent)))
+        assert frames == role_frames(timeline)
+        assert frames[0]['1']['position'] == timeline['info']['frames'][2]['participantFrames']['1']['position']
+        assert frames[1] == timeline['info']['frames'][-1]['participantFrames']
+
+    def test_unexpected_layout(self):
+        timeline = {'info': {'frames': [{'participantFrames': {'1': {'minionsKilled': number}}}
+                                        for number in range(4)]}}
+        # truncated right after the key of the last frame, falls back to decoding everything
+        with pytest.raises(ValueError):
+            role_frames(RawTimeline(json.dumps(timeline)[:-20]))
+        assert role_frames(RawTimeline(json.dumps(timeline))) == ({'1': {'minionsKilled': 2}},
+                                                                  {'1': {'minionsKilled': 3}})
+
+    def test_roles(self):
+        match = test_data_crawler.TestMatchDetails.matches_succ[0]
+        timeline = test_data_crawler.TestMatchDetails.timelines_succ[0]
+        participants = match['info']['participants']
+        assert Crawler.roles_from_timeline(participants, RawTimeline(json.dumps(timeline))) == \
+            Crawler.roles_from_timeline(participants, timeline)
+
+
+def test_deserializer():
+    deserializer = TimelineDeserializer()
+    assert isinstance(deserializer.deserialize("MatchApiV5", "timeline_by_match", '{"info": {}}'), RawTimeline)
+    assert deserializer.deserialize("MatchApiV5", "by_id", '{"info": {}}') == {'info': {}}